@@ -1,18 +1,109 @@
+import argparse
+import asyncio
+import os
+import random
+import sys
 import threading
 import time
-import requests
-from pynput import keyboard
-from model.src import main as video_processor
 
-keyboard_keystrokes = []
-keyboard_timestamps = []
-video_keystrokes = []
-video_timestamps = []
+import aiohttp
+import numpy as np
+
+# The model modules import each other by bare name
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "model", "src"))
+
+from key_codes import key_to_code, pynput_key_to_code
+from finger_key_mapping import available_layouts, DEFAULT_LAYOUT
+
+ATTEST_URL = 'https://wapo-testnet.phala.network/ipfs/QmdjBG9vem9vjMgxKDxwMbcvZs9Asn73C2MAeWfejgMvQv/attest'
+
+
+# One captured keystroke: capture time and canonical key code (see key_codes.py)
+EVENT_DTYPE = np.dtype([('timestamp', np.float64), ('keycode', np.int32)])
+
+
+class EventRing:
+    # Preallocated ring of keystroke events with one writer thread and one reader.
+    # The writer fills a slot and then publishes it by advancing `written`, the reader
+    # copies everything published since its last snapshot and then advances `read`.
+    # Each counter is only ever assigned by one thread, so neither side takes a lock
+    # and capture never waits for the uploader.
+    def __init__(self, capacity=1 << 16):
+        self.events = np.zeros(capacity, dtype=EVENT_DTYPE)
+        self.capacity = capacity
+        self.written = 0
+        self.read = 0
+        self.dropped = 0
+        # Drops already reported by take_dropped, only assigned by the reader
+        self.dropped_reported = 0
+
+    def push(self, timestamp, keycode):
+        if self.written - self.read >= self.capacity:
+            # The reader fell a whole ring behind, newer events are dropped rather than blocking
+            self.dropped += 1
+            return
+        self.events[self.written % self.capacity] = (timestamp, keycode)
+        self.written += 1
+
+    def snapshot(self):
+        # Returns a copy of the events since the last snapshot and frees their slots
+        read, written = self.read, self.written
+        events = np.take(self.events, np.arange(read, written), mode='wrap')
+        self.read = written
+        return events
+
+    def take_dropped(self):
+        # Number of events dropped since the last call
+        dropped = self.dropped
+        new_drops = dropped - self.dropped_reported
+        self.dropped_reported = dropped
+        return new_drops
+
+
+class EventBuffer:
+    # Keystrokes of the keyboard and the video model collected between two uploads,
+    # one ring per source since each has its own capture thread
+    def __init__(self, capacity=1 << 16):
+        self.keyboard = EventRing(capacity)
+        self.video = EventRing(capacity)
+
+    def add_keyboard(self, keycode, timestamp):
+        self.keyboard.push(timestamp, keycode)
+
+    def add_video(self, keycode, timestamp):
+        self.video.push(timestamp, keycode)
+
+    def swap(self):
+        # Returns everything collected so far as upload payload and starts a new batch
+        keyboard_events = self.keyboard.snapshot()
+        video_events = self.video.snapshot()
+        for source, ring in (('keyboard', self.keyboard), ('video', self.video)):
+            dropped = ring.take_dropped()
+            if dropped:
+                print(f"Lost {dropped} {source} keystrokes, the uploader fell a whole buffer behind")
+        return {
+            'keyboard_timestamps': keyboard_events['timestamp'].tolist(),
+            'keyboard_keystrokes': keyboard_events['keycode'].tolist(),
+            'video_timestamps': video_events['timestamp'].tolist(),
+            'video_keystrokes': video_events['keycode'].tolist()
+        }
+
+
+def batch_size(batch):
+    return len(batch['keyboard_keystrokes']) + len(batch['video_keystrokes'])
+
+
+def monitor_keyboard(buffer):
+    # Imported here so the uploader can run and be tested without a display or keyboard hook
+    from pynput import keyboard
 
-def monitor_keyboard():
     def on_press(key):
-        keyboard_timestamps.append(time.time())
-        keyboard_keystrokes.append(key)
+        # Same clock the video frames are stamped with
+        timestamp = time.monotonic()
+        keycode = pynput_key_to_code(key)
+        # Special keys without a layout label can't be compared with the video
+        if keycode is not None:
+            buffer.add_keyboard(keycode, timestamp)
 
     with keyboard.Listener(on_press=on_press) as listener:
         try:
@@ -21,46 +112,107 @@ def monitor_keyboard():
             # Exit gracefully on Ctrl+C
             pass
 
-def monitor_video():
-    def on_press(key):
-        video_timestamps.append(time.time())
-        video_keystrokes.append(key)
-    
-    video_processor.main(on_press=on_press)
+def monitor_video(buffer, setup=None, auto_calibrate=False, layout=DEFAULT_LAYOUT):
+    from model.src import main as video_processor
+
+    def on_press(key, timestamp):
+        # Capture time of the frame the press was detected in, not when detection finished
+        keycode = key_to_code(key)
+        if keycode is not None:
+            buffer.add_video(keycode, timestamp)
+
+    video_processor.main(on_press=on_press, setup=setup, auto_calibrate=auto_calibrate, layout=layout)
+
+
+async def post_batch(session, url, batch, retries, backoff):
+    # Sends one batch to the attestation endpoint, retrying network errors and 5xx
+    # responses with exponential backoff. Returns True once the batch was accepted.
+    reason = None
+    for attempt in range(retries):
+        try:
+            async with session.post(url, json=batch) as response:
+                if response.status < 400:
+                    return True
+                reason = f"HTTP {response.status}"
+                # The endpoint rejected the batch itself, sending it again won't help
+                if response.status < 500:
+                    break
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            reason = repr(e)
+        if attempt + 1 < retries:
+            # Jitter so restarted clients don't retry in lockstep
+            await asyncio.sleep(backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+    print(f"Dropping {batch_size(batch)} keystrokes after {attempt + 1} attempts: {reason}")
+    return False
 
-def compare_lists():
-    # every 15 seconds, call Phala to compare keystrokes and timestamps and get attestation
+
+async def send_batches(session, url, queue, slots, retries, backoff):
     while True:
-        time.sleep(15)
-
-        url = 'https://wapo-testnet.phala.network/ipfs/'
-        data = {
-            'keyboard_timestamps': keyboard_timestamps,
-            'keyboard_keystrokes': keyboard_keystrokes,
-            'video_timestamps': video_timestamps,
-            'video_keystrokes': video_keystrokes
-        }
-        requests.post(url + 'QmdjBG9vem9vjMgxKDxwMbcvZs9Asn73C2MAeWfejgMvQv/attest', json=data)
+        batch = await queue.get()
+        try:
+            await post_batch(session, url, batch, retries, backoff)
+        except Exception as e:
+            # e.g. an invalid URL, the sender has to keep going or the queue fills up for good
+            print(f"Dropping {batch_size(batch)} keystrokes: {e!r}")
+        finally:
+            slots.release()
+            queue.task_done()
+
+
+async def upload_events(buffer, url=ATTEST_URL, interval=15.0, max_pending=2, retries=4,
+                        backoff=1.0, timeout=10.0, flush_timeout=5.0):
+    # Every `interval` seconds the collected keystrokes are sent to Phala to compare
+    # keystrokes and timestamps and get an attestation. At most max_pending batches
+    # are queued or in flight; while the endpoint is slower than that, the next swap
+    # waits and the buffer keeps collecting, so batches grow instead of piling up.
+    queue = asyncio.Queue()
+    slots = asyncio.Semaphore(max_pending)
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        sender = asyncio.create_task(send_batches(session, url, queue, slots, retries, backoff))
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                await slots.acquire()
+                batch = buffer.swap()
+                if batch_size(batch) == 0:
+                    slots.release()
+                    continue
+                queue.put_nowait(batch)
+        finally:
+            # Send what is left on shutdown, without waiting forever for a dead endpoint
+            batch = buffer.swap()
+            if batch_size(batch) > 0:
+                queue.put_nowait(batch)
+            try:
+                await asyncio.wait_for(queue.join(), flush_timeout)
+            except asyncio.TimeoutError:
+                print("Shutting down with unsent keystrokes.")
+            sender.cancel()
 
-        keyboard_keystrokes.clear()
-        keyboard_timestamps.clear()
-        video_keystrokes.clear()
-        video_timestamps.clear()
 
 def main():
-    thread_keyboard = threading.Thread(target=monitor_keyboard)
-    thread_video = threading.Thread(target=monitor_video)
-    thread_compare = threading.Thread(target=compare_lists)
+    parser = argparse.ArgumentParser(description="Record keyboard and video keystrokes and attest them.")
+    parser.add_argument('--attest-url', default=ATTEST_URL, help="endpoint the keystroke batches are posted to")
+    parser.add_argument('--interval', type=float, default=15.0, help="seconds between two uploads")
+    parser.add_argument('--setup', help="name of the camera setup, its keyboard calibration is saved and reused")
+    parser.add_argument('--auto-calibrate', action='store_true', help="detect the keyboard instead of clicking its corners")
+    parser.add_argument('--layout', choices=available_layouts(), default=DEFAULT_LAYOUT, help="keyboard layout of the recorded keyboard")
+    args = parser.parse_args()
+
+    buffer = EventBuffer()
+    # Daemon threads so Ctrl+C ends the program once the last batch is sent
+    thread_keyboard = threading.Thread(target=monitor_keyboard, args=(buffer,), daemon=True)
+    thread_video = threading.Thread(target=monitor_video, args=(buffer, args.setup, args.auto_calibrate, args.layout),
+                                    daemon=True)
 
     thread_keyboard.start()
     thread_video.start()
-    thread_compare.start()
 
-    # Ensure the main thread keeps running
-    thread_keyboard.join()
-    thread_video.join()
-    thread_compare.join()
-    
+    try:
+        asyncio.run(upload_events(buffer, args.attest_url, args.interval))
+    except KeyboardInterrupt:
+        pass
+
 
 if __name__ == '__main__':
     main()
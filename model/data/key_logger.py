@@ -1,7 +1,21 @@
-import csv
+import argparse
+import os
+import sys
 import time
 from pynput import keyboard
 
+# The log format and key codes are shared with the model in ../src
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from key_codes import pynput_key_to_code
+from keylog_format import KeylogWriter, KEY_DOWN, KEY_UP, FSYNC_POLICIES, FSYNC_CLOSE
+
+parser = argparse.ArgumentParser(description="Log key presses and releases to a binary keystroke log.")
+parser.add_argument('-o', '--output', default='key_log.klog', help="log file (default: key_log.klog)")
+parser.add_argument('--fsync', choices=FSYNC_POLICIES, default=FSYNC_CLOSE,
+                    help="when the log is synced to disk (default: close)")
+args = parser.parse_args()
+
 print("==========================================")
 print("       Keyboard Event Logger Started       ")
 print("==========================================")
@@ -9,108 +23,54 @@ print("Recording key presses and releases.")
 print("Press 'Ctrl+C' to stop the logger.")
 print("------------------------------------------")
 
-# Open the CSV file for writing
-with open('key_log.csv', 'w', newline='', buffering=1) as csvfile:
-    fieldnames = ['timestamp', 'key-name', 'key-char', 'key-vk', 'event-type', 'duration']
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-    writer.writeheader()
-    csvfile.flush()
-
+# Open the binary log for writing, events are written in groups instead of one by one
+with KeylogWriter(args.output, fsync=args.fsync) as writer:
     key_press_times = {}
     pressed_keys = set()
 
-    # Function to handle key press events
-    def on_press(key):
-        timestamp = time.time()
-        event_type = 'key down'
-
-        # Identify the key
+    def identify(key):
+        # Returns (key_id, virtual key code) of a pynput key
         if isinstance(key, keyboard.KeyCode):
             # For character keys
-            key_id = ('char', key.char)
-            key_char = key.char
-            key_name = None
-            key_vk = key.vk
+            return ('char', key.char), key.vk
         elif isinstance(key, keyboard.Key):
             # For special keys
-            key_id = ('key', key)
-            key_char = None
-            key_name = key.name
-            key_vk = key.value.vk
-        else:
-            key_id = ('unknown', key)
-            key_char = None
-            key_name = str(key)
-            key_vk = None
+            return ('key', key), key.value.vk
+        return ('unknown', key), None
+
+    # Function to handle key press events
+    def on_press(key):
+        timestamp = time.monotonic_ns()
+        key_id, key_vk = identify(key)
 
         # Check if the key is already pressed
         if key_id in pressed_keys:
             # Key is already pressed, ignore this event
             return
-        else:
-            # Key is not pressed yet, record it
-            pressed_keys.add(key_id)
-            key_press_times[key_id] = timestamp
-
-            # Record the key down event
-            key_data = {
-                'timestamp': timestamp,
-                'key-name': key_name,
-                'key-char': key_char,
-                'key-vk': key_vk,
-                'event-type': event_type,
-                'duration': ''
-            }
-            writer.writerow(key_data)
-            csvfile.flush()
+
+        # Key is not pressed yet, record it
+        pressed_keys.add(key_id)
+        key_press_times[key_id] = timestamp
+
+        # Record the key down event
+        writer.write(timestamp, pynput_key_to_code(key), key_vk, KEY_DOWN)
 
     # Function to handle key release events
     def on_release(key):
-        timestamp = time.time()
-        event_type = 'key up'
-
-        # Identify the key
-        if isinstance(key, keyboard.KeyCode):
-            # For character keys
-            key_id = ('char', key.char)
-            key_char = key.char
-            key_name = None
-            key_vk = key.vk
-        elif isinstance(key, keyboard.Key):
-            # For special keys
-            key_id = ('key', key)
-            key_char = None
-            key_name = key.name
-            key_vk = key.value.vk
-        else:
-            key_id = ('unknown', key)
-            key_char = None
-            key_name = str(key)
-            key_vk = None
+        timestamp = time.monotonic_ns()
+        key_id, key_vk = identify(key)
 
         # Check if the key was pressed
-        if key_id in pressed_keys:
-            # Calculate the duration
-            press_time = key_press_times.pop(key_id, None)
-            duration = timestamp - press_time if press_time else None
-
-            # Remove the key from the set of pressed keys
-            pressed_keys.remove(key_id)
-
-            # Record the key up event
-            key_data = {
-                'timestamp': timestamp,
-                'key-name': key_name,
-                'key-char': key_char,
-                'key-vk': key_vk,
-                'event-type': event_type,
-                'duration': duration
-            }
-            writer.writerow(key_data)
-            csvfile.flush()
-        else:
+        if key_id not in pressed_keys:
             # Key release without a corresponding key press
-            pass  # Ignore or handle as needed
+            return
+
+        # Calculate the duration and remove the key from the set of pressed keys
+        press_time = key_press_times.pop(key_id)
+        pressed_keys.remove(key_id)
+
+        # Record the key up event
+        writer.write(timestamp, pynput_key_to_code(key), key_vk, KEY_UP, timestamp - press_time)
 
     # Start the keyboard listener
     with keyboard.Listener(on_press=on_press, on_release=on_release) as listener:
@@ -122,4 +82,5 @@ with open('key_log.csv', 'w', newline='', buffering=1) as csvfile:
             pass
 
 print("------------------------------------------")
-print("Key logger stopped. Log saved to 'key_log.csv'.")
+print(f"Key logger stopped. Log saved to '{args.output}'.")
+print("Convert it to csv with: python ../src/keylog_format.py export " + args.output + " key_log.csv")
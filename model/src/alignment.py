@@ -0,0 +1,231 @@
+import numpy as np
+
+from finger_key_mapping import as_layout
+
+
+def key_distance_table(keyboard_layout):
+    # Distances between the key centres of the layout in key units (height of one key row),
+    # so the table doesn't depend on the size the layout was created for.
+    # Returns (codes, distances): the sorted key codes of the layout and a matrix with one
+    # extra last row/column for codes that aren't on the layout.
+    layout = as_layout(keyboard_layout)
+    known = layout.codes >= 0
+    pitch = np.median(layout.rects[:, 3])
+
+    # Keys like Shift or Cmd exist twice, a press on either counts as that key
+    codes, owner = np.unique(layout.codes[known], return_inverse=True)
+    points = layout.centers[known]
+    pairwise = np.hypot(*(points[:, None, :] - points[None, :, :]).transpose(2, 0, 1)) / pitch
+
+    distances = np.full((len(codes) + 1, len(codes) + 1), np.inf)
+    np.minimum.at(distances, (owner[:, None], owner[None, :]), pairwise)
+    return codes, distances
+
+
+def code_index(keycodes, codes):
+    # Index of every key code in the sorted layout codes, len(codes) if it isn't on the layout
+    index = np.searchsorted(codes, keycodes)
+    index = np.minimum(index, len(codes) - 1)
+    return np.where(codes[index] == keycodes, index, len(codes))
+
+
+def pair_costs(intervals_a, index_a, keys_a, intervals_b, index_b, keys_b, columns,
+               distances, time_weight, max_interval_error, max_distance):
+    # Cost of pairing keystroke i of a with the keystroke before every column of its band,
+    # infinite for column 0 and columns past the end of b
+    valid = (columns >= 1) & (columns <= len(keys_b))
+    j = np.clip(columns - 1, 0, len(keys_b) - 1)
+    key = np.minimum(distances[index_a[:, None], index_b[j]] / max_distance, 1.0)
+    key[keys_b[j] == keys_a[:, None]] = 0.0
+    timing = np.minimum(np.abs(intervals_b[j] - intervals_a[:, None]) / max_interval_error, 1.0)
+    return np.where(valid, key + time_weight * timing, np.inf)
+
+
+def relax_row(diagonal, vertical, costs, offsets, gap_cost):
+    # One row of the cost matrix from the cells above-left (diagonal) and above (vertical)
+    # of each of its cells. offsets are the column numbers times gap_cost.
+    # Diagonal step pairs the two keystrokes, vertical step skips the keystroke of this row
+    best = diagonal + costs
+    np.minimum(best, vertical + gap_cost, out=best)
+    # Horizontal steps skip keystrokes of b, resolved for the whole row by a running minimum
+    best -= offsets
+    np.minimum.accumulate(best, out=best)
+    best += offsets
+    return best
+
+
+def align_keystrokes(times_a, keys_a, times_b, keys_b, codes, distances, window=32,
+                     gap_cost=1.0, time_weight=1.0, max_interval_error=1.0, max_distance=2.0,
+                     chunk=4096):
+    # Banded alignment of two keystroke streams (Sakoe-Chiba band of `window` keystrokes
+    # around the diagonal). Pairing two keystrokes costs the key distance plus how much
+    # the pause before them differs, a missed or extra keystroke costs gap_cost.
+    # Runs in O(n * window) time and O(n + chunk * window) memory.
+    # Returns the total cost of the best alignment.
+    n = len(keys_a)
+    m = len(keys_b)
+    if n == 0 or m == 0:
+        return (n + m) * gap_cost
+
+    # The streams have different clocks, so timing is compared by the pauses between keystrokes
+    intervals_a = np.diff(times_a, prepend=times_a[0])
+    intervals_b = np.diff(times_b, prepend=times_b[0])
+    keys_a = np.asarray(keys_a)
+    keys_b = np.asarray(keys_b)
+    index_a = code_index(keys_a, codes)
+    index_b = code_index(keys_b, codes)
+
+    # The band must be at least as wide as the slope of the diagonal to stay connected
+    window = max(window, int(np.ceil(m / n)), int(np.ceil(n / m)))
+    width = 2 * window + 1
+    rows = np.arange(1, n + 1)
+    band_lo = np.clip(np.floor(rows * m / n - window).astype(np.int64), 0, m)
+
+    # Two rows of the cost matrix, shifted by one so column -1 is a sentinel.
+    # The band only moves right, so cells a row doesn't compute are still infinite
+    # except the one left of it, which is reset every row
+    size = m + width + 2
+    columns = np.arange(size) * gap_cost
+    previous = np.full(size, np.inf)
+    current = np.full(size, np.inf)
+    previous[1:window + 2] = columns[:window + 1]
+
+    for start in range(0, n, chunk):
+        stop = min(n, start + chunk)
+        band = band_lo[start:stop, None] + np.arange(width)
+        costs = pair_costs(intervals_a[start:stop], index_a[start:stop], keys_a[start:stop],
+                           intervals_b, index_b, keys_b, band,
+                           distances, time_weight, max_interval_error, max_distance)
+
+        for i in range(start, stop):
+            lo = band_lo[i]
+            current[lo] = np.inf
+            current[lo + 1:lo + width + 1] = relax_row(previous[lo:lo + width], previous[lo + 1:lo + width + 1],
+                                                       costs[i - start], columns[lo:lo + width], gap_cost)
+            previous, current = current, previous
+
+    return previous[m + 1]
+
+
+class KeystrokeStream:
+    # Append-only keystroke stream backed by arrays that double in size when full
+    def __init__(self, codes, capacity=1024):
+        self.codes = codes
+        self.length = 0
+        self.times = np.empty(capacity, dtype=np.float64)
+        self.keys = np.empty(capacity, dtype=np.int64)
+        self.index = np.empty(capacity, dtype=np.int64)
+        self.intervals = np.empty(capacity, dtype=np.float64)
+
+    def __len__(self):
+        return self.length
+
+    def extend(self, times, keys):
+        times = np.asarray(times, dtype=np.float64)
+        keys = np.asarray(keys, dtype=np.int64)
+        end = self.length + len(times)
+        if end > len(self.times):
+            capacity = max(end, 2 * len(self.times))
+            for name in ('times', 'keys', 'index', 'intervals'):
+                grown = np.empty(capacity, dtype=getattr(self, name).dtype)
+                grown[:self.length] = getattr(self, name)[:self.length]
+                setattr(self, name, grown)
+
+        self.times[self.length:end] = times
+        self.keys[self.length:end] = keys
+        self.index[self.length:end] = code_index(keys, self.codes)
+        # Pause before every keystroke, 0 for the very first one
+        previous = self.times[self.length - 1] if self.length else (times[0] if len(times) else 0.0)
+        self.intervals[self.length:end] = np.diff(times, prepend=previous)
+        self.length = end
+
+
+class StreamingAligner:
+    # Incremental version of align_keystrokes for streams that arrive in pieces.
+    # Every row of the cost matrix (keystroke of a) is computed once as soon as the
+    # keystrokes of b in its band are known, so closing the streams only computes the
+    # rows still missing. The band follows the cheapest cell of the previous row since
+    # the final lengths aren't known in advance.
+    def __init__(self, codes, distances, window=32, gap_cost=1.0, time_weight=1.0,
+                 max_interval_error=1.0, max_distance=2.0):
+        self.distances = distances
+        self.window = window
+        self.width = 2 * window + 1
+        self.gap_cost = gap_cost
+        self.time_weight = time_weight
+        self.max_interval_error = max_interval_error
+        self.max_distance = max_distance
+
+        self.a = KeystrokeStream(codes)
+        self.b = KeystrokeStream(codes)
+        self.closed = False
+
+        # Last computed row of the cost matrix over the columns lo .. lo + width - 1
+        self.rows = 0
+        self.lo = 0
+        self.row = np.arange(self.width) * gap_cost
+        self.offsets = np.arange(self.width) * gap_cost
+
+    def extend_a(self, times, keys):
+        self.a.extend(times, keys)
+        self.advance()
+
+    def extend_b(self, times, keys):
+        self.b.extend(times, keys)
+        self.advance()
+
+    def close(self):
+        # No more keystrokes will arrive, returns the total cost of the best alignment
+        self.closed = True
+        self.advance()
+        return self.cost()
+
+    def next_lo(self):
+        # Band of the next row, centred one step diagonally from the cheapest cell of this row
+        return max(self.lo, self.lo + int(np.argmin(self.row)) + 1 - self.window)
+
+    def advance(self):
+        while self.rows < len(self.a):
+            lo = self.next_lo()
+            # Without the whole band of b the row would have to be recomputed later
+            if not self.closed and len(self.b) < lo + self.width - 1:
+                return
+            self.compute_row(lo)
+
+    def compute_row(self, lo):
+        a = self.a
+        b = self.b
+        m = len(b)
+        columns = lo + np.arange(self.width)
+        i = self.rows
+        if m:
+            costs = pair_costs(a.intervals[i:i + 1], a.index[i:i + 1], a.keys[i:i + 1],
+                               b.intervals[:m], b.index[:m], b.keys[:m], columns[None, :],
+                               self.distances, self.time_weight, self.max_interval_error,
+                               self.max_distance)[0]
+        else:
+            costs = np.full(self.width, np.inf)
+
+        # The previous row padded with infinity around it, shifted to the new band
+        shift = lo - self.lo
+        padded = np.full(2 * self.width + 1, np.inf)
+        padded[1:self.width + 1] = self.row
+        self.row = relax_row(padded[shift:shift + self.width], padded[shift + 1:shift + self.width + 1],
+                             costs, self.offsets + lo * self.gap_cost, self.gap_cost)
+        self.lo = lo
+        self.rows += 1
+
+    def partial_cost(self):
+        # Cost of the best alignment of the rows computed so far against any prefix of b
+        return float(np.min(self.row))
+
+    def cost(self):
+        # Cost of the best alignment of the keystrokes seen so far, the rest of b counts as missed
+        m = len(self.b)
+        if self.rows < len(self.a):
+            m = min(m, self.lo + self.width - 1)
+        columns = self.lo + np.arange(self.width)
+        known = columns <= m
+        if not known.any():
+            return np.inf
+        return float(np.min(self.row[known] + (m - columns[known]) * self.gap_cost))
@@ -1,155 +1,181 @@
+import json
+import os
+from functools import lru_cache
+
 import numpy as np
 import cv2
 
-def create_keyboard_layout(width, height):
-    key_unit = 50  # Base key unit size in pixels
-
-    horizontal_spacing = 5
-    vertical_spacing = 5
-    starting_x = 5
-    starting_y = 5
-
-    # Define the keyboard rows with keys and their relative widths (updated for MacBook)
-    keyboard_rows = [
-        # Function keys row
-        [
-            {'key': 'Esc', 'width': 1.5},
-            {'key': 'F1', 'width': 1},
-            {'key': 'F2', 'width': 1},
-            {'key': 'F3', 'width': 1},
-            {'key': 'F4', 'width': 1},
-            {'key': 'F5', 'width': 1},
-            {'key': 'F6', 'width': 1},
-            {'key': 'F7', 'width': 1},
-            {'key': 'F8', 'width': 1},
-            {'key': 'F9', 'width': 1},
-            {'key': 'F10', 'width': 1},
-            {'key': 'F11', 'width': 1},
-            {'key': 'F12', 'width': 1},
-            {'key': 'Power', 'width': 1},
-        ],
-        # Number row
-        [
-            {'key': '^', 'width': 1},
-            {'key': '1', 'width': 1},
-            {'key': '2', 'width': 1},
-            {'key': '3', 'width': 1},
-            {'key': '4', 'width': 1},
-            {'key': '5', 'width': 1},
-            {'key': '6', 'width': 1},
-            {'key': '7', 'width': 1},
-            {'key': '8', 'width': 1},
-            {'key': '9', 'width': 1},
-            {'key': '0', 'width': 1},
-            {'key': 'SS', 'width': 1},
-            {'key': '´', 'width': 1},
-            {'key': 'Delete', 'width': 1.5},
-        ],
-        # Top letter row
-        [
-            {'key': 'Tab', 'width': 1.5},
-            {'key': 'Q', 'width': 1},
-            {'key': 'W', 'width': 1},
-            {'key': 'E', 'width': 1},
-            {'key': 'R', 'width': 1},
-            {'key': 'T', 'width': 1},
-            {'key': 'Z', 'width': 1},
-            {'key': 'U', 'width': 1},
-            {'key': 'I', 'width': 1},
-            {'key': 'O', 'width': 1},
-            {'key': 'P', 'width': 1},
-            {'key': 'UE', 'width': 1},
-            {'key': '+', 'width': 1},
-            {'key': 'Return', 'width': 1},
-        ],
-        # Middle letter row
-        [
-            {'key': 'CapsLock', 'width': 1.75},
-            {'key': 'A', 'width': 1},
-            {'key': 'S', 'width': 1},
-            {'key': 'D', 'width': 1},
-            {'key': 'F', 'width': 1},
-            {'key': 'G', 'width': 1},
-            {'key': 'H', 'width': 1},
-            {'key': 'J', 'width': 1},
-            {'key': 'K', 'width': 1},
-            {'key': 'L', 'width': 1},
-            {'key': 'OE', 'width': 1},
-            {'key': 'AE', 'width': 1},
-            {'key': '#', 'width': 1},
-            {'key': 'Return', 'width': 0.75},
-        ],
-        # Bottom letter row
-        [
-            {'key': 'Shift', 'width': 1.25},
-            {'key': '<', 'width': 1},
-            {'key': 'Y', 'width': 1},
-            {'key': 'X', 'width': 1},
-            {'key': 'C', 'width': 1},
-            {'key': 'V', 'width': 1},
-            {'key': 'B', 'width': 1},
-            {'key': 'N', 'width': 1},
-            {'key': 'M', 'width': 1},
-            {'key': ',', 'width': 1},
-            {'key': '.', 'width': 1},
-            {'key': '-', 'width': 1},
-            {'key': 'Shift', 'width': 2.25},
-        ],
-        # Spacebar row
-        [
-            {'key': 'Fn', 'width': 1},
-            {'key': 'Ctr', 'width': 1},
-            {'key': 'Opt', 'width': 1},
-            {'key': 'Cmd', 'width': 1.25},
-            {'key': 'Space', 'width': 5},
-            {'key': 'Cmd', 'width': 1.25},
-            {'key': 'Opt', 'width': 1},
-            {'key': 'Left', 'width': 1},
-            {'key': 'Up', 'width': 1},
-            {'key': 'Down', 'width': 1},
-            {'key': 'Right', 'width': 1},
-        ],
-    ]
+from key_codes import key_to_code
 
-    # Calculate total key widths for scaling
-    total_units = sum([key_info['width'] for key_info in keyboard_rows[1]])  # Using the number row as reference
-    total_key_width = total_units * key_unit
-    total_key_height = key_unit * len(keyboard_rows)
+# Keyboard layouts as json files, see load_layout_rows
+LAYOUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'layouts')
+DEFAULT_LAYOUT = 'iso_de'
+
+KEY_UNIT = 50  # Base key unit size in pixels
+KEY_SPACING = 5  # Gap between two keys in pixels, horizontally and vertically
+KEY_ORIGIN = 5  # Position of the first key in pixels
+
+
+class KeyboardLayout:
+    # Keys of a layout scaled to a warped keyboard size, stored as one array entry per key:
+    #   keys    => key labels, a key like Shift can appear more than once
+    #   codes   => canonical key code of every key, -1 for labels without one
+    #   rects   => (x, y, width, height) of every key in pixels
+    #   centers => (x, y) centre of every key in pixels
+    # Layouts are cached and shared by every caller, so the arrays are read-only.
+    # Iterating yields the keys as dicts {'key', 'x', 'y', 'width', 'height'}.
+    __slots__ = ('name', 'size', 'keys', 'codes', 'rects', 'centers')
+
+    def __init__(self, name, size, keys, rects):
+        self.name = name
+        self.size = size
+        self.keys = tuple(keys)
+        codes = [key_to_code(key) for key in self.keys]
+        self.codes = np.array([-1 if code is None else code for code in codes], dtype=np.int64)
+        self.rects = np.asarray(rects, dtype=np.float64).reshape(-1, 4)
+        self.centers = self.rects[:, :2] + self.rects[:, 2:] / 2
+        for array in (self.codes, self.rects, self.centers):
+            array.flags.writeable = False
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, key_id):
+        x, y, w, h = self.rects[key_id].tolist()
+        return {'key': self.keys[key_id], 'x': x, 'y': y, 'width': w, 'height': h}
+
+    def __iter__(self):
+        for key_id in range(len(self.keys)):
+            yield self[key_id]
 
-    # Scaling factors
-    scale_x = width / total_key_width
-    scale_y = height / total_key_height
+    def key_ids(self, labels):
+        # Ids of all keys with one of the labels
+        labels = set(labels)
+        return [key_id for key_id, key in enumerate(self.keys) if key in labels]
+
+
+def available_layouts():
+    return sorted(name[:-len('.json')] for name in os.listdir(LAYOUT_DIR) if name.endswith('.json'))
+
+@lru_cache(maxsize=None)
+def load_layout_rows(name):
+    # Reads layouts/<name>.json: the keyboard rows from top to bottom, every key as
+    # [label, width in key units], and the row whose width spans the whole keyboard
+    with open(os.path.join(LAYOUT_DIR, name + '.json'), 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    rows = tuple(tuple((key, float(width)) for key, width in row) for row in data['rows'])
+    return rows, data.get('reference_row', 1)
+
+@lru_cache(maxsize=32)
+def create_keyboard_layout(width, height, layout=DEFAULT_LAYOUT):
+    # Scales the layout to the warped keyboard size, computed once per (width, height, layout)
+    rows, reference_row = load_layout_rows(layout)
+
+    # Calculate total key widths for scaling
+    total_key_width = sum(key_width for _, key_width in rows[reference_row]) * KEY_UNIT
+    total_key_height = KEY_UNIT * len(rows)
 
     # Use the smaller scaling factor to maintain aspect ratio
-    scale = min(scale_x, scale_y)
+    scale = min(width / total_key_width, height / total_key_height)
+    key_h = KEY_UNIT * scale
+
+    keys = []
+    rects = []
+    for row_index, row in enumerate(rows):
+        key_w = np.array([key_width for _, key_width in row]) * KEY_UNIT * scale
+        # Every key starts where the previous one ended
+        xs = np.cumsum(np.concatenate(([KEY_ORIGIN], key_w[:-1])))
+        y = KEY_ORIGIN + row_index * key_h
+        keys.extend(key for key, _ in row)
+        rects.extend((x, y, w - KEY_SPACING * scale, key_h - KEY_SPACING * scale)
+                     for x, w in zip(xs.tolist(), key_w.tolist()))
+
+    return KeyboardLayout(layout, (width, height), keys, rects)
+
+def as_layout(keyboard_layout):
+    # Accepts a KeyboardLayout or a list of key dicts as created by older code
+    if isinstance(keyboard_layout, KeyboardLayout):
+        return keyboard_layout
+    keys = [key_info['key'] for key_info in keyboard_layout]
+    rects = [(key_info['x'], key_info['y'], key_info['width'], key_info['height']) for key_info in keyboard_layout]
+    return KeyboardLayout(None, None, keys, rects)
 
-    # Adjust key sizes and positions
-    keyboard_layout = []
-    current_y = starting_y
+def get_key_lookup(keyboard_layout):
+    # Key lookup of a layout, shared by every detector of the same cached layout
+    if isinstance(keyboard_layout, KeyboardLayout):
+        return _cached_key_lookup(keyboard_layout)
+    return create_key_lookup(keyboard_layout)
 
-    for row in keyboard_rows:
-        current_x = starting_x
-        for key_info in row:
-            key = key_info['key']
-            key_w = key_info['width'] * key_unit * scale
-            key_h = key_unit * scale
+@lru_cache(maxsize=32)
+def _cached_key_lookup(keyboard_layout):
+    return create_key_lookup(keyboard_layout)
 
-            key_data = {
-                'key': key,
-                'x': current_x,
-                'y': current_y,
-                'width': key_w - horizontal_spacing * scale,
-                'height': key_h - vertical_spacing * scale
-            }
-            keyboard_layout.append(key_data)
+def create_key_lookup(keyboard_layout):
+    # Precompute a per-pixel label raster over the warped keyboard space so fingertips
+    # map to keys by NumPy indexing instead of scanning the layout.
+    #   'keys'     => key label per key id
+    #   'labels'   => key id of the key containing the pixel, -1 for gaps between keys
+    #   'nearest'  => key id of the closest key for every pixel
+    #   'distance' => distance in pixels to that closest key, 0 inside a key
+    layout = as_layout(keyboard_layout)
+    # Python floats, so the distances below are computed in float32 like the raster
+    x_min, y_min = layout.rects[:, 0].tolist(), layout.rects[:, 1].tolist()
+    x_max = (layout.rects[:, 0] + layout.rects[:, 2]).tolist()
+    y_max = (layout.rects[:, 1] + layout.rects[:, 3]).tolist()
+    raster_w = int(np.ceil(max(x_max))) + 1
+    raster_h = int(np.ceil(max(y_max))) + 1
+    xs = np.arange(raster_w, dtype=np.float32)
+    ys = np.arange(raster_h, dtype=np.float32)
 
-            current_x += key_w
+    labels = np.full((raster_h, raster_w), -1, dtype=np.int16)
+    nearest = np.zeros((raster_h, raster_w), dtype=np.int16)
+    distance = np.full((raster_h, raster_w), np.inf, dtype=np.float32)
 
-        current_y += key_h
+    # Walk the keys backwards so that, as in the linear scan, the first matching key wins
+    for key_id in range(len(layout) - 1, -1, -1):
+        dx = np.maximum(np.maximum(x_min[key_id] - xs, xs - x_max[key_id]), 0)
+        dy = np.maximum(np.maximum(y_min[key_id] - ys, ys - y_max[key_id]), 0)
+        key_distance = np.sqrt(dy[:, None] ** 2 + dx[None, :] ** 2)
 
-    return keyboard_layout
+        closer = key_distance <= distance
+        nearest[closer] = key_id
+        distance[closer] = key_distance[closer]
+        labels[key_distance == 0] = key_id
+
+    # Shared between detectors, nobody may change it
+    for array in (labels, nearest, distance):
+        array.flags.writeable = False
+    return {
+        'keys': list(layout.keys),
+        'labels': labels,
+        'nearest': nearest,
+        'distance': distance,
+    }
+
+def map_fingertips_to_keys(xs, ys, key_lookup):
+    # Map a batch of fingertip coordinates to key ids in O(1) each.
+    # Returns (key_ids, distances): the closest key for every point and its distance,
+    # a distance of 0 means the point is on the key. Points outside the raster are
+    # clamped to its border and their distance to the border is added.
+    xs = np.asarray(xs, dtype=np.float32)
+    ys = np.asarray(ys, dtype=np.float32)
+    raster_h, raster_w = key_lookup['labels'].shape
+    clamped_x = np.clip(xs, 0, raster_w - 1)
+    clamped_y = np.clip(ys, 0, raster_h - 1)
+    cx = np.rint(clamped_x).astype(np.intp)
+    cy = np.rint(clamped_y).astype(np.intp)
+
+    key_ids = key_lookup['nearest'][cy, cx]
+    distances = key_lookup['distance'][cy, cx] + np.hypot(xs - clamped_x, ys - clamped_y)
+    return key_ids, distances
+
+def map_fingertip_to_key(x, y, keyboard_layout, key_lookup=None):
+    if key_lookup is not None:
+        key_ids, distances = map_fingertips_to_keys([x], [y], key_lookup)
+        if distances[0] > 0:
+            return None
+        return key_lookup['keys'][key_ids[0]]
 
-def map_fingertip_to_key(x, y, keyboard_layout):
     # Iterate over the keys to find which one contains the point (x, y)
     for key_info in keyboard_layout:
         x_min = key_info['x']
@@ -208,3 +234,74 @@ def draw_keyboard_layout2(frame, keyboard_layout, pressed_keys=None):
         cv2.putText(frame, key, (text_x, text_y),
                     cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1)
 
+
+
+def _draw_key(image, alpha, key, rect, color, thickness):
+    # Draws the key into the color image and, in full opacity, into the alpha mask
+    x, y, w, h = rect
+
+    # Draw the key rectangle
+    cv2.rectangle(image, (x, y), (x + w, y + h), color, thickness)
+    cv2.rectangle(alpha, (x, y), (x + w, y + h), 255, thickness)
+
+    # Put the key label at the center of the rectangle
+    text_size = cv2.getTextSize(key, cv2.FONT_HERSHEY_SIMPLEX, 0.4, 1)[0]
+    text_x = x + (w - text_size[0]) // 2
+    text_y = y + (h + text_size[1]) // 2
+    cv2.putText(image, key, (text_x, text_y),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1)
+    cv2.putText(alpha, key, (text_x, text_y),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.4, 255, 1)
+
+
+class KeyboardOverlay:
+    # Keyboard layout rendered once into an image plus alpha mask and blended onto each
+    # warped frame, instead of drawing every key on every frame. Pressed key highlights
+    # only redraw the keys whose state changed since the last frame.
+
+    def __init__(self, keyboard_layout, size):
+        width, height = size
+        self.keyboard_layout = as_layout(keyboard_layout)
+        # Whole pixel rectangles of the keys, truncated like the drawing functions above
+        self.rects = [tuple(rect) for rect in self.keyboard_layout.rects.astype(int).tolist()]
+
+        # Drawn onto black, so the color image is already premultiplied by the alpha mask
+        self.base_image = np.zeros((height, width, 3), dtype=np.uint8)
+        self.base_alpha = np.zeros((height, width), dtype=np.uint8)
+        for key, rect in zip(self.keyboard_layout.keys, self.rects):
+            _draw_key(self.base_image, self.base_alpha, key, rect, (200, 200, 200), 1)
+
+        self.image = self.base_image.copy()
+        self.alpha = self.base_alpha.copy()
+        self.inv_alpha = cv2.merge([255 - self.alpha] * 3)
+        self.pressed_keys = set()
+
+    def _key_region(self, key_id):
+        height, width = self.image.shape[:2]
+        x, y, w, h = self.rects[key_id]
+        return slice(max(y, 0), min(y + h + 1, height)), slice(max(x, 0), min(x + w + 1, width))
+
+    def set_pressed_keys(self, pressed_keys):
+        pressed_keys = set(pressed_keys)
+        changed = pressed_keys ^ self.pressed_keys
+        if not changed:
+            return
+
+        for key_id in self.keyboard_layout.key_ids(changed):
+            key = self.keyboard_layout.keys[key_id]
+            region = self._key_region(key_id)
+            if key in pressed_keys:
+                # Green filled rectangle for pressed keys
+                _draw_key(self.image, self.alpha, key, self.rects[key_id], (0, 255, 0), -1)
+            else:
+                # Restore the unpressed key from the static rendering
+                self.image[region] = self.base_image[region]
+                self.alpha[region] = self.base_alpha[region]
+            self.inv_alpha[region] = (255 - self.alpha[region])[..., None]
+        self.pressed_keys = pressed_keys
+
+    def draw(self, frame):
+        # Blend the overlay onto the frame in place: frame * (1 - alpha) + image
+        cv2.multiply(frame, self.inv_alpha, dst=frame, scale=1 / 255)
+        cv2.add(frame, self.image, dst=frame)
+        return frame
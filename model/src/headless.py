@@ -0,0 +1,211 @@
+import argparse
+import csv
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+
+from keyboard_tracking import get_homography_matrix, load_corners, compute_roi, detect_video_corners, HomographyTracker, read_reference_frame
+from finger_key_mapping import create_keyboard_layout, available_layouts, DEFAULT_LAYOUT
+from press_detection import PressDetector
+from pipeline import Pipeline, BLOCK
+from key_codes import key_to_code
+
+
+def create_hands():
+    # Same settings as the interactive main(). Imported here so the video server can
+    # split and merge segments without loading the model in its request process.
+    import mediapipe as mp
+    return mp.solutions.hands.Hands(
+        static_image_mode=False,
+        max_num_hands=2,
+        min_detection_confidence=0.5,
+        min_tracking_confidence=0.5
+    )
+
+
+def process_video(video_path, pts_src, hands=None, verbose=False, use_roi=True, inference_width=None,
+                  start=0.0, end=None, warmup=0.0, track=True, layout=DEFAULT_LAYOUT):
+    # Runs fingertip -> key press detection over a recorded video without any GUI calls.
+    # Returns the keystroke stream as a list of dicts {'timestamp', 'key', 'keycode'},
+    # timestamps are seconds since the start of the recording.
+    # Only keystrokes in [start, end) are returned, decoding starts `warmup` seconds
+    # earlier so hand tracking and fingertip histories are settled at start.
+    # Without pts_src the keyboard corners are detected in the video itself.
+    # track follows the keyboard if the camera moved during the recording.
+    # layout names the keyboard layout file in model/layouts.
+    # A passed in hands instance must not have seen another video, its tracking state
+    # would carry over, by default a fresh one is created and closed here.
+    # Returns None if the video cannot be opened or no keyboard is found.
+    if pts_src is None:
+        pts_src = detect_video_corners(video_path)
+        if pts_src is None:
+            print(f"No keyboard found in video {video_path}.")
+            return None
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print(f"Failed to open video {video_path}.")
+        return None
+
+    tracker = None
+    if track:
+        # The corners belong to the start of the recording
+        reference = read_reference_frame(cap)
+        if reference is not None:
+            tracker = HomographyTracker(reference, pts_src)
+    cap.set(cv2.CAP_PROP_POS_MSEC, max(start - warmup, 0.0) * 1000.0)
+
+    h_matrix, (width, height) = get_homography_matrix(pts_src)
+    keyboard_layout = create_keyboard_layout(width, height, layout)
+    detector = PressDetector(h_matrix, (width, height), keyboard_layout)
+
+    keystrokes = []
+
+    def on_frame(packet):
+        if packet['timestamp'] < start:
+            return
+        for key, _, _ in packet['presses']:
+            keystrokes.append({
+                'timestamp': packet['timestamp'],
+                'key': key,
+                'keycode': key_to_code(key),
+            })
+
+    owns_hands = hands is None
+    if owns_hands:
+        hands = create_hands()
+
+    roi = None
+    if use_roi:
+        roi = compute_roi(pts_src, (cap.get(cv2.CAP_PROP_FRAME_HEIGHT), cap.get(cv2.CAP_PROP_FRAME_WIDTH)))
+
+    # Never drop frames of a recording, decode as fast as the inference keeps up
+    pipeline = Pipeline(cap, hands, detector, on_frame=on_frame, live=False, end_time=end,
+                        queue_size=4, drop_policy=BLOCK, verbose=verbose,
+                        roi=roi, inference_width=inference_width, tracker=tracker)
+    try:
+        pipeline.run()
+    finally:
+        cap.release()
+        if owns_hands:
+            hands.close()
+    return keystrokes
+
+
+def video_duration(video_path):
+    # Length of the recording in seconds from its container metadata, 0 if unknown
+    cap = cv2.VideoCapture(video_path)
+    frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+    if frames <= 0 or fps <= 0:
+        return 0.0
+    return frames / fps
+
+
+def split_segments(duration, count, min_length=10.0):
+    # Splits [0, duration) into at most `count` segments of at least min_length seconds.
+    # The last segment is open ended since container durations aren't exact.
+    count = max(1, min(count, int(duration // min_length)))
+    length = duration / count
+    segments = [(i * length, (i + 1) * length) for i in range(count)]
+    segments[-1] = (segments[-1][0], None)
+    return segments
+
+
+def merge_segments(segment_keystrokes, dedup_window=0.1):
+    # Concatenates the keystroke streams of consecutive segments. A press right at a
+    # seam can be seen by both neighbours a frame apart, so a keystroke of the same key
+    # within dedup_window seconds of one from another segment is dropped.
+    merged = []
+    last_seen = {}  # keycode => (timestamp, segment index) of the last kept keystroke
+    tagged = sorted((k['timestamp'], index, n, k) for index, keystrokes in enumerate(segment_keystrokes)
+                    for n, k in enumerate(keystrokes))
+    for timestamp, index, _, keystroke in tagged:
+        previous = last_seen.get(keystroke['keycode'])
+        if previous is not None and previous[1] != index and timestamp - previous[0] <= dedup_window:
+            continue
+        last_seen[keystroke['keycode']] = (timestamp, index)
+        merged.append(keystroke)
+    return merged
+
+
+def _process_segment(video_path, pts_src, start, end, warmup, kwargs):
+    # Hands in tracking mode carries landmarks over from the previous frame, so every
+    # segment gets a fresh instance instead of one shared by all jobs of a worker
+    return process_video(video_path, pts_src, start=start, end=end, warmup=warmup, **kwargs)
+
+
+def process_video_parallel(video_path, pts_src, workers=None, overlap=2.0, min_length=10.0, **kwargs):
+    # Same result as process_video, but the recording is split into segments analyzed in
+    # parallel worker processes. Each worker seeks to its segment and warms up tracking
+    # over the `overlap` seconds before it, the streams are merged at the seams.
+    # Automatic calibration runs once here instead of in every worker.
+    if pts_src is None:
+        pts_src = detect_video_corners(video_path)
+        if pts_src is None:
+            print(f"No keyboard found in video {video_path}.")
+            return None
+
+    workers = workers or os.cpu_count() or 1
+    segments = split_segments(video_duration(video_path), workers, min_length)
+    if len(segments) == 1:
+        return process_video(video_path, pts_src, **kwargs)
+
+    with ProcessPoolExecutor(max_workers=len(segments)) as executor:
+        futures = [executor.submit(_process_segment, video_path, pts_src, start, end, overlap, kwargs)
+                   for start, end in segments]
+        results = [future.result() for future in futures]
+    if any(keystrokes is None for keystrokes in results):
+        return None
+    return merge_segments(results)
+
+
+def write_keystrokes(keystrokes, f):
+    writer = csv.DictWriter(f, fieldnames=['timestamp', 'keycode', 'key'])
+    writer.writeheader()
+    writer.writerows(keystrokes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Detect keystrokes in a recorded video without a GUI.")
+    parser.add_argument('video', help="recorded video, e.g. data/key_log_typing_1.mp4")
+    parser.add_argument('corners', nargs='?', help="json file with the four calibrated keyboard corners "
+                                                   "(default: detect the keyboard in the video)")
+    parser.add_argument('-o', '--output', help="csv file for the keystroke stream (default: stdout)")
+    parser.add_argument('--full-frame', action='store_true', help="run hand detection on the full frame instead of the keyboard region")
+    parser.add_argument('--inference-width', type=int, help="downscale the inference image to this width")
+    parser.add_argument('--fixed-calibration', action='store_true', help="don't follow the keyboard if the camera moves")
+    parser.add_argument('--layout', choices=available_layouts(), default=DEFAULT_LAYOUT, help="keyboard layout of the recording")
+    parser.add_argument('--workers', type=int, default=1, help="analyze segments of the video in this many processes")
+    args = parser.parse_args()
+
+    pts_src = None
+    if args.corners:
+        pts_src = load_corners(args.corners)
+        if pts_src is None:
+            return 1
+
+    if args.workers > 1:
+        keystrokes = process_video_parallel(args.video, pts_src, workers=args.workers,
+                                            use_roi=not args.full_frame, inference_width=args.inference_width,
+                                            track=not args.fixed_calibration, layout=args.layout)
+    else:
+        keystrokes = process_video(args.video, pts_src, use_roi=not args.full_frame,
+                                   inference_width=args.inference_width, track=not args.fixed_calibration,
+                                   layout=args.layout)
+    if keystrokes is None:
+        return 1
+
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            write_keystrokes(keystrokes, f)
+    else:
+        write_keystrokes(keystrokes, sys.stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+# Canonical key codes shared by the video model and the input logs
+#
+# Printable keys use the unicode code point of their (upper case) character,
+# named keys use the usual control code if there is one and otherwise a code
+# from the private use area so they can never collide with a character.
+
+NAMED_KEY_CODES = {
+    'Delete': 8,
+    'Tab': 9,
+    'Return': 13,
+    'Esc': 27,
+    'Space': 32,
+    'SS': ord('ß'),
+    'UE': ord('Ü'),
+    'OE': ord('Ö'),
+    'AE': ord('Ä'),
+    'Shift': 0xE000,
+    'Ctr': 0xE001,
+    'Opt': 0xE002,
+    'Cmd': 0xE003,
+    'Fn': 0xE004,
+    'CapsLock': 0xE005,
+    'Power': 0xE006,
+    'Left': 0xE010,
+    'Up': 0xE011,
+    'Down': 0xE012,
+    'Right': 0xE013,
+}
+NAMED_KEY_CODES.update({f'F{n}': 0xE020 + n for n in range(1, 13)})
+
+CODE_NAMES = {code: name for name, code in NAMED_KEY_CODES.items()}
+
+
+def key_to_code(key):
+    # Returns the key code of a keyboard layout label, None for unknown labels
+    if key in NAMED_KEY_CODES:
+        return NAMED_KEY_CODES[key]
+    if len(key) == 1:
+        # Some characters have no single upper case character, 'ß'.upper() is 'SS'
+        upper = key.upper()
+        return ord(upper if len(upper) == 1 else key)
+    return None
+
+
+def code_to_key(code):
+    if code in CODE_NAMES:
+        return CODE_NAMES[code]
+    return chr(code)
+
+
+# pynput special key names => keyboard layout labels, so keystrokes logged from the
+# keyboard get the same codes as the ones detected in the video
+PYNPUT_KEY_NAMES = {
+    'backspace': 'Delete',
+    'tab': 'Tab',
+    'enter': 'Return',
+    'esc': 'Esc',
+    'space': 'Space',
+    'shift': 'Shift',
+    'shift_l': 'Shift',
+    'shift_r': 'Shift',
+    'ctrl': 'Ctr',
+    'ctrl_l': 'Ctr',
+    'ctrl_r': 'Ctr',
+    'alt': 'Opt',
+    'alt_l': 'Opt',
+    'alt_r': 'Opt',
+    'alt_gr': 'Opt',
+    'cmd': 'Cmd',
+    'cmd_l': 'Cmd',
+    'cmd_r': 'Cmd',
+    'caps_lock': 'CapsLock',
+    'left': 'Left',
+    'up': 'Up',
+    'down': 'Down',
+    'right': 'Right',
+}
+PYNPUT_KEY_NAMES.update({f'f{n}': f'F{n}' for n in range(1, 13)})
+
+
+def pynput_key_to_code(key):
+    # Key code of a pynput Key or KeyCode, None for special keys without a layout label.
+    # Every character gets a code, but pynput reports the shifted character, so e.g. '!'
+    # gets a code of its own that the layout labels ('1') never produce.
+    char = getattr(key, 'char', None)
+    if char is not None:
+        return key_to_code(char)
+    name = getattr(key, 'name', None)
+    if name in PYNPUT_KEY_NAMES:
+        return NAMED_KEY_CODES[PYNPUT_KEY_NAMES[name]]
+    return None
@@ -1,42 +1,46 @@
+import json
+import os
+
 import cv2
 import numpy as np
 
-# Global variables to store mouse clicks
-ref_points = []
-calibration_complete = False
+# Saved calibrations of every camera setup, see save_calibration
+CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'calibrations.json')
 
-def click_event(event, x, y, flags, params):
-    global ref_points, calibration_complete
+def click_event(event, x, y, flags, state):
     if event == cv2.EVENT_LBUTTONDOWN:
-        if len(ref_points) < 4:
-            ref_points.append((x, y))
+        if len(state['points']) < 4:
+            state['points'].append((x, y))
             print(f"Point selected: ({x}, {y})")
-        if len(ref_points) == 4:
-            calibration_complete = True
 
 def calibrate_keyboard(cap):
-    global ref_points, calibration_complete
     # cap = cv2.VideoCapture(0)  # Use the default webcam
 
     # if not cap.isOpened():
     #     print("Failed to open camera.")
     #     return None
 
+    # Clicked points, filled by the mouse callback
+    state = {'points': []}
+    ref_points = state['points']
+
     cv2.namedWindow("Calibrate Keyboard")
-    cv2.setMouseCallback("Calibrate Keyboard", click_event)
+    cv2.setMouseCallback("Calibrate Keyboard", click_event, state)
 
     print("Please click on the four corners of the keyboard in the following order:")
     print("Top-Left, Top-Right, Bottom-Right, Bottom-Left")
     print("Press 'r' to reset the points if needed.")
 
+    raw_frame = None
+    display_frame = None
     while True:
-        ret, frame = cap.read()
+        ret, raw_frame = cap.read(raw_frame)
         if not ret:
             print("Failed to capture frame from camera.")
             break
 
-        frame = cv2.flip(frame, 1)
-        display_frame = frame.copy()
+        # Flip straight into the reused display buffer, the frame itself is only displayed
+        display_frame = cv2.flip(raw_frame, 1, dst=display_frame)
 
         # Draw the selected points
         for idx, point in enumerate(ref_points):
@@ -58,14 +62,12 @@ def calibrate_keyboard(cap):
 
         if key == ord('q'):
             print("Calibration aborted by user.")
-            ref_points = []
-            calibration_complete = False
+            ref_points.clear()
             break
         elif key == ord('r'):
             print("Resetting calibration points.")
-            ref_points = []
-            calibration_complete = False
-        elif calibration_complete:
+            ref_points.clear()
+        elif len(ref_points) == 4:
             print("Calibration complete.")
             break
 
@@ -80,7 +82,146 @@ def calibrate_keyboard(cap):
 
     return pts_src
 
+def order_corners(points):
+    # Sorts four points into top-left, top-right, bottom-right, bottom-left.
+    # Given more points, e.g. a convex hull, picks the outermost ones in these directions
+    points = np.asarray(points, dtype='float32').reshape(-1, 2)
+    sums = points.sum(axis=1)
+    diffs = points[:, 1] - points[:, 0]
+    return np.array([
+        points[np.argmin(sums)],   # Top-Left has the smallest x + y
+        points[np.argmin(diffs)],  # Top-Right has the smallest y - x
+        points[np.argmax(sums)],   # Bottom-Right has the largest x + y
+        points[np.argmax(diffs)],  # Bottom-Left has the largest y - x
+    ], dtype='float32')
+
+def sample_frames(cap, samples=5, flip=True):
+    # Reads `samples` frames, spread over the whole file for recordings and consecutive
+    # for live cameras. Frames are flipped like the pipeline does, so detected corners
+    # are in the same coordinates as clicked ones.
+    frames = []
+    frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    for i in range(samples):
+        if frame_count > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, int((i + 0.5) * frame_count / samples))
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(cv2.flip(frame, 1) if flip else frame)
+    if frame_count > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    return frames
+
+def read_reference_frame(cap, flip=True):
+    # The frame a calibration belongs to: the first one of a recording, the current one of
+    # a live camera. Recordings are rewound afterwards.
+    recording = cap.get(cv2.CAP_PROP_FRAME_COUNT) > 0
+    if recording:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    ret, frame = cap.read()
+    if recording:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    if not ret:
+        return None
+    return cv2.flip(frame, 1) if flip else frame
+
+def median_frame(frames):
+    # Pixel-wise median of the frames, moving hands vanish from it
+    if len(frames) == 1:
+        return frames[0]
+    return np.median(np.stack(frames), axis=0).astype(np.uint8)
+
+def detect_keyboard_corners(frames, min_area=0.05, min_aspect=1.8, max_aspect=7.0):
+    # Finds the keyboard as the largest wide quadrilateral in the frames. The pixel-wise
+    # median of the sampled frames removes hands moving over the keys, the edges of the
+    # keys are then closed into one blob whose convex hull gives the four corners.
+    # min_area is the smallest keyboard size as fraction of the frame, the aspect ratio
+    # limits reject monitors and desks. Returns the ordered corners or None.
+    if not frames:
+        return None
+    frame = median_frame(frames)
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    frame_h, frame_w = gray.shape
+
+    edges = cv2.Canny(cv2.GaussianBlur(gray, (5, 5), 0), 50, 150)
+    # Close the gaps between the keys so the whole keyboard becomes one contour
+    size = max(3, int(frame_w * 0.02)) | 1
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (size, size))
+    closed = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, kernel)
+    contours, _ = cv2.findContours(closed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    best = None
+    best_area = min_area * frame_w * frame_h
+    for contour in contours:
+        hull = cv2.convexHull(contour)
+        area = cv2.contourArea(hull)
+        if area < best_area:
+            continue
+        # The outermost hull points towards the four diagonals are the keyboard corners,
+        # also under perspective
+        corners = order_corners(hull)
+        # Mean width over mean height, so perspective doesn't skew it much
+        sides = np.linalg.norm(corners - np.roll(corners, -1, axis=0), axis=1)
+        width = (sides[0] + sides[2]) / 2
+        height = (sides[1] + sides[3]) / 2
+        if height == 0 or not min_aspect <= width / height <= max_aspect:
+            continue
+        best = corners
+        best_area = area
+    return best
+
+def detect_video_corners(video_path, samples=5):
+    # Automatic calibration of a recording, without any human step
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        return None
+    frames = sample_frames(cap, samples)
+    cap.release()
+    return detect_keyboard_corners(frames)
+
+def load_calibrations(path=CALIBRATION_FILE):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_calibration(setup, pts_src, frame_size, path=CALIBRATION_FILE):
+    # Stores the corners of a camera setup (e.g. "camera1"), frame_size is (width, height)
+    # of the frames they were calibrated on
+    calibrations = load_calibrations(path)
+    calibrations[setup] = {
+        'corners': [[float(x), float(y)] for x, y in pts_src],
+        'frame_size': [int(frame_size[0]), int(frame_size[1])],
+    }
+    # Replace the file in one step so a crash can't leave half a file behind
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(calibrations, f, indent=2)
+    os.replace(tmp_path, path)
+
+def load_calibration(setup, frame_size=None, path=CALIBRATION_FILE):
+    # Corners saved for the camera setup, scaled if the camera now delivers another
+    # resolution, or None if the setup was never calibrated
+    calibration = load_calibrations(path).get(setup)
+    if calibration is None:
+        return None
+    corners = np.array(calibration['corners'], dtype='float32')
+    if frame_size is not None and frame_size[0] > 0 and frame_size[1] > 0:
+        corners *= np.array(frame_size, dtype='float32') / np.array(calibration['frame_size'], dtype='float32')
+    return corners
+
+# Homographies by calibrated corners, a setup is only solved once
+_homographies = {}
+
 def get_homography_matrix(pts_src):
+    key = np.asarray(pts_src, dtype='float32').tobytes()
+    if key not in _homographies:
+        _homographies[key] = compute_homography_matrix(pts_src)
+    h_matrix, size = _homographies[key]
+    return h_matrix.copy(), size
+
+def compute_homography_matrix(pts_src):
     # Define the destination points for a standard keyboard size
     # For example, we can assume a keyboard size of 800x300 pixels
     width, height = 725, 300
@@ -95,7 +236,171 @@ def get_homography_matrix(pts_src):
     h_matrix, status = cv2.findHomography(pts_src, pts_dst)
     return h_matrix, (width, height)
 
-def warp_frame(frame, h_matrix, size):
-    # Warp the input frame to the top-down view
-    warped_frame = cv2.warpPerspective(frame, h_matrix, size)
+def warp_frame(frame, h_matrix, size, dst=None):
+    # Warp the input frame to the top-down view, into dst if given
+    warped_frame = cv2.warpPerspective(frame, h_matrix, size, dst=dst)
     return warped_frame
+
+def save_corners(pts_src, path):
+    # Store the four calibrated corners so a recording can be analyzed without clicking again
+    with open(path, 'w') as f:
+        json.dump([[float(x), float(y)] for x, y in pts_src], f)
+
+def load_corners(path):
+    with open(path, 'r') as f:
+        corners = json.load(f)
+    if len(corners) != 4:
+        print("Calibration file must contain exactly 4 points.")
+        return None
+    return np.array(corners, dtype='float32')
+
+def transform_points(points, h_matrix):
+    # Apply the homography to an (N, 2) array of points in one batched multiply,
+    # same result as cv2.perspectiveTransform without the per-call overhead
+    points = np.asarray(points, dtype='float64').reshape(-1, 2)
+    projected = points @ h_matrix[:, :2].T + h_matrix[:, 2]
+    return projected[:, :2] / projected[:, 2:3]
+
+def compute_roi(pts_src, frame_shape, margin=0.25, margin_above=0.75):
+    # Bounding box (x0, y0, x1, y1) of the calibrated keyboard in the frame, grown by
+    # margin (fraction of the keyboard size) on every side and by margin_above on top
+    # so hands hovering above the keys are still fully visible to the hand detector
+    frame_h, frame_w = frame_shape[:2]
+    x_min, y_min = pts_src.min(axis=0)
+    x_max, y_max = pts_src.max(axis=0)
+    kb_w = x_max - x_min
+    kb_h = y_max - y_min
+
+    x0 = int(max(x_min - margin * kb_w, 0))
+    x1 = int(min(x_max + margin * kb_w, frame_w))
+    y0 = int(max(y_min - (margin + margin_above) * kb_h, 0))
+    y1 = int(min(y_max + margin * kb_h, frame_h))
+    return x0, y0, x1, y1
+
+class HomographyTracker:
+    # Keeps the calibration valid when the laptop or camera moves during a session.
+    # ORB features of the keyboard in the calibration frame are matched against the
+    # current frame every `interval` frames, and a RANSAC homography between the two
+    # moves the calibrated corners to where the keyboard is now. Once the keyboard was
+    # seen moving it is checked every `fast_interval` frames until it settles again.
+    # Hands over the keys only cost matches, RANSAC rejects the few that land on them.
+    # A fit further than max_shift from the last position is only trusted once
+    # `confirmations` fits in a row agree on it, and after a check that didn't find the
+    # keyboard near its last position the next one searches the whole frame, so tracking
+    # recovers from large moves instead of keeping the old homography for good.
+
+    def __init__(self, reference, pts_src, interval=30, fast_interval=5, max_features=500,
+                 min_matches=20, min_inlier_ratio=0.4, min_shift=1.5, max_shift=0.25, ratio=0.75,
+                 confirmations=2):
+        self.interval = interval
+        self.fast_interval = fast_interval
+        self.min_matches = min_matches
+        self.min_inlier_ratio = min_inlier_ratio
+        # Corner movement in pixels below which the calibration is kept, so the
+        # homography doesn't jitter with every estimate
+        self.min_shift = min_shift
+        # Largest plausible movement between two checks as fraction of the keyboard size,
+        # also how far around the last position the keyboard is searched
+        self.max_shift = max_shift
+        self.ratio = ratio
+        self.confirmations = confirmations
+
+        self.orb = cv2.ORB_create(max_features)
+        self.matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+        self.reference_corners = np.asarray(pts_src, dtype='float32').reshape(4, 2)
+        self.corners = self.reference_corners.copy()
+
+        # Only features on the keyboard itself, the desk around it may change on its own
+        gray = cv2.cvtColor(reference, cv2.COLOR_BGR2GRAY) if reference.ndim == 3 else reference
+        mask = np.zeros(gray.shape, dtype=np.uint8)
+        cv2.fillConvexPoly(mask, self.reference_corners.astype(np.int32), 255)
+        keypoints, self.descriptors = self.orb.detectAndCompute(gray, mask)
+        self.reference_points = np.array([kp.pt for kp in keypoints], dtype='float32').reshape(-1, 2)
+        if self.descriptors is None or len(self.descriptors) < min_matches:
+            print("Too few keyboard features for tracking, keeping the calibration fixed.")
+            self.descriptors = None
+
+        self.next_check = 0
+        self.checks = 0
+        self.updates = 0
+        # Position of a large move seen by `candidate_count` fits in a row, not trusted yet
+        self.candidate = None
+        self.candidate_count = 0
+        # The last check didn't find the keyboard near its last position
+        self.lost = False
+
+    def update(self, frame, index):
+        # Called with every frame and its index, returns the new corners if the keyboard
+        # moved since the last update and None otherwise
+        if self.descriptors is None or index < self.next_check:
+            return None
+        self.checks += 1
+        was_lost = self.lost
+        corners = self.estimate(frame, full_frame=self.lost or self.candidate is not None)
+        self.lost = corners is None
+        if corners is None:
+            # Look once more soon, then back off: hands covering the keys also end up here
+            self.candidate = None
+            self.next_check = index + (self.interval if was_lost else self.fast_interval)
+            return None
+
+        shift = np.abs(corners - self.corners).max()
+        if shift < self.min_shift:
+            self.candidate = None
+            self.next_check = index + self.interval
+            return None
+
+        if shift > self.max_shift * self.size(self.corners) and not self.confirm(corners):
+            # Check again soon whether the keyboard is really there now
+            self.next_check = index + self.fast_interval
+            return None
+
+        self.candidate = None
+        self.corners = corners
+        self.updates += 1
+        self.next_check = index + self.fast_interval
+        return corners
+
+    def confirm(self, corners):
+        # Counts the fits in a row that agree on a large move, True once there are enough
+        if self.candidate is not None and np.abs(corners - self.candidate).max() <= self.max_shift * self.size(self.candidate):
+            self.candidate_count += 1
+        else:
+            self.candidate_count = 1
+        self.candidate = corners
+        return self.candidate_count >= self.confirmations
+
+    @staticmethod
+    def size(corners):
+        return np.ptp(corners, axis=0).max()
+
+    def estimate(self, frame, full_frame=False):
+        # Corners of the keyboard in the frame, or None if it can't be found reliably,
+        # e.g. while hands cover most of it. Searches around the last known position
+        # unless full_frame is set.
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        if full_frame:
+            x0, y0, x1, y1 = 0, 0, gray.shape[1], gray.shape[0]
+        else:
+            x0, y0, x1, y1 = compute_roi(self.corners, gray.shape, margin=self.max_shift, margin_above=0)
+        keypoints, descriptors = self.orb.detectAndCompute(gray[y0:y1, x0:x1], None)
+        if descriptors is None or len(descriptors) < 2:
+            return None
+
+        # Ratio test, drops the ambiguous matches between look-alike keys
+        pairs = self.matcher.knnMatch(self.descriptors, descriptors, k=2)
+        good = [p[0] for p in pairs if len(p) == 2 and p[0].distance < self.ratio * p[1].distance]
+        if len(good) < self.min_matches:
+            return None
+        src = self.reference_points[[m.queryIdx for m in good]]
+        dst = np.array([keypoints[m.trainIdx].pt for m in good], dtype='float32') + (x0, y0)
+
+        h_matrix, inliers = cv2.findHomography(src, dst, cv2.RANSAC, 3.0)
+        if h_matrix is None or inliers.sum() < max(self.min_matches, self.min_inlier_ratio * len(good)):
+            return None
+        corners = transform_points(self.reference_corners, h_matrix).astype('float32')
+
+        # A keyboard doesn't fold, such fits come from mismatched features
+        if not cv2.isContourConvex(corners):
+            return None
+        return corners
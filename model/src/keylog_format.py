@@ -0,0 +1,351 @@
+import argparse
+import csv
+import mmap
+import os
+import sys
+import threading
+import time
+import warnings
+from io import StringIO
+
+import numpy as np
+
+from key_codes import key_to_code, code_to_key, NAMED_KEY_CODES, PYNPUT_KEY_NAMES
+
+# Binary keystroke log: a 16 byte header followed by fixed width little endian records.
+#   header: magic, format version, record size, origin_ns
+#   origin_ns is the wall clock time in ns at monotonic time 0 of the recording machine,
+#   so timestamp_ns + origin_ns is the wall clock time of an event
+MAGIC = b'KLOG'
+VERSION = 2
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S4'),
+    ('version', '<u2'),
+    ('record_size', '<u2'),
+    ('origin_ns', '<i8'),
+])
+RECORD_DTYPE = np.dtype([
+    ('timestamp_ns', '<i8'),  # time.monotonic_ns() of the event
+    ('duration_ns', '<i8'),   # how long the key was held, 0 for key down events
+    ('keycode', '<i4'),       # canonical key code (key_codes.py), -1 if the key isn't on the layout
+    ('vk', '<u4'),            # virtual key code reported by the OS, 0 if unknown (X11 keysyms exceed 16 bits)
+    ('event', 'u1'),          # KEY_DOWN or KEY_UP
+    ('reserved', 'u1'),
+], align=True)  # padded to 32 bytes so the timestamps of a memory map stay aligned
+# Version 1 logs stored vk in 16 bits, they are still readable
+RECORD_DTYPES = {
+    1: np.dtype([('timestamp_ns', '<i8'), ('duration_ns', '<i8'), ('keycode', '<i4'),
+                 ('vk', '<u2'), ('event', 'u1'), ('reserved', 'u1')]),
+    VERSION: RECORD_DTYPE,
+}
+MAX_VK = np.iinfo(RECORD_DTYPE['vk']).max
+HEADER_SIZE = HEADER_DTYPE.itemsize
+
+# Key presses as returned by KeylogReader, timestamps in seconds
+PRESS_DTYPE = np.dtype([('timestamp', np.float64), ('keycode', np.int32)])
+
+# Rows of a csv log with an event-type column
+CSV_EVENT_DTYPE = np.dtype([('timestamp', np.float64), ('keycode', np.int32), ('event', 'U16')])
+
+# KeylogReader keeps the timestamp of every INDEX_STRIDE-th record or line
+INDEX_STRIDE = 1024
+# csv logs are scanned for line breaks in blocks of this many bytes
+SCAN_BLOCK = 1 << 22
+
+KEY_DOWN = 1
+KEY_UP = 2
+EVENT_NAMES = {KEY_DOWN: 'key down', KEY_UP: 'key up'}
+
+# fsync policies of KeylogWriter
+FSYNC_NEVER = 'never'    # leave it to the OS, fastest
+FSYNC_FLUSH = 'flush'    # after every group write, survives a power loss up to the last flush
+FSYNC_CLOSE = 'close'    # once when the log is closed
+FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_FLUSH, FSYNC_CLOSE)
+
+
+class KeylogWriter:
+    # Appends records to a binary keystroke log. Events are collected in a preallocated
+    # record buffer and written in groups, when it is full or at the latest flush_interval
+    # seconds after they were written, so logging costs one syscall per group instead of
+    # per event. A background thread does the timed flushes, so an idle logger doesn't keep
+    # events in memory; flush_interval=None only flushes full buffers and on close.
+    def __init__(self, path, fsync=FSYNC_CLOSE, buffer_size=256, flush_interval=1.0, origin_ns=None):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync policy must be one of {FSYNC_POLICIES}")
+        self.fsync = fsync
+        self.flush_interval = flush_interval
+        self.records = np.zeros(buffer_size, dtype=RECORD_DTYPE)
+        self.count = 0
+        # write() is called from the key listener thread, flushes also from the flusher
+        self.lock = threading.Lock()
+
+        if origin_ns is None:
+            origin_ns = time.time_ns() - time.monotonic_ns()
+        header = np.array([(MAGIC, VERSION, RECORD_DTYPE.itemsize, origin_ns)], dtype=HEADER_DTYPE)
+        self.file = open(path, 'wb')
+        self.file.write(header.tobytes())
+        self.file.flush()
+
+        self.closed = threading.Event()
+        self.flusher = None
+        if flush_interval is not None:
+            self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self.flusher.start()
+
+    def _flush_loop(self):
+        while not self.closed.wait(self.flush_interval):
+            self.flush(timed=True)
+
+    def write(self, timestamp_ns, keycode, vk=0, event=KEY_DOWN, duration_ns=0):
+        # Virtual key codes that don't fit the record are stored as unknown
+        vk = vk or 0
+        if not 0 <= vk <= MAX_VK:
+            vk = 0
+        with self.lock:
+            self.records[self.count] = (timestamp_ns, duration_ns, -1 if keycode is None else keycode,
+                                        vk, event, 0)
+            self.count += 1
+            if self.count == len(self.records):
+                self._flush()
+
+    def write_records(self, records):
+        # Writes an array of RECORD_DTYPE records at once
+        with self.lock:
+            self._flush()
+            self.file.write(np.ascontiguousarray(records, dtype=RECORD_DTYPE).tobytes())
+
+    def flush(self, timed=False):
+        with self.lock:
+            # The timed flush has nothing to do if nothing was written since the last one
+            if timed and not self.count:
+                return
+            self._flush()
+
+    def _flush(self):
+        if self.count:
+            self.file.write(self.records[:self.count].tobytes())
+            self.count = 0
+        self.file.flush()
+        if self.fsync == FSYNC_FLUSH:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.closed.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        self.flush()
+        if self.fsync == FSYNC_CLOSE:
+            os.fsync(self.file.fileno())
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def is_keylog(data):
+    return bytes(data[:len(MAGIC)]) == MAGIC
+
+
+def parse_keylog(data):
+    # Returns (origin_ns, records) of a binary log given as bytes-like object (bytes, mmap, ...).
+    # The records are a zero-copy view into data. A record cut off by a crash is ignored.
+    header = np.frombuffer(data, dtype=HEADER_DTYPE, count=1)[0]
+    if header['magic'] != MAGIC:
+        raise ValueError("not a binary keystroke log")
+    record_dtype = RECORD_DTYPES.get(int(header['version']))
+    if record_dtype is None or header['record_size'] != record_dtype.itemsize:
+        raise ValueError(f"unsupported keystroke log version {header['version']}")
+    count = (len(data) - HEADER_SIZE) // record_dtype.itemsize
+    records = np.frombuffer(data, dtype=record_dtype, count=count, offset=HEADER_SIZE)
+    return int(header['origin_ns']), records
+
+
+def read_keylog(path):
+    with open(path, 'rb') as f:
+        return parse_keylog(f.read())
+
+
+class KeylogReader:
+    # Random access to the key presses of a stored keystroke log, binary or csv
+    # (with timestamp and keycode columns). The log is read in place from a bytes-like
+    # object such as a memory map; a sparse index of every stride-th timestamp finds
+    # the records of a time range, so only the blocks around it are touched or parsed.
+    # Records have to be in time order, which both loggers guarantee.
+    def __init__(self, data, stride=INDEX_STRIDE):
+        self.data = data
+        self.stride = stride
+        if is_keylog(data):
+            self.init_binary()
+        else:
+            self.init_csv()
+
+    @classmethod
+    def open(cls, path, stride=INDEX_STRIDE):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls(b'', stride)
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), stride)
+
+    def init_binary(self):
+        _, self.records = parse_keylog(self.data)
+        self.index = self.records['timestamp_ns'][::self.stride] / 1e9
+        self.read_block = self.read_binary_block
+
+    def init_csv(self):
+        header_end = self.find_line_end(0)
+        fieldnames = next(csv.reader([bytes(self.data[:header_end]).decode('utf-8')]))
+        if 'timestamp' not in fieldnames or 'keycode' not in fieldnames:
+            raise ValueError("csv log needs timestamp and keycode columns")
+        self.columns = (fieldnames.index('timestamp'), fieldnames.index('keycode'))
+        self.time_column = self.columns[0]
+        # Exported logs also hold the key up events, they are filtered out like in binary logs
+        if 'event-type' in fieldnames:
+            self.columns += (fieldnames.index('event-type'),)
+
+        # Byte offset of every stride-th line, found by scanning for line breaks without decoding
+        starts = []
+        line = 0
+        for block_start in range(header_end + 1, len(self.data), SCAN_BLOCK):
+            block = np.frombuffer(self.data, dtype=np.uint8, offset=block_start,
+                                  count=min(SCAN_BLOCK, len(self.data) - block_start))
+            # Lines starting in this block: the first one and every one after a line break
+            line_starts = np.flatnonzero(block[:-1] == 10) + 1 + block_start
+            if block_start == header_end + 1:
+                line_starts = np.concatenate([[block_start], line_starts])
+            elif self.data[block_start - 1] == 10:
+                line_starts = np.concatenate([[block_start], line_starts])
+            picked = (line + np.arange(len(line_starts))) % self.stride == 0
+            starts.extend(line_starts[picked].tolist())
+            line += len(line_starts)
+        # A trailing line break doesn't start a line
+        if starts and starts[-1] >= len(self.data):
+            starts.pop()
+        self.offsets = np.array(starts + [len(self.data)], dtype=np.int64)
+        self.index = np.array([self.line_timestamp(start) for start in starts], dtype=np.float64)
+        self.read_block = self.read_csv_block
+
+    def find_line_end(self, start):
+        end = self.data.find(b'\n', start)
+        return len(self.data) if end < 0 else end
+
+    def line_timestamp(self, start):
+        line = bytes(self.data[start:self.find_line_end(start)]).decode('utf-8')
+        return float(next(csv.reader([line]))[self.time_column])
+
+    def read_binary_block(self, first, last):
+        records = self.records[first * self.stride:last * self.stride]
+        presses = records[(records['event'] == KEY_DOWN) & (records['keycode'] >= 0)]
+        keystrokes = np.empty(len(presses), dtype=PRESS_DTYPE)
+        keystrokes['timestamp'] = presses['timestamp_ns'] / 1e9
+        keystrokes['keycode'] = presses['keycode']
+        return keystrokes
+
+    def read_csv_block(self, first, last):
+        text = bytes(self.data[self.offsets[first]:self.offsets[last]]).decode('utf-8')
+        dtype = PRESS_DTYPE if len(self.columns) == 2 else CSV_EVENT_DTYPE
+        with warnings.catch_warnings():
+            # A block without keystrokes is valid, loadtxt warns about it
+            warnings.simplefilter("ignore", UserWarning)
+            rows = np.loadtxt(StringIO(text), dtype=dtype, delimiter=",", quotechar='"',
+                              usecols=self.columns, ndmin=1)
+        keep = rows['keycode'] >= 0
+        if dtype is CSV_EVENT_DTYPE:
+            keep &= rows['event'] != EVENT_NAMES[KEY_UP]
+        keystrokes = np.empty(np.count_nonzero(keep), dtype=PRESS_DTYPE)
+        keystrokes['timestamp'] = rows['timestamp'][keep]
+        keystrokes['keycode'] = rows['keycode'][keep]
+        return keystrokes
+
+    def presses(self, start=-np.inf, end=np.inf):
+        # Key presses with start <= timestamp < end as PRESS_DTYPE array
+        # Only the index blocks overlapping the range are read
+        # The block before the first index entry >= start may end with records at start
+        first = max(0, int(np.searchsorted(self.index, start, 'left')) - 1)
+        last = int(np.searchsorted(self.index, end, 'left'))
+        if last <= first:
+            return np.empty(0, dtype=PRESS_DTYPE)
+        keystrokes = self.read_block(first, last)
+        times = keystrokes['timestamp']
+        return keystrokes[(times >= start) & (times < end)]
+
+
+def export_csv(path, csv_path):
+    # Writes a binary log as csv with wall clock timestamps in seconds
+    origin_ns, records = read_keylog(path)
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['timestamp', 'keycode', 'key', 'key-vk', 'event-type', 'duration'])
+        for record in records:
+            keycode = int(record['keycode'])
+            writer.writerow([
+                (int(record['timestamp_ns']) + origin_ns) / 1e9,
+                keycode,
+                code_to_key(keycode) if keycode >= 0 else '',
+                int(record['vk']) or '',
+                EVENT_NAMES.get(int(record['event']), ''),
+                int(record['duration_ns']) / 1e9 if record['event'] == KEY_UP else '',
+            ])
+
+
+def import_csv(csv_path, path, fsync=FSYNC_CLOSE):
+    # Converts a csv log to the binary format. Understands the export of this module,
+    # the csv logs of key_logger.py (key-name / key-char or key-value columns) and plain
+    # timestamp,keycode logs.
+    # Timestamps are wall clock seconds, so they are stored with origin 0.
+    records = []
+    with open(csv_path, newline='') as f:
+        for row in csv.DictReader(f):
+            timestamp_ns = round(float(row['timestamp']) * 1e9)
+            if row.get('keycode'):
+                keycode = int(row['keycode'])
+            else:
+                keycode = csv_key_to_code(row)
+            event = KEY_UP if row.get('event-type') == 'key up' else KEY_DOWN
+            duration = row.get('duration')
+            duration_ns = round(float(duration) * 1e9) if duration else 0
+            vk = int(row['key-vk']) if row.get('key-vk') else 0
+            if not 0 <= vk <= MAX_VK:
+                vk = 0
+            records.append((timestamp_ns, duration_ns, -1 if keycode is None else keycode, vk, event, 0))
+
+    with KeylogWriter(path, fsync=fsync, flush_interval=None, origin_ns=0) as writer:
+        writer.write_records(np.array(records, dtype=RECORD_DTYPE))
+
+
+def csv_key_to_code(row):
+    # Key code of a key as logged by the csv key_logger.py, either split into key-char and
+    # key-name or as one key-value column holding the character or 'Key.<name>'
+    char = row.get('key-char')
+    name = row.get('key-name')
+    value = row.get('key-value')
+    if value:
+        if value.startswith('Key.'):
+            name = value[len('Key.'):]
+        else:
+            char = value
+    if char:
+        return key_to_code(char)
+    if name in PYNPUT_KEY_NAMES:
+        return NAMED_KEY_CODES[PYNPUT_KEY_NAMES[name]]
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert keystroke logs between the binary and the csv format.")
+    parser.add_argument('command', choices=['export', 'import'], help="export: binary to csv, import: csv to binary")
+    parser.add_argument('source')
+    parser.add_argument('destination')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_csv(args.source, args.destination)
+    else:
+        import_csv(args.source, args.destination)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,23 @@
 import cv2
 import mediapipe as mp
 import numpy as np
-import time
 
-from keyboard_tracking import calibrate_keyboard, get_homography_matrix, warp_frame
-from finger_key_mapping import create_keyboard_layout, map_fingertip_to_key, draw_keyboard_layout
-
-def main(on_press=None):
+from keyboard_tracking import (calibrate_keyboard, get_homography_matrix, warp_frame, save_corners, compute_roi,
+                               sample_frames, detect_keyboard_corners, load_calibration, save_calibration,
+                               read_reference_frame, HomographyTracker, CALIBRATION_FILE)
+from finger_key_mapping import create_keyboard_layout, KeyboardOverlay, DEFAULT_LAYOUT
+from press_detection import PressDetector
+from pipeline import Pipeline, DROP_OLDEST
+
+def main(on_press=None, show=True, queue_size=2, drop_policy=DROP_OLDEST, corners_path=None,
+         use_roi=True, inference_width=None, setup=None, auto_calibrate=False,
+         calibration_path=CALIBRATION_FILE, track=True, layout=DEFAULT_LAYOUT):
+    # on_press(key, timestamp) is called for every detected key press with the capture time
+    # of its frame: time.monotonic() for live cameras, seconds into the file for recordings
+    # setup names the camera setup, its calibration is saved and reused on the next start.
+    # auto_calibrate detects the keyboard corners instead of asking for four clicks.
+    # track follows the keyboard if the laptop or camera moves after calibration.
+    # layout names the keyboard layout file in model/layouts, e.g. 'iso_de' or 'ansi_us'.
     # Start capturing video input
     # live webcam feed
     #   0 => default webcam
@@ -15,17 +26,44 @@ def main(on_press=None):
     # recorded video feed
     # cap = cv2.VideoCapture('data/key_log_typing_1.mp4')
 
+    frame_size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+    # Reuse the calibration of this camera setup if there is one
+    pts_src = None
+    if setup is not None:
+        pts_src = load_calibration(setup, frame_size, calibration_path)
+
+    if pts_src is None and auto_calibrate:
+        pts_src = detect_keyboard_corners(sample_frames(cap))
+        if pts_src is None:
+            print("No keyboard found, please calibrate manually.")
+
     # Calibrate the keyboard
-    pts_src = calibrate_keyboard(cap)
     if pts_src is None:
-        print("Keyboard calibration failed.")
-        return
+        pts_src = calibrate_keyboard(cap)
+        if pts_src is None:
+            print("Keyboard calibration failed.")
+            return
+        if setup is not None:
+            save_calibration(setup, pts_src, frame_size, calibration_path)
+
+    # Keep the corners so recordings of this setup can be analyzed headless
+    if corners_path:
+        save_corners(pts_src, corners_path)
+
+    # Features of the calibrated keyboard to find it again if it moves. A median over the
+    # recording would blur exactly the moves the tracker is for, so one frame is the reference.
+    tracker = None
+    if track:
+        reference = read_reference_frame(cap)
+        if reference is not None:
+            tracker = HomographyTracker(reference, pts_src)
 
     # Compute the homography matrix
     h_matrix, (width, height) = get_homography_matrix(pts_src)
 
     # Create the keyboard layout
-    keyboard_layout = create_keyboard_layout(width, height)
+    keyboard_layout = create_keyboard_layout(width, height, layout)
 
     # Initialize MediaPipe Hands
     mp_hands = mp.solutions.hands
@@ -35,148 +73,71 @@ def main(on_press=None):
         min_detection_confidence=0.5,
         min_tracking_confidence=0.5
     )
-    mp_drawing = mp.solutions.drawing_utils
-
-    # Initialize fingertip history for press detection
-    fingertips = [4, 8, 12, 16, 20]
-    fingertip_history = {idx: [] for idx in fingertips}
-    press_detected = {idx: False for idx in fingertips}
-    threshold = 14  # Adjust based on testing
-
-    # Initialize keystroke management
-    max_simultaneous_keystrokes = 1
-    current_keystrokes = 0  # Counter for current keystrokes displayed
-
-    # Initialize keystroke rate limiter
-    keystroke_timestamps = []
-    max_keystrokes_per_window = 2  # Maximum keystrokes allowed in the time window
-    time_window = 1.0  # Time window in seconds
-    suppress_keystrokes = False
-    cooldown_start_time = None
-    cooldown_duration = 3.0  # Duration to suppress keystrokes after overload
-
-    while cap.isOpened():
-        success, frame = cap.read()
-        if not success:
-            print("Unable to read from webcam. Exiting...")
-            break
-
-        frame = cv2.flip(frame, 1)
-
-        # Get the current time
-        current_time = time.time()
-
-        # Remove old timestamps outside the time window
-        keystroke_timestamps = [t for t in keystroke_timestamps if current_time - t <= time_window]
-
-        # Check if the number of keystrokes exceeds the maximum allowed
-        if len(keystroke_timestamps) > max_keystrokes_per_window:
-            if not suppress_keystrokes:
-                suppress_keystrokes = True
-                cooldown_start_time = current_time
-                print("Keystroke overload detected. Suppressing outputs.")
-        
-        # Handle cooldown period
-        if suppress_keystrokes:
-            if current_time - cooldown_start_time >= cooldown_duration:
-                suppress_keystrokes = False
-                keystroke_timestamps.clear()
-                print("Resuming keystroke outputs.")
-
-        # Convert the BGR image to RGB
-        image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        image.flags.writeable = False
-
-        # Process the image and detect hands
-        results = hands.process(image)
-
-        # Prepare for drawing
-        image.flags.writeable = True
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-
-        # Transform the image to top-down view
-        warped_frame = warp_frame(frame, h_matrix, (width, height))
-
-        # Draw the keyboard layout on the warped frame
-        draw_keyboard_layout(warped_frame, keyboard_layout)
-
-        if results.multi_hand_landmarks:
-            for hand_landmarks in results.multi_hand_landmarks:
-                # Draw landmarks on the original frame
-                mp_drawing.draw_landmarks(
-                    image, hand_landmarks, mp_hands.HAND_CONNECTIONS)
-
-                # Extract fingertip coordinates
-                h_orig, w_orig, _ = image.shape
-                for idx in fingertips:
-                    landmark = hand_landmarks.landmark[idx]
-                    x, y = int(landmark.x * w_orig), int(landmark.y * h_orig)
-
-                    # Transform the fingertip coordinate to the keyboard coordinate system
-                    point = np.array([[[x, y]]], dtype='float32')
-                    transformed_point = cv2.perspectiveTransform(point, h_matrix)
-
-                    tx, ty = transformed_point[0][0]
-                    tx = int(tx)
-                    ty = int(ty)
-
-                    # Apply vertical offset correction
-                    vertical_offset = -150  # Adjust based on testing
-                    ty_corrected = ty + vertical_offset
-
-                    # Ensure transformed points are within bounds
-                    if not (0 <= tx < width and 0 <= ty_corrected < height):
-                        continue
-
-                    # Update fingertip history with corrected ty
-                    if len(fingertip_history[idx]) >= 5:
-                        fingertip_history[idx].pop(0)
-                    fingertip_history[idx].append(ty_corrected)
-
-                    # Compute velocity for press detection
-                    if len(fingertip_history[idx]) == 5:
-                        y_values = fingertip_history[idx]
-                        velocity = y_values[-1] - y_values[0]
-
-                        # Detect downward motion for key press
-                        if velocity > threshold and not press_detected[idx]:
-                            if current_keystrokes < max_simultaneous_keystrokes:
-                                key = map_fingertip_to_key(tx, ty, keyboard_layout)
-                                if key:
-                                    print(f"Key Press Detected: {key}")
-                                    cv2.putText(warped_frame, f"Pressed: {key}", (tx, ty - 30),
-                                                cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 255), 2)
-                                    current_keystrokes += 1  # Increment counter
-                                    if on_press:
-                                        on_press(key)
-                                press_detected[idx] = True
-                        elif velocity < -threshold / 2 and press_detected[idx]:
-                            # Reset press_detected when finger moves up
-                            press_detected[idx] = False
-                            if current_keystrokes > 0:
-                                current_keystrokes -= 1  # Decrement counter
-
-                    # Draw the fingertip on the warped frame
-                    cv2.circle(warped_frame, (tx, ty), 5, (0, 0, 255), -1)
-        else:
-            # No hands detected; reset counters and states
-            fingertip_history = {idx: [] for idx in fingertips}
-            press_detected = {idx: False for idx in fingertips}
-            keystroke_timestamps.clear()
+
+    # Initialize the fingertip press detector
+    detector = PressDetector(h_matrix, (width, height), keyboard_layout)
+
+    # Render the keyboard layout once, it never changes after calibration
+    keyboard_overlay = KeyboardOverlay(keyboard_layout, (width, height))
+
+    # Reused for every rendered frame
+    warped_frame = np.empty((height, width, 3), dtype=np.uint8)
+
+    def render(packet):
+        frame = packet['frame']
+
+        # Transform the image to top-down view, with the homography the presses were detected with
+        warp_frame(frame, packet['h_matrix'], (width, height), dst=warped_frame)
+
+        # Draw the keyboard layout on the warped frame, highlighting the keys pressed in this frame
+        keyboard_overlay.set_pressed_keys(key for key, _, _ in packet['presses'])
+        keyboard_overlay.draw(warped_frame)
+
+        # Draw landmarks on the original frame, from the full-frame coordinates
+        # because the MediaPipe results are relative to the inference region
+        for hand in packet['landmarks'].astype(int).tolist():
+            for start, end in mp_hands.HAND_CONNECTIONS:
+                cv2.line(frame, hand[start], hand[end], (224, 224, 224), 2)
+            for point in hand:
+                cv2.circle(frame, point, 2, (0, 0, 255), -1)
+        if packet['roi'] is not None:
+            cv2.rectangle(frame, packet['roi'][:2], packet['roi'][2:], (255, 0, 0), 1)
+
+        for key, tx, ty in packet['presses']:
+            cv2.putText(warped_frame, f"Pressed: {key}", (tx, ty - 30),
+                        cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 255), 2)
+
+        # Draw the fingertips on the warped frame
+        for tx, ty in packet['points']:
+            cv2.circle(warped_frame, (tx, ty), 5, (0, 0, 255), -1)
 
         # Display the original frame and the warped frame
-        cv2.imshow('Original Frame', image)
+        cv2.imshow('Original Frame', frame)
         cv2.imshow('Warped Keyboard View', warped_frame)
 
-
         # Exit on pressing 'q'
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
-
-    # Release resources
-    cap.release()
-    cv2.destroyAllWindows()
-    hands.close()
+        return cv2.waitKey(1) & 0xFF != ord('q')
+
+    # Only run the hand detector on the keyboard region, hands outside of it can't type
+    roi = None
+    if use_roi:
+        roi = compute_roi(pts_src, (cap.get(cv2.CAP_PROP_FRAME_HEIGHT), cap.get(cv2.CAP_PROP_FRAME_WIDTH)))
+
+    # Run capture, inference, press detection and rendering as concurrent stages
+    pipeline = Pipeline(cap, hands, detector, on_press=on_press,
+                        render=render if show else None,
+                        queue_size=queue_size, drop_policy=drop_policy,
+                        roi=roi, inference_width=inference_width, tracker=tracker)
+    try:
+        stats = pipeline.run()
+    finally:
+        # Release resources
+        cap.release()
+        cv2.destroyAllWindows()
+        hands.close()
+    print(f"Processed {stats['frames_processed']}/{stats['frames_captured']} frames, "
+          f"dropped {stats['frames_dropped']}, avg latency {stats['avg_latency'] * 1000:.1f} ms, "
+          f"homography updates {stats['homography_updates']}")
 
 if __name__ == "__main__":
     main()
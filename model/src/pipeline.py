@@ -0,0 +1,345 @@
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from press_detection import landmarks_to_array, handedness_to_list
+from keyboard_tracking import compute_homography_matrix, compute_roi
+
+# Frame drop policies for a full queue:
+#   DROP_OLDEST => discard the oldest queued frame, keeps latency flat (live camera)
+#   DROP_NEWEST => discard the incoming frame, keeps the queued backlog
+#   BLOCK       => wait for the consumer, never drops (recorded video)
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
+
+
+def get_buffer(slot, name, shape, dtype=np.uint8):
+    # Returns the buffer `name` of the slot, only allocating it if it doesn't exist yet
+    # or the frame size changed
+    buffer = slot.get(name)
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+        buffer = slot[name] = np.empty(shape, dtype=dtype)
+        slot['allocations'] = slot.get('allocations', 0) + 1
+    return buffer
+
+
+class BufferPool:
+    # Recycles the frame buffers travelling through the pipeline so the hot loop
+    # reads, flips and converts into preallocated arrays instead of new ones.
+    # A slot is a dict of named buffers, see get_buffer().
+
+    def __init__(self, size):
+        self.free = queue.Queue()
+        for _ in range(size):
+            self.free.put({})
+
+    def acquire(self):
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            # Every slot is in flight, grow the pool
+            return {}
+
+    def release(self, slot):
+        self.free.put(slot)
+
+
+class FrameQueue:
+    # Bounded queue between two pipeline stages with a frame drop policy
+
+    def __init__(self, maxsize=2, policy=DROP_OLDEST, on_drop=None):
+        if policy not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            raise ValueError(f"Unknown drop policy: {policy}")
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.policy = policy
+        self.dropped = 0
+        # Called with every dropped item, e.g. to recycle its buffers
+        self.on_drop = on_drop
+
+    def _drop(self, item):
+        self.dropped += 1
+        if self.on_drop:
+            self.on_drop(item)
+
+    def put(self, item, stop_event=None):
+        # Returns False if a frame had to be dropped
+        if self.policy == BLOCK:
+            while stop_event is None or not stop_event.is_set():
+                try:
+                    self.queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            self._drop(item)
+            return False
+
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+
+        if self.policy == DROP_NEWEST:
+            self._drop(item)
+            return False
+
+        while True:
+            try:
+                self._drop(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(item)
+                return False
+            except queue.Full:
+                continue
+
+    def get(self, timeout=0.1):
+        # Returns None if nothing arrived within the timeout
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Pipeline:
+    # capture thread -> inference worker -> press detection -> optional render (calling thread)
+    #
+    # Every stage runs concurrently so the frame rate is bounded by the slowest stage
+    # instead of the sum of all of them. Frames travel between the stages as dicts.
+    # Their image buffers come from a BufferPool and are recycled once the last stage
+    # is done with the packet, so callbacks must not keep packet['frame'] around.
+
+    def __init__(self, cap, hands, detector, on_press=None, render=None,
+                 queue_size=2, drop_policy=DROP_OLDEST, on_frame=None, verbose=True,
+                 roi=None, inference_width=None, live=None, end_time=None, tracker=None):
+        self.cap = cap
+        # Stop capturing at the first frame stamped at or after end_time
+        self.end_time = end_time
+        # Live cameras stamp frames with the monotonic clock at capture, recordings with
+        # their position in the file. None decides from the frame count of the source.
+        if live is None:
+            live = cap.get(cv2.CAP_PROP_FRAME_COUNT) <= 0
+        self.live = live
+        self.hands = hands
+        self.detector = detector
+        # (x0, y0, x1, y1) region of the frame the hand detector runs on, None for the full frame
+        self.roi = roi
+        # HomographyTracker that follows the keyboard when the camera moves, None keeps
+        # the calibration fixed
+        self.tracker = tracker
+        # Downscale the inference image to at most this width, None to keep the resolution
+        self.inference_width = inference_width
+        self.on_press = on_press
+        self.render = render
+        # Called with every packet once press detection is done
+        self.on_frame = on_frame
+        self.verbose = verbose
+
+        self.stop_event = threading.Event()
+        self.capture_queue = FrameQueue(queue_size, drop_policy, self._release)
+        self.inference_queue = FrameQueue(queue_size, drop_policy, self._release)
+        # Rendering is only a debug view and must never hold up detection
+        self.render_queue = FrameQueue(1, DROP_OLDEST, self._release) if render else None
+
+        # Enough slots for every queue to be full while every stage holds a frame
+        self.buffers = BufferPool(2 * queue_size + 5)
+        # Inference scratch buffers, only ever touched by the inference thread
+        self.inference_slot = {}
+
+        self.frames_captured = 0
+        self.frames_processed = 0
+        self.total_latency = 0.0
+
+        self.capture_done = threading.Event()
+        self.inference_done = threading.Event()
+        # First exception raised by a stage, run() re-raises it once all stages stopped
+        self.error = None
+        self.threads = [
+            threading.Thread(target=self._run_stage, args=(self._capture_stage, self.capture_done), daemon=True),
+            threading.Thread(target=self._run_stage, args=(self._inference_stage, self.inference_done), daemon=True),
+            threading.Thread(target=self._run_stage, args=(self._detection_stage, self.stop_event), daemon=True),
+        ]
+
+    def _release(self, packet):
+        self.buffers.release(packet['slot'])
+
+    def _run_stage(self, stage, done):
+        # A failing stage (detector, on_press / on_frame callbacks, ...) stops the whole
+        # pipeline, otherwise the other stages and run() would wait for it forever
+        try:
+            stage()
+        except BaseException as e:
+            if self.error is None:
+                self.error = e
+            self.stop_event.set()
+        finally:
+            done.set()
+
+    def _capture_stage(self):
+        index = 0
+        while not self.stop_event.is_set() and self.cap.isOpened():
+            slot = self.buffers.acquire()
+            # Decode into the slot's raw buffer, backends that can't reuse it hand back a new one
+            success, raw = self.cap.read(slot.get('raw'))
+            capture_time = time.monotonic()
+            if not success:
+                self.buffers.release(slot)
+                if self.verbose:
+                    print("Unable to read from webcam. Exiting...")
+                break
+            slot['raw'] = raw
+
+            # When the frame was taken, everything detected in it carries this time
+            timestamp = capture_time if self.live else self.cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+            if self.end_time is not None and timestamp >= self.end_time:
+                self.buffers.release(slot)
+                break
+
+            frame = get_buffer(slot, 'frame', raw.shape)
+            cv2.flip(raw, 1, dst=frame)
+            self.capture_queue.put({
+                'index': index,
+                'slot': slot,
+                'frame': frame,
+                'timestamp': timestamp,
+                'capture_time': capture_time,
+            }, self.stop_event)
+            index += 1
+            self.frames_captured = index
+
+    def _inference_stage(self):
+        while not self.stop_event.is_set():
+            packet = self.capture_queue.get()
+            if packet is None:
+                if self.capture_done.is_set() and self.capture_queue.queue.empty():
+                    break
+                continue
+
+            # Crop to the keyboard region and downscale before inference
+            frame = packet['frame']
+            origin = (0, 0)
+            if self.roi is not None:
+                x0, y0, x1, y1 = self.roi
+                frame = frame[y0:y1, x0:x1]
+                origin = (x0, y0)
+            packet['roi'] = self.roi
+            image = frame
+            if self.inference_width and frame.shape[1] > self.inference_width:
+                scale = self.inference_width / frame.shape[1]
+                size = (self.inference_width, round(frame.shape[0] * scale))
+                image = get_buffer(self.inference_slot, 'small', (size[1], size[0], 3))
+                cv2.resize(frame, size, dst=image, interpolation=cv2.INTER_AREA)
+
+            # Convert the BGR image to RGB
+            rgb = get_buffer(self.inference_slot, 'rgb', image.shape)
+            rgb.flags.writeable = True
+            cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=rgb)
+            rgb.flags.writeable = False
+
+            # Process the image and detect hands, landmarks are normalized to the
+            # inference image so they map back through the crop size and origin
+            packet['results'] = self.hands.process(rgb)
+            packet['landmarks'] = landmarks_to_array(
+                packet['results'].multi_hand_landmarks, frame.shape, origin)
+            packet['handedness'] = handedness_to_list(packet['results'].multi_handedness)
+            self.inference_queue.put(packet, self.stop_event)
+
+    def _detection_stage(self):
+        while not self.stop_event.is_set():
+            packet = self.inference_queue.get()
+            if packet is None:
+                if self.inference_done.is_set() and self.inference_queue.queue.empty():
+                    break
+                continue
+
+            # Re-estimate the keyboard position on the frames the tracker asks for
+            if self.tracker is not None:
+                self._track(packet)
+            packet['h_matrix'] = self.detector.h_matrix
+
+            presses, points = self.detector.update(
+                packet['landmarks'], packet['timestamp'], packet['handedness'])
+            packet['presses'] = presses
+            packet['points'] = points
+
+            for key, _, _ in presses:
+                if self.verbose:
+                    print(f"Key Press Detected: {key}")
+                if self.on_press:
+                    self.on_press(key, packet['timestamp'])
+            if self.on_frame:
+                self.on_frame(packet)
+
+            self.frames_processed += 1
+            self.total_latency += time.monotonic() - packet['capture_time']
+
+            if self.render_queue is not None:
+                self.render_queue.put(packet)
+            else:
+                self._release(packet)
+
+    def _track(self, packet):
+        pts_src = self.tracker.update(packet['frame'], packet['index'])
+        if pts_src is None:
+            return
+        h_matrix, _ = compute_homography_matrix(pts_src)
+        self.detector.set_homography(h_matrix)
+        # The inference stage picks the new region up with its next frame
+        if self.roi is not None:
+            self.roi = compute_roi(pts_src, packet['frame'].shape)
+        if self.verbose:
+            print(f"Keyboard moved, homography updated on frame {packet['index']}")
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+
+    def run(self):
+        # Blocks until the input ends or the render callback asks to quit.
+        # Rendering happens on the calling thread because the GUI backends need it.
+        # An exception raised in one of the stages is raised here once all of them stopped.
+        self.start()
+        try:
+            while not self.stop_event.is_set():
+                if self.render_queue is None:
+                    self.stop_event.wait(0.1)
+                    continue
+                packet = self.render_queue.get()
+                if packet is None:
+                    continue
+                keep_running = self.render(packet)
+                self._release(packet)
+                if not keep_running:
+                    break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+        if self.error is not None:
+            raise self.error
+        return self.stats()
+
+    def stats(self):
+        dropped = self.capture_queue.dropped + self.inference_queue.dropped
+        avg_latency = self.total_latency / self.frames_processed if self.frames_processed else 0.0
+        # Buffers allocated over the whole run, stays constant once every slot was used once
+        allocations = self.inference_slot.get('allocations', 0)
+        allocations += sum(slot.get('allocations', 0) for slot in list(self.buffers.free.queue))
+        return {
+            'frames_captured': self.frames_captured,
+            'frames_processed': self.frames_processed,
+            'frames_dropped': dropped,
+            'avg_latency': avg_latency,
+            'buffer_allocations': allocations,
+            'homography_updates': self.tracker.updates if self.tracker is not None else 0,
+        }
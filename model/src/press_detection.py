@@ -0,0 +1,327 @@
+import itertools
+from collections import deque
+
+import numpy as np
+
+from finger_key_mapping import get_key_lookup, map_fingertips_to_keys
+from keyboard_tracking import transform_points
+
+# MediaPipe landmark indices of the five fingertips
+FINGERTIPS = [4, 8, 12, 16, 20]
+
+
+class FingertipHistory:
+    # Fixed size ring buffer of (x, y, t) samples per hand and finger, appending and
+    # reading the window never allocates or shifts like list.pop(0) does
+
+    def __init__(self, num_hands=2, num_fingers=5, capacity=5):
+        self.capacity = capacity
+        self.samples = np.zeros((num_hands, num_fingers, capacity, 3), dtype=np.float64)
+        self.head = np.zeros((num_hands, num_fingers), dtype=np.intp)  # next write position
+        self.count = np.zeros((num_hands, num_fingers), dtype=np.intp)
+
+    def append(self, hands, fingers, samples):
+        # Append one (x, y, t) sample for each (hand, finger) pair, pairs must be unique
+        head = self.head[hands, fingers]
+        self.samples[hands, fingers, head] = samples
+        self.head[hands, fingers] = (head + 1) % self.capacity
+        self.count[hands, fingers] = np.minimum(self.count[hands, fingers] + 1, self.capacity)
+
+    def clear(self, hands=slice(None), fingers=slice(None)):
+        self.count[hands, fingers] = 0
+
+    def newest(self, hands, fingers, back=0):
+        # The sample `back` steps before the newest one of every (hand, finger) pair
+        index = (self.head[hands, fingers] - 1 - back) % self.capacity
+        return self.samples[hands, fingers, index]
+
+    def oldest(self, hands, fingers):
+        return self.newest(hands, fingers, np.maximum(self.count[hands, fingers] - 1, 0))
+
+    def is_full(self, hands, fingers):
+        return self.count[hands, fingers] == self.capacity
+
+    def trajectory(self, hand, finger):
+        # All samples of one fingertip ordered from oldest to newest
+        count = self.count[hand, finger]
+        index = (self.head[hand, finger] - count + np.arange(count)) % self.capacity
+        return self.samples[hand, finger, index]
+
+    def kinematics(self, hands, fingers):
+        # Velocity (px/s) and acceleration (px/s^2) of every (hand, finger) pair from its
+        # three newest samples, NaN where there aren't enough samples yet
+        p0 = self.newest(hands, fingers, 2)
+        p1 = self.newest(hands, fingers, 1)
+        p2 = self.newest(hands, fingers, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dt1 = (p1[..., 2] - p0[..., 2])[..., None]
+            dt2 = (p2[..., 2] - p1[..., 2])[..., None]
+            v1 = (p1[..., :2] - p0[..., :2]) / dt1
+            v2 = (p2[..., :2] - p1[..., :2]) / dt2
+            acceleration = (v2 - v1) / ((dt1 + dt2) / 2)
+        too_short = (self.count[hands, fingers] < 3)[..., None]
+        velocity = np.where(too_short, np.nan, v2)
+        acceleration = np.where(too_short, np.nan, acceleration)
+        return velocity, acceleration
+
+
+class RateLimiter:
+    # Sliding window keystroke rate limiter, constant time per frame and event.
+    # More than max_events within window seconds starts a cooldown period.
+
+    def __init__(self, max_events=2, window=1.0, cooldown=3.0):
+        self.max_events = max_events  # Maximum keystrokes allowed in the time window
+        self.window = window  # Time window in seconds
+        self.cooldown = cooldown  # Duration to suppress keystrokes after overload
+        self.events = deque()
+        self.suppressing = False
+        self.cooldown_start_time = None
+
+    def record(self, timestamp):
+        self.events.append(timestamp)
+
+    def update(self, current_time):
+        # Returns True while keystrokes are suppressed
+        # Remove old timestamps outside the time window
+        while self.events and current_time - self.events[0] > self.window:
+            self.events.popleft()
+
+        # Check if the number of keystrokes exceeds the maximum allowed
+        if len(self.events) > self.max_events and not self.suppressing:
+            self.suppressing = True
+            self.cooldown_start_time = current_time
+            print("Keystroke overload detected. Suppressing outputs.")
+
+        # Handle cooldown period
+        if self.suppressing and current_time - self.cooldown_start_time >= self.cooldown:
+            self.suppressing = False
+            self.events.clear()
+            print("Resuming keystroke outputs.")
+
+        return self.suppressing
+
+
+class HandTracker:
+    # Associates the hands detected in a frame with persistent hand slots, so press
+    # detection state follows a hand instead of its position in the MediaPipe results.
+    # Cost of putting a hand in a slot is the distance to where the slot's hand was last
+    # seen, plus a penalty if the MediaPipe handedness label doesn't match.
+
+    def __init__(self, max_num_hands=2, max_distance=150, handedness_penalty=100,
+                 duplicate_distance=20, max_gap=0.5):
+        self.max_num_hands = max_num_hands
+        self.max_distance = max_distance  # Max movement in pixels per frame to keep a track
+        self.handedness_penalty = handedness_penalty
+        # Detections closer than this are the same hand detected twice
+        self.duplicate_distance = duplicate_distance
+        self.max_gap = max_gap  # Seconds after which a lost track is given up
+
+        self.labels = [None] * max_num_hands
+        self.centers = np.zeros((max_num_hands, 2), dtype=np.float64)
+        self.last_seen = np.full(max_num_hands, -np.inf)
+
+    def _drop_duplicates(self, centers, scores):
+        keep = []
+        for i in np.argsort(-scores, kind='stable'):
+            if all(np.hypot(*(centers[i] - centers[j])) >= self.duplicate_distance for j in keep):
+                keep.append(i)
+        # Keep the most confident hands if there are more than slots
+        return sorted(keep[:self.max_num_hands])
+
+    def assign(self, landmarks, handedness, current_time):
+        # landmarks: (n_hands, 21, 2) array, handedness: (label, score) per hand or None.
+        # Returns (slots, new_slots): the slot of every hand (-1 if it was dropped) and
+        # the slots that now hold a different hand than before and need a fresh state
+        n_hands = len(landmarks)
+        slots = np.full(n_hands, -1, dtype=np.intp)
+        if n_hands == 0:
+            return slots, []
+        if handedness is None:
+            handedness = [(None, 1.0)] * n_hands
+        labels = [label for label, _ in handedness]
+        scores = np.array([score for _, score in handedness], dtype=np.float64)
+        centers = landmarks.mean(axis=1)
+
+        hands = self._drop_duplicates(centers, scores)
+        active = current_time - self.last_seen <= self.max_gap
+
+        # Cost of every (hand, slot) pair, starting a new track in a slot costs as much as
+        # the largest allowed movement so continuing a plausible track is always preferred
+        cost = np.empty((len(hands), self.max_num_hands))
+        for row, hand in enumerate(hands):
+            distance = np.hypot(*(self.centers - centers[hand]).T)
+            mismatch = [slot_label is not None and slot_label != labels[hand] for slot_label in self.labels]
+            cost[row] = np.where(active & (distance <= self.max_distance), distance, self.max_distance + 1)
+            cost[row] += np.where(mismatch, self.handedness_penalty, 0)
+
+        # At most a handful of hands and slots, trying every assignment is cheapest
+        best = min(itertools.permutations(range(self.max_num_hands), len(hands)),
+                   key=lambda perm: sum(cost[row, slot] for row, slot in enumerate(perm)))
+
+        new_slots = []
+        for row, slot in enumerate(best):
+            hand = hands[row]
+            slots[hand] = slot
+            distance = np.hypot(*(self.centers[slot] - centers[hand]))
+            if not active[slot] or distance > self.max_distance:
+                new_slots.append(slot)
+            self.labels[slot] = labels[hand]
+            self.centers[slot] = centers[hand]
+            self.last_seen[slot] = current_time
+        return slots, new_slots
+
+
+class PressDetector:
+    # Fingertip -> key press state machine, fed with one frame of hand landmarks at a time
+
+    def __init__(self, h_matrix, size, keyboard_layout, threshold=14, vertical_offset=-150,
+                 key_lookup=None, key_tolerance=0, max_num_hands=2, history_size=5,
+                 max_gap=0.5, suppress_on_overload=False):
+        self.h_matrix = h_matrix
+        self.width, self.height = size
+        self.keyboard_layout = keyboard_layout
+        self.key_lookup = key_lookup if key_lookup is not None else get_key_lookup(keyboard_layout)
+        # Max distance in pixels to the closest key for a fingertip between keys to still count
+        self.key_tolerance = key_tolerance
+        self.threshold = threshold  # Adjust based on testing
+        self.vertical_offset = vertical_offset  # Adjust based on testing
+        self.max_num_hands = max_num_hands
+        # A fingertip track that wasn't seen for this many seconds starts over
+        self.max_gap = max_gap
+
+        # Initialize per-hand tracking and fingertip history for press detection
+        self.hand_tracker = HandTracker(max_num_hands, max_gap=max_gap)
+        self.history = FingertipHistory(max_num_hands, len(FINGERTIPS), history_size)
+        self.press_detected = np.zeros((max_num_hands, len(FINGERTIPS)), dtype=bool)
+
+        # Initialize keystroke management
+        self.max_simultaneous_keystrokes = 1
+        self.current_keystrokes = 0  # Counter for current keystrokes displayed
+
+        # Initialize keystroke rate limiter, drops presses during a cooldown if enabled
+        self.rate_limiter = RateLimiter()
+        self.suppress_on_overload = suppress_on_overload
+
+    def reset(self):
+        self.history.clear()
+        self.press_detected[:] = False
+        self.current_keystrokes = 0
+
+    def set_homography(self, h_matrix):
+        # The keyboard moved in the frame. Fingertip histories are in keyboard coordinates
+        # of the old homography, the jump between both would look like a press.
+        self.h_matrix = h_matrix
+        self.history.clear()
+
+    def _release(self, hands, fingers):
+        # Forget the press state of fingers that were released or lost
+        released = int(np.count_nonzero(self.press_detected[hands, fingers]))
+        self.press_detected[hands, fingers] = False
+        self.current_keystrokes = max(self.current_keystrokes - released, 0)
+
+    def _expire_stale(self, current_time):
+        # Tracks that weren't updated for max_gap seconds start over, so a hand leaving
+        # the view doesn't keep its history or keep a key held down forever
+        all_hands, all_fingers = np.indices(self.press_detected.shape)
+        last_seen = self.history.newest(all_hands, all_fingers)[..., 2]
+        stale = (self.history.count > 0) & (current_time - last_seen > self.max_gap)
+        if stale.any():
+            hands, fingers = np.nonzero(stale)
+            self._release(hands, fingers)
+            self.history.clear(hands, fingers)
+
+    def update(self, landmarks, current_time, handedness=None):
+        # landmarks: (n_hands, 21, 2) array of hand landmarks in frame pixel coordinates,
+        # handedness: MediaPipe (label, score) of every hand, if available.
+        # Returns (presses, points): the keys pressed in this frame as (key, tx, ty)
+        # and every fingertip position in keyboard coordinates for drawing
+        suppressing = self.rate_limiter.update(current_time)
+        self._expire_stale(current_time)
+
+        presses = []
+        points = []
+
+        # Key the tracking state by hand identity, not by detection order
+        slots, new_slots = self.hand_tracker.assign(landmarks, handedness, current_time)
+        for slot in new_slots:
+            self._release(slot, slice(None))
+            self.history.clear(slot)
+        landmarks = landmarks[slots >= 0]
+        slots = slots[slots >= 0]
+        if len(landmarks) == 0:
+            return presses, points
+
+        # Transform all fingertips of all hands to the keyboard coordinate system at once
+        fingertips = landmarks[:, FINGERTIPS].astype(np.int32).reshape(-1, 2)
+        transformed = transform_points(fingertips, self.h_matrix).astype(np.int32)
+        tx_all = transformed[:, 0]
+        ty_all = transformed[:, 1]
+
+        # Apply vertical offset correction
+        ty_corrected_all = ty_all + self.vertical_offset
+
+        # Ensure transformed points are within bounds
+        in_bounds = (tx_all >= 0) & (tx_all < self.width) & (ty_corrected_all >= 0) & (ty_corrected_all < self.height)
+        valid = np.flatnonzero(in_bounds)
+        if len(valid) == 0:
+            return presses, points
+
+        # Look up the key under every fingertip at once
+        key_ids, key_distances = map_fingertips_to_keys(tx_all[valid], ty_all[valid], self.key_lookup)
+        on_key = key_distances <= self.key_tolerance
+
+        # Update fingertip history with corrected ty
+        hand_index, fingers = np.divmod(valid, len(FINGERTIPS))
+        hands = slots[hand_index]
+        samples = np.empty((len(valid), 3), dtype=np.float64)
+        samples[:, 0] = tx_all[valid]
+        samples[:, 1] = ty_corrected_all[valid]
+        samples[:, 2] = current_time
+        self.history.append(hands, fingers, samples)
+
+        # Compute velocity for press detection over the full window
+        full = self.history.is_full(hands, fingers)
+        velocity = self.history.newest(hands, fingers)[:, 1] - self.history.oldest(hands, fingers)[:, 1]
+        pressed = self.press_detected[hands, fingers]
+        going_down = full & (velocity > self.threshold) & ~pressed
+        going_up = full & (velocity < -self.threshold / 2) & pressed
+
+        for i in np.flatnonzero(going_down | going_up):
+            hand, finger = hands[i], fingers[i]
+            if going_down[i]:
+                # Detect downward motion for key press
+                if self.current_keystrokes < self.max_simultaneous_keystrokes:
+                    if on_key[i] and not (suppressing and self.suppress_on_overload):
+                        key = self.key_lookup['keys'][key_ids[i]]
+                        presses.append((key, int(tx_all[valid[i]]), int(ty_all[valid[i]])))
+                        self.rate_limiter.record(current_time)
+                        self.current_keystrokes += 1  # Increment counter
+                    self.press_detected[hand, finger] = True
+            else:
+                # Reset press_detected when finger moves up
+                self._release(hand, finger)
+
+        points = list(zip(tx_all[valid].tolist(), ty_all[valid].tolist()))
+        return presses, points
+
+
+def landmarks_to_array(multi_hand_landmarks, frame_shape, origin=(0, 0)):
+    # Convert the MediaPipe results of all detected hands into one (n_hands, 21, 2)
+    # array of pixel coordinates. frame_shape is the shape of the (cropped) image the
+    # landmarks were detected in and origin its top left corner in the full frame.
+    if not multi_hand_landmarks:
+        return np.empty((0, 21, 2), dtype=np.float32)
+    h, w = frame_shape[:2]
+    landmarks = np.array(
+        [[(lm.x, lm.y) for lm in hand_landmarks.landmark] for hand_landmarks in multi_hand_landmarks],
+        dtype=np.float32)
+    landmarks *= (w, h)
+    landmarks += origin
+    return landmarks
+
+
+def handedness_to_list(multi_handedness):
+    # (label, score) of every detected hand, in the same order as the landmarks
+    if not multi_handedness:
+        return []
+    return [(hand.classification[0].label, hand.classification[0].score) for hand in multi_handedness]
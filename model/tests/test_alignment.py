@@ -0,0 +1,126 @@
+import numpy as np
+import pytest
+
+from alignment import align_keystrokes, code_index, key_distance_table, StreamingAligner
+from finger_key_mapping import create_keyboard_layout
+
+CODES, DISTANCES = key_distance_table(create_keyboard_layout(1000, 1000))
+LETTERS = [ord(c) for c in 'ASDFGHJKLQWERTYUIOP']
+
+
+def full_alignment(times_a, keys_a, times_b, keys_b, gap_cost=1.0, time_weight=1.0,
+                   max_interval_error=1.0, max_distance=2.0):
+    # Textbook edit distance DP over the whole cost matrix
+    n, m = len(keys_a), len(keys_b)
+    cost = np.zeros((n + 1, m + 1))
+    cost[0, :] = np.arange(m + 1) * gap_cost
+    cost[:, 0] = np.arange(n + 1) * gap_cost
+    intervals_a = np.diff(times_a, prepend=times_a[0]) if n else []
+    intervals_b = np.diff(times_b, prepend=times_b[0]) if m else []
+    index_a = code_index(np.asarray(keys_a), CODES)
+    index_b = code_index(np.asarray(keys_b), CODES)
+    for i in range(1, n + 1):
+        for j in range(1, m + 1):
+            if keys_a[i - 1] == keys_b[j - 1]:
+                key = 0.0
+            else:
+                key = min(DISTANCES[index_a[i - 1], index_b[j - 1]] / max_distance, 1.0)
+            timing = min(abs(intervals_a[i - 1] - intervals_b[j - 1]) / max_interval_error, 1.0)
+            cost[i, j] = min(cost[i - 1, j - 1] + key + time_weight * timing,
+                             cost[i - 1, j] + gap_cost, cost[i, j - 1] + gap_cost)
+    return cost[n, m]
+
+
+def random_stream(rng, length):
+    times = np.cumsum(rng.uniform(0.05, 0.6, length))
+    keys = rng.choice(LETTERS + [0xE000, 12345], length)
+    return times, keys
+
+
+def noisy_copy(rng, times, keys, errors):
+    # The same typing seen by another device: another clock, jitter and a few missed,
+    # extra or wrong keystrokes
+    times = list(times + 100.0 + rng.normal(0, 0.02, len(times)))
+    keys = list(keys)
+    for _ in range(errors):
+        position = int(rng.integers(0, len(keys)))
+        kind = rng.integers(0, 3)
+        if kind == 0 and len(keys) > 1:
+            del times[position], keys[position]
+        elif kind == 1:
+            times.insert(position, times[position] - 0.01)
+            keys.insert(position, int(rng.choice(LETTERS)))
+        else:
+            keys[position] = int(rng.choice(LETTERS))
+    return np.array(times), np.array(keys)
+
+
+def stream_alignment(times_a, keys_a, times_b, keys_b, rng, window):
+    # Feeds both streams in random pieces, interleaved
+    aligner = StreamingAligner(CODES, DISTANCES, window=window)
+    i = j = 0
+    while i < len(keys_a) or j < len(keys_b):
+        if rng.random() < 0.5 and i < len(keys_a):
+            step = int(rng.integers(1, 8))
+            aligner.extend_a(times_a[i:i + step], keys_a[i:i + step])
+            i += step
+        elif j < len(keys_b):
+            step = int(rng.integers(1, 8))
+            aligner.extend_b(times_b[j:j + step], keys_b[j:j + step])
+            j += step
+    return aligner.close()
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_wide_band_matches_full_dp(seed):
+    rng = np.random.default_rng(seed)
+    times_a, keys_a = random_stream(rng, int(rng.integers(1, 40)))
+    times_b, keys_b = random_stream(rng, int(rng.integers(1, 40)))
+    expected = full_alignment(times_a, keys_a, times_b, keys_b)
+    assert align_keystrokes(times_a, keys_a, times_b, keys_b, CODES, DISTANCES, window=40) == pytest.approx(expected)
+    assert align_keystrokes(times_a, keys_a, times_b, keys_b, CODES, DISTANCES, window=40, chunk=3) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_narrow_band_on_similar_streams(seed):
+    rng = np.random.default_rng(seed)
+    times_a, keys_a = random_stream(rng, int(rng.integers(20, 120)))
+    times_b, keys_b = noisy_copy(rng, times_a, keys_a, int(rng.integers(0, 6)))
+    expected = full_alignment(times_a, keys_a, times_b, keys_b)
+    banded = align_keystrokes(times_a, keys_a, times_b, keys_b, CODES, DISTANCES, window=8)
+    # The band only restricts the paths, and the best one of similar streams lies inside it
+    assert banded == pytest.approx(expected)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_band_is_an_upper_bound(seed):
+    rng = np.random.default_rng(seed)
+    times_a, keys_a = random_stream(rng, 30)
+    times_b, keys_b = random_stream(rng, 20)
+    expected = full_alignment(times_a, keys_a, times_b, keys_b)
+    assert align_keystrokes(times_a, keys_a, times_b, keys_b, CODES, DISTANCES, window=2) >= expected - 1e-9
+
+
+def test_empty_streams():
+    times, keys = random_stream(np.random.default_rng(0), 5)
+    assert align_keystrokes(times, keys, [], [], CODES, DISTANCES) == 5
+    assert align_keystrokes([], [], times, keys, CODES, DISTANCES) == 5
+    assert align_keystrokes(times, keys, times, keys, CODES, DISTANCES) == 0
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_streaming_matches_batch(seed):
+    rng = np.random.default_rng(seed)
+    times_a, keys_a = random_stream(rng, int(rng.integers(20, 120)))
+    times_b, keys_b = noisy_copy(rng, times_a, keys_a, int(rng.integers(0, 6)))
+    batch = align_keystrokes(times_a, keys_a, times_b, keys_b, CODES, DISTANCES, window=8)
+    assert stream_alignment(times_a, keys_a, times_b, keys_b, rng, window=8) == pytest.approx(batch)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_streaming_wide_band_matches_full_dp(seed):
+    rng = np.random.default_rng(seed)
+    times_a, keys_a = random_stream(rng, int(rng.integers(1, 30)))
+    times_b, keys_b = random_stream(rng, int(rng.integers(1, 30)))
+    expected = full_alignment(times_a, keys_a, times_b, keys_b)
+    assert stream_alignment(times_a, keys_a, times_b, keys_b, rng, window=40) == pytest.approx(expected)
@@ -0,0 +1,92 @@
+import numpy as np
+
+from finger_key_mapping import (create_keyboard_layout, create_key_lookup, get_key_lookup, map_fingertip_to_key,
+                                map_fingertips_to_keys, available_layouts, KeyboardLayout, KeyboardOverlay)
+
+# The German MacBook layout as it was hardcoded before layouts became data files
+OLD_ROWS = [
+    [('Esc', 1.5)] + [(f'F{n}', 1) for n in range(1, 13)] + [('Power', 1)],
+    [(key, 1) for key in ['^', '1', '2', '3', '4', '5', '6', '7', '8', '9', '0', 'SS', '´']] + [('Delete', 1.5)],
+    [('Tab', 1.5)] + [(key, 1) for key in ['Q', 'W', 'E', 'R', 'T', 'Z', 'U', 'I', 'O', 'P', 'UE', '+', 'Return']],
+    [('CapsLock', 1.75)] + [(key, 1) for key in ['A', 'S', 'D', 'F', 'G', 'H', 'J', 'K', 'L', 'OE', 'AE', '#']]
+    + [('Return', 0.75)],
+    [('Shift', 1.25)] + [(key, 1) for key in ['<', 'Y', 'X', 'C', 'V', 'B', 'N', 'M', ',', '.', '-']]
+    + [('Shift', 2.25)],
+    [('Fn', 1), ('Ctr', 1), ('Opt', 1), ('Cmd', 1.25), ('Space', 5), ('Cmd', 1.25), ('Opt', 1),
+     ('Left', 1), ('Up', 1), ('Down', 1), ('Right', 1)],
+]
+
+
+def old_keyboard_layout(width, height):
+    # The layout computation as it was before, key by key
+    key_unit = 50
+    total_units = sum(key_width for _, key_width in OLD_ROWS[1])
+    scale = min(width / (total_units * key_unit), height / (key_unit * len(OLD_ROWS)))
+    layout = []
+    current_y = 5
+    for row in OLD_ROWS:
+        current_x = 5
+        for key, key_width in row:
+            key_w = key_width * key_unit * scale
+            key_h = key_unit * scale
+            layout.append({'key': key, 'x': current_x, 'y': current_y,
+                           'width': key_w - 5 * scale, 'height': key_h - 5 * scale})
+            current_x += key_w
+        current_y += key_h
+    return layout
+
+
+def test_layout_equals_old_hardcoded_layout():
+    for size in [(725, 300), (1000, 1000), (640, 200)]:
+        assert list(create_keyboard_layout(*size)) == old_keyboard_layout(*size)
+
+
+def test_layouts_are_cached_and_read_only():
+    layout = create_keyboard_layout(725, 300)
+    assert create_keyboard_layout(725, 300) is layout
+    assert get_key_lookup(layout) is get_key_lookup(layout)
+    assert not layout.rects.flags.writeable
+    assert not get_key_lookup(layout)['nearest'].flags.writeable
+
+
+def test_lookup_matches_old_list_layout():
+    layout = create_keyboard_layout(725, 300)
+    from_arrays = create_key_lookup(layout)
+    from_dicts = create_key_lookup(old_keyboard_layout(725, 300))
+    for name in ('labels', 'nearest', 'distance'):
+        assert np.array_equal(from_arrays[name], from_dicts[name])
+    assert from_arrays['keys'] == from_dicts['keys']
+
+
+def test_fingertip_lookup():
+    layout = create_keyboard_layout(725, 300)
+    lookup = get_key_lookup(layout)
+    key_id = layout.keys.index('A')
+    x, y = layout.centers[key_id]
+    assert map_fingertip_to_key(x, y, layout, lookup) == 'A'
+    assert map_fingertip_to_key(x, y, layout) == 'A'
+    key_ids, distances = map_fingertips_to_keys([x, -10], [y, -10], lookup)
+    assert lookup['keys'][key_ids[0]] == 'A' and distances[0] == 0
+    assert distances[1] > 0
+
+
+def test_all_layouts_load():
+    assert {'iso_de', 'ansi_us'} <= set(available_layouts())
+    for name in available_layouts():
+        layout = create_keyboard_layout(725, 300, name)
+        assert isinstance(layout, KeyboardLayout)
+        # Every key has a key code and a size
+        assert (layout.codes >= 0).all()
+        assert (layout.rects[:, 2:] > 0).all()
+
+
+def test_overlay_highlights_pressed_keys():
+    layout = create_keyboard_layout(725, 300)
+    overlay = KeyboardOverlay(layout, (725, 300))
+    key_id = layout.keys.index('A')
+    # Inside the key, away from its label
+    x, y = (layout.rects[key_id, :2] + 3).astype(int)
+    overlay.set_pressed_keys(['A'])
+    assert overlay.image[y, x].tolist() == [0, 255, 0]
+    overlay.set_pressed_keys([])
+    assert np.array_equal(overlay.image, overlay.base_image)
@@ -0,0 +1,37 @@
+import pytest
+
+from headless import split_segments, merge_segments
+
+
+def keystroke(timestamp, keycode):
+    return {'timestamp': timestamp, 'key': chr(keycode), 'keycode': keycode}
+
+
+def test_unknown_duration_is_one_open_segment():
+    assert split_segments(0.0, 4) == [(0.0, None)]
+
+
+def test_segments_cover_the_recording():
+    segments = split_segments(100.0, 4, min_length=10.0)
+    assert segments == [(0.0, 25.0), (25.0, 50.0), (50.0, 75.0), (75.0, None)]
+    # Too short for every worker
+    assert split_segments(25.0, 8, min_length=10.0) == [(0.0, 12.5), (12.5, None)]
+
+
+def test_press_seen_by_both_segments_is_merged():
+    first = [keystroke(9.0, 65), keystroke(9.98, 66)]
+    second = [keystroke(10.02, 66), keystroke(10.5, 67)]
+    merged = merge_segments([first, second], dedup_window=0.1)
+    assert [(k['timestamp'], k['keycode']) for k in merged] == [(9.0, 65), (9.98, 66), (10.5, 67)]
+
+
+def test_other_key_at_seam_is_kept():
+    merged = merge_segments([[keystroke(9.98, 65)], [keystroke(10.02, 66)]], dedup_window=0.1)
+    assert len(merged) == 2
+
+
+def test_repeated_key_within_segment_is_kept():
+    # Fast double presses belong to one segment, only seam duplicates are dropped
+    merged = merge_segments([[keystroke(1.0, 65), keystroke(1.05, 65)], [keystroke(12.0, 65)]],
+                            dedup_window=0.1)
+    assert [k['timestamp'] for k in merged] == pytest.approx([1.0, 1.05, 12.0])
@@ -0,0 +1,30 @@
+from types import SimpleNamespace
+
+from key_codes import key_to_code, code_to_key, pynput_key_to_code, NAMED_KEY_CODES
+
+
+def test_letters_are_case_insensitive():
+    assert key_to_code('a') == key_to_code('A') == ord('A')
+
+
+def test_german_letters_match_layout_labels():
+    assert key_to_code('ß') == NAMED_KEY_CODES['SS']
+    assert key_to_code('ä') == NAMED_KEY_CODES['AE']
+    assert key_to_code('ö') == NAMED_KEY_CODES['OE']
+    assert key_to_code('ü') == NAMED_KEY_CODES['UE']
+
+
+def test_named_keys_round_trip():
+    for name, code in NAMED_KEY_CODES.items():
+        assert key_to_code(name) == code
+        assert code_to_key(code) == name
+
+
+def test_unknown_labels():
+    assert key_to_code('Unknown') is None
+
+
+def test_pynput_keys():
+    assert pynput_key_to_code(SimpleNamespace(char='ß')) == NAMED_KEY_CODES['SS']
+    assert pynput_key_to_code(SimpleNamespace(char=None, name='enter')) == NAMED_KEY_CODES['Return']
+    assert pynput_key_to_code(SimpleNamespace(char=None, name='media_play_pause')) is None
@@ -0,0 +1,103 @@
+import cv2
+import numpy as np
+import pytest
+
+from keyboard_tracking import HomographyTracker, order_corners, detect_keyboard_corners
+
+WIDTH, HEIGHT = 725, 300
+CORNERS = np.float32([[100, 300], [540, 300], [560, 460], [80, 460]])
+
+
+@pytest.fixture(scope='module')
+def scene():
+    # A keyboard with labelled keys on a noisy desk, and a function rendering it moved
+    rng = np.random.default_rng(1)
+    keyboard = np.full((HEIGHT, WIDTH, 3), 40, np.uint8)
+    letters = "QWERTYUIOPASDFGHJKLZXCVBNM1234567890"
+    for row in range(5):
+        for column in range(14):
+            x, y = column * 51 + 5, row * 58 + 5
+            cv2.rectangle(keyboard, (x, y), (x + 46, y + 52), (200, 200, 200), 2)
+            cv2.putText(keyboard, letters[rng.integers(len(letters))], (x + 12, y + 36),
+                        cv2.FONT_HERSHEY_SIMPLEX, 1, (230, 230, 230), 2)
+    to_frame = cv2.getPerspectiveTransform(np.float32([[0, 0], [WIDTH, 0], [WIDTH, HEIGHT], [0, HEIGHT]]), CORNERS)
+    desk = (rng.random((480, 640, 3)) * 60).astype(np.uint8)
+
+    def render(move=np.eye(3)):
+        h_matrix = move @ to_frame
+        frame = desk.copy()
+        warped = cv2.warpPerspective(keyboard, h_matrix, (640, 480))
+        mask = cv2.warpPerspective(np.full((HEIGHT, WIDTH), 255, np.uint8), h_matrix, (640, 480))
+        frame[mask > 0] = warped[mask > 0]
+        return frame
+
+    return render
+
+
+def moved_corners(move):
+    return cv2.perspectiveTransform(CORNERS.reshape(-1, 1, 2), move).reshape(-1, 2)
+
+
+def translation(dx, dy, angle=0.0):
+    move = np.vstack([cv2.getRotationMatrix2D((320, 380), angle, 1.0), [0, 0, 1]])
+    move[0, 2] += dx
+    move[1, 2] += dy
+    return move
+
+
+def test_static_keyboard_keeps_calibration(scene):
+    tracker = HomographyTracker(scene(), CORNERS)
+    assert tracker.update(scene(), 0) is None
+    assert tracker.next_check == tracker.interval
+    assert tracker.update(scene(), 1) is None
+    assert tracker.checks == 1
+
+
+def test_small_move_is_followed(scene):
+    tracker = HomographyTracker(scene(), CORNERS)
+    move = translation(8, -5, angle=2.0)
+    frame = scene(move)
+    # A hand covering part of the keys
+    cv2.circle(frame, (300, 370), 50, (120, 150, 200), -1)
+    corners = tracker.update(frame, 0)
+    assert corners is not None
+    assert np.abs(corners - moved_corners(move)).max() < 2.0
+    # Checked again soon while it may still be moving
+    assert tracker.next_check == tracker.fast_interval
+
+
+def test_large_move_is_confirmed_and_reacquired(scene):
+    tracker = HomographyTracker(scene(), CORNERS)
+    move = translation(-70, -200)
+    frame = scene(move)
+    # Out of the search region and too far for a single fit to be trusted: the next
+    # checks search the whole frame and accept once two fits agree
+    assert tracker.update(frame, 0) is None
+    corners = None
+    for _ in range(3):
+        corners = tracker.update(frame, tracker.next_check)
+        if corners is not None:
+            break
+    assert corners is not None
+    assert np.abs(corners - moved_corners(move)).max() < 2.0
+    assert tracker.updates == 1
+
+
+def test_lost_keyboard_backs_off(scene):
+    tracker = HomographyTracker(scene(), CORNERS)
+    empty = np.zeros((480, 640, 3), np.uint8)
+    assert tracker.update(empty, 0) is None
+    assert tracker.next_check == tracker.fast_interval
+    assert tracker.update(empty, tracker.next_check) is None
+    assert tracker.next_check == tracker.fast_interval + tracker.interval
+
+
+def test_order_corners():
+    shuffled = CORNERS[[2, 0, 3, 1]]
+    assert np.array_equal(order_corners(shuffled), CORNERS)
+
+
+def test_detect_keyboard_corners(scene):
+    corners = detect_keyboard_corners([scene()])
+    assert corners is not None
+    assert np.abs(corners - CORNERS).max() < 10
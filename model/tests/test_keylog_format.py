@@ -0,0 +1,134 @@
+import time
+
+import numpy as np
+import pytest
+
+from keylog_format import (KeylogWriter, KeylogReader, read_keylog, parse_keylog, export_csv, import_csv,
+                           HEADER_DTYPE, RECORD_DTYPES, MAGIC, HEADER_SIZE, KEY_DOWN, KEY_UP)
+
+
+def test_writer_round_trip(tmp_path):
+    path = str(tmp_path / 'log.klog')
+    with KeylogWriter(path, buffer_size=4, origin_ns=123) as writer:
+        for i in range(10):
+            writer.write(i * 1000, 65 + i, vk=i, event=KEY_DOWN)
+        writer.write(20000, None, event=KEY_UP, duration_ns=500)
+    origin_ns, records = read_keylog(path)
+    assert origin_ns == 123
+    assert records['timestamp_ns'].tolist() == [i * 1000 for i in range(10)] + [20000]
+    assert records['keycode'].tolist() == list(range(65, 75)) + [-1]
+    assert records['vk'].tolist() == list(range(10)) + [0]
+    assert records['event'][-1] == KEY_UP
+    assert records['duration_ns'][-1] == 500
+
+
+def test_large_virtual_key_codes(tmp_path):
+    path = str(tmp_path / 'log.klog')
+    with KeylogWriter(path) as writer:
+        # X11 keysym of a media key
+        writer.write(1, 65, 0x1008FF11)
+        writer.write(2, 66, 1 << 40)
+    _, records = read_keylog(path)
+    assert records['vk'].tolist() == [0x1008FF11, 0]
+
+
+def test_idle_writer_flushes(tmp_path):
+    path = str(tmp_path / 'log.klog')
+    writer = KeylogWriter(path, flush_interval=0.05)
+    try:
+        writer.write(1, 65)
+        deadline = time.monotonic() + 2.0
+        while time.monotonic() < deadline:
+            with open(path, 'rb') as f:
+                if len(parse_keylog(f.read())[1]) == 1:
+                    break
+            time.sleep(0.01)
+        with open(path, 'rb') as f:
+            assert len(parse_keylog(f.read())[1]) == 1
+    finally:
+        writer.close()
+
+
+def test_reads_version_1_logs():
+    header = np.array([(MAGIC, 1, RECORD_DTYPES[1].itemsize, 7)], dtype=HEADER_DTYPE)
+    records = np.array([(5, 0, 65, 12, KEY_DOWN, 0)], dtype=RECORD_DTYPES[1])
+    origin_ns, parsed = parse_keylog(header.tobytes() + records.tobytes())
+    assert origin_ns == 7
+    assert parsed['keycode'].tolist() == [65]
+    assert parsed['vk'].tolist() == [12]
+
+
+def test_truncated_record_is_ignored(tmp_path):
+    path = str(tmp_path / 'log.klog')
+    with KeylogWriter(path) as writer:
+        writer.write(1, 65)
+        writer.write(2, 66)
+    with open(path, 'rb') as f:
+        data = f.read()
+    assert len(parse_keylog(data[:-1])[1]) == 1
+    assert len(parse_keylog(data[:HEADER_SIZE])[1]) == 0
+
+
+def write_log(path, timestamps, keycodes=None, events=None):
+    keycodes = keycodes or [65] * len(timestamps)
+    events = events or [KEY_DOWN] * len(timestamps)
+    with KeylogWriter(str(path), origin_ns=0) as writer:
+        for timestamp, keycode, event in zip(timestamps, keycodes, events):
+            writer.write(round(timestamp * 1e9), keycode, event=event)
+    return str(path)
+
+
+def test_reader_matches_full_scan(tmp_path):
+    rng = np.random.default_rng(0)
+    timestamps = np.sort(rng.integers(0, 200, 500)) / 10.0
+    keycodes = rng.integers(-1, 90, 500).tolist()
+    events = rng.choice([KEY_DOWN, KEY_UP], 500).tolist()
+    path = write_log(tmp_path / 'log.klog', timestamps.tolist(), keycodes, events)
+    for stride in (1, 3, 16, 1024):
+        reader = KeylogReader.open(path, stride)
+        for start, end in [(-np.inf, np.inf), (0.0, 5.0), (3.3, 3.4), (5.0, 5.0), (19.0, 100.0), (-5.0, 0.1)]:
+            presses = reader.presses(start, end)
+            expected = [(t, k) for t, k, e in zip(timestamps.tolist(), keycodes, events)
+                        if start <= t < end and k >= 0 and e == KEY_DOWN]
+            assert list(zip(presses['timestamp'].tolist(), presses['keycode'].tolist())) == expected
+
+
+def test_reader_block_boundary_with_equal_timestamps(tmp_path):
+    path = write_log(tmp_path / 'log.klog', [1, 2, 3, 3, 3, 4])
+    reader = KeylogReader.open(path, stride=2)
+    assert reader.presses(3.0)['timestamp'].tolist() == [3, 3, 3, 4]
+
+    csv_path = tmp_path / 'log.csv'
+    csv_path.write_text("timestamp,keycode\n" + "".join(f"{t},65\n" for t in [1, 2, 3, 3, 3, 4]))
+    reader = KeylogReader.open(str(csv_path), stride=2)
+    assert reader.presses(3.0)['timestamp'].tolist() == [3, 3, 3, 4]
+
+
+def test_exported_csv_reads_like_binary(tmp_path):
+    path = write_log(tmp_path / 'log.klog', [1, 2, 3, 4], [65, 66, -1, 67], [KEY_DOWN, KEY_UP, KEY_DOWN, KEY_DOWN])
+    csv_path = str(tmp_path / 'log.csv')
+    export_csv(path, csv_path)
+    for stride in (1, 2, 1024):
+        binary = KeylogReader.open(path, stride).presses()
+        exported = KeylogReader.open(csv_path, stride).presses()
+        assert exported.tolist() == binary.tolist() == [(1.0, 65), (4.0, 67)]
+
+
+def test_csv_import_round_trip(tmp_path):
+    path = write_log(tmp_path / 'log.klog', [1, 2, 3], [65, 66, 67], [KEY_DOWN, KEY_UP, KEY_DOWN])
+    csv_path = str(tmp_path / 'log.csv')
+    export_csv(path, csv_path)
+    imported = str(tmp_path / 'imported.klog')
+    import_csv(csv_path, imported)
+    _, original = read_keylog(path)
+    _, records = read_keylog(imported)
+    for field in ('timestamp_ns', 'keycode', 'event'):
+        assert records[field].tolist() == original[field].tolist()
+
+
+def test_malformed_csv_line_raises_value_error(tmp_path):
+    csv_path = tmp_path / 'log.csv'
+    csv_path.write_text("timestamp,keycode\n1.0,65\n2.0,abc\n")
+    reader = KeylogReader.open(str(csv_path))
+    with pytest.raises(ValueError):
+        reader.presses()
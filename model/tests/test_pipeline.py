@@ -0,0 +1,106 @@
+import threading
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+
+from pipeline import Pipeline, FrameQueue, BLOCK, DROP_OLDEST, DROP_NEWEST
+
+
+class FakeCapture:
+    # Recording of `frames` black frames at 25 fps
+    def __init__(self, frames=20):
+        self.frames = frames
+        self.position = 0
+
+    def isOpened(self):
+        return True
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return self.frames
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            return self.position * 40.0
+        return 0
+
+    def read(self, buffer=None):
+        if self.position >= self.frames:
+            return False, None
+        self.position += 1
+        return True, np.zeros((48, 64, 3), np.uint8)
+
+
+class FakeHands:
+    def process(self, image):
+        return SimpleNamespace(multi_hand_landmarks=None, multi_handedness=None)
+
+
+class FakeDetector:
+    h_matrix = np.eye(3)
+
+    def update(self, landmarks, current_time, handedness=None):
+        return [('A', 0, 0)], []
+
+
+def run_pipeline(**kwargs):
+    pipeline = Pipeline(FakeCapture(), FakeHands(), FakeDetector(), live=False, drop_policy=BLOCK,
+                        verbose=False, **kwargs)
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(stats=pipeline.run()), daemon=True)
+    thread.start()
+    thread.join(5.0)
+    assert not thread.is_alive(), "pipeline hangs"
+    return result.get('stats'), pipeline
+
+
+def test_every_frame_is_processed():
+    presses = []
+    stats, _ = run_pipeline(on_press=lambda key, timestamp: presses.append(timestamp))
+    assert stats['frames_processed'] == stats['frames_captured'] == 20
+    assert presses == pytest.approx([i * 0.04 for i in range(1, 21)])
+
+
+def test_failing_callback_stops_run():
+    def on_frame(packet):
+        if packet['index'] == 3:
+            raise RuntimeError("callback failed")
+
+    pipeline = Pipeline(FakeCapture(), FakeHands(), FakeDetector(), live=False, drop_policy=BLOCK,
+                        verbose=False, on_frame=on_frame)
+    errors = []
+
+    def run():
+        try:
+            pipeline.run()
+        except RuntimeError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(5.0)
+    assert not thread.is_alive(), "pipeline hangs"
+    assert str(errors[0]) == "callback failed"
+
+
+def test_frame_queue_policies():
+    dropped = []
+    oldest = FrameQueue(2, DROP_OLDEST, dropped.append)
+    for item in range(4):
+        oldest.put(item)
+    assert [oldest.get(), oldest.get()] == [2, 3]
+    assert dropped == [0, 1]
+
+    newest = FrameQueue(2, DROP_NEWEST)
+    for item in range(4):
+        newest.put(item)
+    assert [newest.get(), newest.get()] == [0, 1]
+    assert newest.dropped == 2
+
+    # A blocking put gives up once the pipeline stops
+    stop = threading.Event()
+    blocking = FrameQueue(1, BLOCK)
+    assert blocking.put(0, stop)
+    stop.set()
+    assert not blocking.put(1, stop)
+    assert blocking.dropped == 1
@@ -0,0 +1,101 @@
+import numpy as np
+
+from press_detection import FingertipHistory, RateLimiter, HandTracker
+
+
+def test_history_keeps_newest_samples_in_order():
+    history = FingertipHistory(num_hands=2, num_fingers=5, capacity=3)
+    for t in range(5):
+        history.append(np.array([1]), np.array([2]), np.array([[t, 10 * t, t]], dtype=np.float64))
+    assert history.trajectory(1, 2)[:, 2].tolist() == [2, 3, 4]
+    assert history.newest(1, 2)[2] == 4
+    assert history.newest(1, 2, back=2)[2] == 2
+    assert history.oldest(1, 2)[2] == 2
+    assert history.is_full(1, 2)
+    # Other fingers are untouched
+    assert history.count[0, 2] == 0 and history.count[1, 1] == 0
+
+
+def test_history_before_full_and_after_clear():
+    history = FingertipHistory(capacity=5)
+    hands = np.array([0, 1])
+    fingers = np.array([3, 3])
+    history.append(hands, fingers, np.array([[0, 0, 1.0], [0, 0, 2.0]]))
+    history.append(hands, fingers, np.array([[0, 0, 3.0], [0, 0, 4.0]]))
+    assert history.oldest(hands, fingers)[:, 2].tolist() == [1.0, 2.0]
+    assert history.newest(hands, fingers)[:, 2].tolist() == [3.0, 4.0]
+    assert not history.is_full(hands, fingers).any()
+    history.clear(0)
+    assert history.count[0, 3] == 0 and history.count[1, 3] == 2
+    assert len(history.trajectory(0, 3)) == 0
+
+
+def test_history_kinematics():
+    history = FingertipHistory(capacity=5)
+    for t, y in [(0.0, 0.0), (0.1, 1.0)]:
+        history.append(0, 0, np.array([0.0, y, t]))
+    velocity, _ = history.kinematics(0, 0)
+    assert np.isnan(velocity).all()
+    history.append(0, 0, np.array([0.0, 3.0, 0.2]))
+    velocity, acceleration = history.kinematics(0, 0)
+    assert np.allclose(velocity, [0.0, 20.0])
+    assert np.allclose(acceleration, [0.0, 100.0])
+
+
+def test_rate_limiter_cooldown():
+    limiter = RateLimiter(max_events=2, window=1.0, cooldown=3.0)
+    for t in (0.0, 0.1):
+        limiter.record(t)
+    assert not limiter.update(0.2)
+    limiter.record(0.3)
+    assert limiter.update(0.4)
+    assert limiter.update(3.3)
+    assert not limiter.update(3.5)
+
+
+def test_rate_limiter_window_slides():
+    limiter = RateLimiter(max_events=2, window=1.0)
+    for t in (0.0, 0.5, 1.2, 1.7, 2.4):
+        limiter.record(t)
+        assert not limiter.update(t)
+
+
+def hand_at(x, y):
+    # 21 landmarks around (x, y)
+    return np.tile(np.array([x, y], dtype=np.float64), (21, 1))
+
+
+def test_hand_tracker_follows_hands_across_order_changes():
+    tracker = HandTracker(max_num_hands=2)
+    left, right = hand_at(100, 100), hand_at(400, 100)
+    slots, new_slots = tracker.assign(np.stack([left, right]), [('Left', 0.9), ('Right', 0.9)], 0.0)
+    assert sorted(new_slots) == [0, 1]
+    first = slots.tolist()
+
+    # MediaPipe reports the hands in the other order, both moved a bit
+    slots, new_slots = tracker.assign(np.stack([hand_at(410, 105), hand_at(95, 100)]),
+                                      [('Right', 0.9), ('Left', 0.9)], 0.033)
+    assert slots.tolist() == first[::-1]
+    assert new_slots == []
+
+
+def test_hand_tracker_starts_new_track_after_gap_or_jump():
+    tracker = HandTracker(max_num_hands=2, max_distance=150, max_gap=0.5)
+    slots, _ = tracker.assign(hand_at(100, 100)[None], None, 0.0)
+    slot = slots[0]
+    _, new_slots = tracker.assign(hand_at(110, 100)[None], None, 0.1)
+    assert new_slots == []
+    _, new_slots = tracker.assign(hand_at(110, 100)[None], None, 1.0)
+    assert new_slots == [slot]
+    _, new_slots = tracker.assign(hand_at(600, 100)[None], None, 1.1)
+    assert len(new_slots) == 1
+
+
+def test_hand_tracker_drops_duplicates_and_extra_hands():
+    tracker = HandTracker(max_num_hands=2, duplicate_distance=20)
+    landmarks = np.stack([hand_at(100, 100), hand_at(105, 100), hand_at(300, 100), hand_at(500, 100)])
+    handedness = [('Left', 0.5), ('Left', 0.9), ('Right', 0.8), ('Right', 0.7)]
+    slots, _ = tracker.assign(landmarks, handedness, 0.0)
+    # The less confident duplicate and the least confident extra hand get no slot
+    assert slots[0] == -1 and slots[3] == -1
+    assert sorted(slots[[1, 2]].tolist()) == [0, 1]
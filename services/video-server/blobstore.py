@@ -0,0 +1,116 @@
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+from collections import Counter
+
+#files are hashed in blocks of this size so memory stays bounded
+HASH_BLOCK = 1 << 20
+
+
+#content addressed file store: every file is stored once under the sha256 of its content,
+#uploading the same recording twice only keeps one copy
+class BlobStore:
+    #isReferenced(digest) tells if the database references the blob, it is asked right before
+    #a file is removed because an identical upload may have referenced it again meanwhile
+    def __init__(self, root, isReferenced=None):
+        self.root = root
+        self.isReferenced = isReferenced
+        os.makedirs(root, exist_ok=True)
+        #blobs in use by a running verification or an upload that isn't committed yet
+        #are only removed once released
+        self.pins = Counter()
+        self.doomed = set()
+        self.lock = threading.Lock()
+
+    #blobs are spread over 256 sub directories by the first byte of their hash
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    #moves the file at srcPath into the store and returns (digest, size)
+    #if the same content is already stored the new copy is discarded
+    #with pin the blob stays pinned until the caller committed its reference and unpins it
+    def putFile(self, srcPath, pin=False):
+        digest = hashlib.sha256()
+        size = 0
+        with open(srcPath, "rb") as f:
+            while True:
+                block = f.read(HASH_BLOCK)
+                if not block:
+                    break
+                digest.update(block)
+                size += len(block)
+        digest = digest.hexdigest()
+
+        path = self.path(digest)
+        #under the lock so a concurrent delete can't remove the blob this upload is reusing
+        with self.lock:
+            if os.path.exists(path):
+                os.remove(srcPath)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(srcPath, path)
+            if pin:
+                self.pins[digest] += 1
+        return digest, size
+
+    #stores the given bytes and returns (digest, size)
+    def putBytes(self, data, pin=False):
+        fd, tmpPath = tempfile.mkstemp(dir=self.root)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        return self.putFile(tmpPath, pin)
+
+    #read only memory map of the blob, the content is paged in on access instead of copied
+    #the caller closes it with closeMmap once done
+    def openMmap(self, digest):
+        with open(self.path(digest), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def closeMmap(self, data):
+        if isinstance(data, mmap.mmap):
+            try:
+                data.close()
+            except BufferError:
+                #an array still views the map, it is unmapped once that is garbage collected
+                pass
+
+    def pin(self, digest):
+        with self.lock:
+            self.pins[digest] += 1
+
+    def unpin(self, digest):
+        with self.lock:
+            self.pins[digest] -= 1
+            if self.pins[digest] > 0:
+                return
+            del self.pins[digest]
+            if digest in self.doomed:
+                self.doomed.discard(digest)
+                self.removeUnreferenced(digest)
+
+    #removes the blob, deferred while it is pinned
+    def delete(self, digest):
+        with self.lock:
+            if self.pins[digest] > 0:
+                self.doomed.add(digest)
+                return
+            self.removeUnreferenced(digest)
+
+    #caller holds the lock
+    def removeUnreferenced(self, digest):
+        if self.isReferenced is not None and self.isReferenced(digest):
+            return
+        self.removeFile(digest)
+
+    def removeFile(self, digest):
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            pass
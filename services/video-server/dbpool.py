@@ -0,0 +1,104 @@
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+#applied to every new connection
+#WAL lets readers continue while one request writes, NORMAL only syncs at checkpoints which is safe in WAL mode
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+]
+
+#every connection keeps this many compiled statements, the server only uses a few dozen
+STATEMENT_CACHE = 128
+
+
+#fixed size pool of SQLite connections shared by the request threads
+#connections stay open so their page cache and prepared statements are reused across requests
+class ConnectionPool:
+    def __init__(self, path, size=8, timeout=10.0, onQuery=None):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        #called as onQuery(sql, seconds) after every query executed through the pool
+        self.onQuery = onQuery
+        #LIFO so the most recently used (warmest) connection is handed out first
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        #autocommit mode, transactions are opened explicitly by transaction()
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                               check_same_thread=False, cached_statements=STATEMENT_CACHE)
+        conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    #returns an idle connection, opens a new one while the pool isn't full, otherwise waits
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            grow = self.created < self.size
+            if grow:
+                self.created += 1
+        if grow:
+            try:
+                return self.connect()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+        try:
+            return self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("no database connection available")
+
+    def release(self, conn):
+        #a request that failed mid transaction must not leak it to the next user
+        if conn.in_transaction:
+            conn.rollback()
+        self.idle.put(conn)
+
+    def execute(self, conn, sql, args=()):
+        start = time.perf_counter()
+        try:
+            return conn.execute(sql, args)
+        finally:
+            if self.onQuery is not None:
+                self.onQuery(sql, time.perf_counter() - start)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+            with self.lock:
+                self.created -= 1
+
+
+#runs the enclosed statements in one write transaction, committed at the end or rolled back on error
+#nested use joins the outer transaction
+@contextmanager
+def transaction(conn):
+    if conn.in_transaction:
+        yield conn
+        return
+    #IMMEDIATE takes the write lock up front so two writers can't deadlock upgrading a read lock
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
@@ -1,9 +1,23 @@
 CREATE TABLE videoData (
     playerID INTEGER PRIMARY KEY,
-    videoData BLOB
+    blobHash TEXT NOT NULL
 );
 
 CREATE TABLE inputData ( 
     playerID INTEGER PRIMARY KEY,
-    inputData BLOB
+    blobHash TEXT NOT NULL
+);
+
+CREATE TABLE blobs (
+    blobHash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL
+);
+
+CREATE TABLE uploads (
+    uploadID TEXT PRIMARY KEY,
+    playerID INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL,
+    received INTEGER NOT NULL
 );
\ No newline at end of file
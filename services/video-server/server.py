@@ -3,14 +3,19 @@ from werkzeug.utils import secure_filename
 import base64
 import sqlite3
 import logging
-import csv
-from io import StringIO
+import os
+import uuid
 
-app = Flask(__name__)
+from verification import getCorners, getEvents, getLayout, getInputData, VerificationPool, StreamingSessions, PENDING, UNKNOWN
+from blobstore import BlobStore
+from dbpool import ConnectionPool, transaction
 
+app = Flask(__name__)
 
-csvTime = "timestamp"
-csvKey = "keycode"
+#number of verification worker processes, defaults to the number of cores
+VERIFY_WORKERS = int(os.environ.get("VERIFY_WORKERS", os.cpu_count() or 1))
+#longest a client can block on GET /verify/<jobID>
+MAX_WAIT = 30.0
 
 #returns if given playerID is a valid ID
 def isID(playerID):
@@ -25,105 +30,336 @@ def isID(playerID):
 
 #SQLite3 Database for storing intermidiate information until video and inputs are send
 DATABASE = "database.db"
-
-insertVideoSQL = 'REPLACE INTO videoData (playerID, videoData) VALUES(?, ?)'
-insertInputSQL = 'REPLACE INTO inputData (playerID, inputData) VALUES(?, ?)'
+#number of pooled database connections, should match the number of request threads
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))
+#queries slower than this many seconds are logged
+SLOW_QUERY = 0.05
+
+#only the content hash is stored in the database, the files themselves live in the blob store
+insertVideoSQL = 'REPLACE INTO videoData (playerID, blobHash) VALUES(?, ?)'
+insertInputSQL = 'REPLACE INTO inputData (playerID, blobHash) VALUES(?, ?)'
 requestVideoSQL = 'SELECT * FROM videoData WHERE playerID = ?'
 requestInputSQL = 'SELECT * FROM inputData WHERE playerID = ?'
 deleteVideoSQL = 'DELETE FROM videoData WHERE playerID = ?'
 deleteInputSQL = 'DELETE FROM inputData WHERE playerID = ?'
-
-#Gets only called once to create initial database
+insertUploadSQL = 'INSERT INTO uploads (uploadID, playerID, kind, path, received) VALUES(?, ?, ?, ?, 0)'
+requestUploadSQL = 'SELECT * FROM uploads WHERE uploadID = ?'
+updateUploadSQL = 'UPDATE uploads SET received = ? WHERE uploadID = ?'
+deleteUploadSQL = 'DELETE FROM uploads WHERE uploadID = ?'
+insertBlobSQL = 'INSERT OR IGNORE INTO blobs (blobHash, size, refs) VALUES(?, ?, 0)'
+refBlobSQL = 'UPDATE blobs SET refs = refs + ? WHERE blobHash = ?'
+requestBlobSQL = 'SELECT * FROM blobs WHERE blobHash = ?'
+deleteBlobSQL = 'DELETE FROM blobs WHERE blobHash = ?'
+
+#directory the uploaded files are streamed to until they are complete
+UPLOAD_DIR = "uploads"
+#directory of the content addressed blob store
+BLOB_DIR = "blobs"
+#request bodies are streamed to disk in blocks of this size
+STREAM_BLOCK = 1 << 20
+#upload kind => (insert, request, delete) statement of its table
+UPLOAD_KINDS = {
+    "video": (insertVideoSQL, requestVideoSQL, deleteVideoSQL),
+    "inputs": (insertInputSQL, requestInputSQL, deleteInputSQL),
+}
+
+#creates the database from schema.sql, getDbPool() calls it when the database file is missing
 #from server import init_db
 #init_db()
 
 def init_db():
-    with app.app_context():
-        db = get_db()
-        with app.open_resource('schema.sql', mode='r') as f:
-            db.cursor().executescript(f.read())
+    with app.open_resource('schema.sql', mode='r') as f:
+        schema = f.read()
+    db = sqlite3.connect(DATABASE)
+    try:
+        db.executescript(schema)
         db.commit()
+    finally:
+        db.close()
 
 
-#get database connection
+#get database connection, borrowed from the pool until the request context ends
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
+        db = g._database = getDbPool().acquire()
     return db
 
 def query_db(query, args=(), one=False):
-    cur = get_db().execute(query, args)
+    cur = getDbPool().execute(get_db(), query, args)
     rv = cur.fetchall()
     cur.close()
     return (rv[0] if rv else None) if one else rv
 
+#statements run inside `with transaction(get_db()):` are committed together
 def insert_db(query, args=()):
-    conn= get_db()
-    cur = conn.cursor()
-    try:
-        cur.execute(query, args)
-        conn.commit()
-    except:
-        app.logger.warning("sql error while inserting")
+    write_db(query, args, "inserting")
 
 def delete_db(query, args=()):
+    write_db(query, args, "deleting")
+
+#a failing statement of a batch is raised so the outer transaction() rolls the whole batch back,
+#only a statement run on its own logs the error and carries on
+def write_db(query, args, action):
     conn = get_db()
-    cur = conn.cursor()
+    if conn.in_transaction:
+        getDbPool().execute(conn, query, args)
+        return
     try:
-        cur.execute(query, args)
-        conn.commit()
-    except:
-        app.logger.warning("sql error while deleting")
+        with transaction(conn):
+            getDbPool().execute(conn, query, args)
+    except sqlite3.Error:
+        app.logger.warning("sql error while %s", action)
+
+#metrics hook of the connection pool
+def logQuery(query, seconds):
+    if seconds > SLOW_QUERY:
+        app.logger.warning("slow query (%.1f ms): %s", seconds * 1000, query)
+
+
+#the pool is created on first use so importing the server doesn't fork workers
+_pool = None
+_store = None
+_dbPool = None
+
+def getDbPool():
+    global _dbPool
+    if _dbPool is None:
+        if not os.path.exists(DATABASE):
+            init_db()
+        _dbPool = ConnectionPool(DATABASE, DB_POOL_SIZE, onQuery=logQuery)
+    return _dbPool
+
+def getStore():
+    global _store
+    if _store is None:
+        _store = BlobStore(BLOB_DIR, blobReferenced)
+    return _store
+
+#asked by the store under its lock before removing a file, on an own connection so it never
+#waits for a pooled one that a request holds while it waits for the store
+def blobReferenced(digest):
+    conn = getDbPool().connect()
+    try:
+        return conn.execute(requestBlobSQL, [digest]).fetchone() is not None
+    finally:
+        conn.close()
 
-    
+#sessions of games that are verified while they are played
+streams = StreamingSessions()
+
+def getPool():
+    global _pool
+    if _pool is None:
+        _pool = VerificationPool(VERIFY_WORKERS)
+    return _pool
 
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        getDbPool().release(db)
 
 
 
-@app.route("/video", methods=['POST'])
-def upload_video():
+#makes the stored blob the players current file of the given kind, returns false if the database failed
+def storeFile(kind, playerID, digest, size):
+    insertSQL, requestSQL, _ = UPLOAD_KINDS[kind]
+    try:
+        with transaction(get_db()):
+            old = query_db(requestSQL, [playerID], one=True)
+            if old is not None and old['blobHash'] == digest:
+                return True
+            insert_db(insertBlobSQL, [digest, size])
+            insert_db(refBlobSQL, [1, digest])
+            insert_db(insertSQL, [playerID, digest])
+            orphan = old is not None and releaseBlob(old['blobHash'])
+    except sqlite3.Error:
+        app.logger.warning("sql error while storing %s of player %s", kind, playerID)
+        return False
+    #files are only removed once the database no longer references them
+    if orphan:
+        getStore().delete(old['blobHash'])
+    return True
+
+#drops the players current file of the given kind, returns the blob hash if it is now unreferenced
+#the caller deletes it from the store after committing
+def deleteFile(kind, playerID):
+    _, requestSQL, deleteSQL = UPLOAD_KINDS[kind]
+    old = query_db(requestSQL, [playerID], one=True)
+    if old is None:
+        return None
+    delete_db(deleteSQL, [playerID])
+    if releaseBlob(old['blobHash']):
+        return old['blobHash']
+    return None
+
+#removes a reference to the blob, returns true if nobody references it anymore
+def releaseBlob(digest):
+    insert_db(refBlobSQL, [-1, digest])
+    blob = query_db(requestBlobSQL, [digest], one=True)
+    if blob is not None and blob['refs'] <= 0:
+        delete_db(deleteBlobSQL, [digest])
+        return True
+    return False
+
+#base64 json upload, only meant for small files, large ones should use /upload
+def uploadB64(kind):
     requestJson = request.get_json()
     if 'fileContent' not in requestJson:
         return  {"Error": "no file content"}
     fileContentB64 = requestJson['fileContent']
-    
+
     if 'playerID' not in requestJson:
         return {"Error": "no playerID"}
-    
+
     playerID = requestJson['playerID']
     if not isID(playerID):
         return {"Error": "no valid playerID"}
-    
+
     playerID = int(playerID)
 
-    insert_db(insertVideoSQL, [playerID, fileContentB64])
+    try:
+        fileContent = base64.b64decode(fileContentB64)
+    except:
+        return {"Error": "data was not in b64 format"}
+
+    #pinned until the database references it
+    store = getStore()
+    digest, size = store.putBytes(fileContent, pin=True)
+    try:
+        if not storeFile(kind, playerID, digest, size):
+            store.delete(digest)
+            return {"Error": "could not store file"}
+    finally:
+        store.unpin(digest)
     return {"Error": "no Error"}
 
+@app.route("/video", methods=['POST'])
+def upload_video():
+    return uploadB64("video")
+
 @app.route("/inputs", methods=['POST'])
 def upload_inputs():
-    requestJson = request.get_json()
-    if 'fileContent' not in requestJson:
-        return {"Error": "no file content"}
-    fileContentB64 = requestJson['fileContent']
+    return uploadB64("inputs")
 
+#returns the key presses of the players stored input log with start <= timestamp < end,
+#only the part of the log around the range is read
+@app.route("/inputs/<playerID>", methods=['GET'])
+def read_inputs(playerID):
+    if not isID(playerID):
+        return {"Error": "no valid playerID"}
+    try:
+        start = float(request.args.get('start', '-inf'))
+        end = float(request.args.get('end', 'inf'))
+    except ValueError:
+        return {"Error": "no valid time range"}
+
+    inputData = query_db(requestInputSQL, [int(playerID)], one=True)
+    if inputData is None:
+        return {"Error": "no input data"}
+    store = getStore()
+    digest = inputData['blobHash']
+    store.pin(digest)
+    data = store.openMmap(digest)
+    try:
+        keystrokes = getInputData(data, start, end)
+    finally:
+        store.closeMmap(data)
+        store.unpin(digest)
+    if keystrokes is None:
+        return {"Error": "data was not in csv or keystroke log format"}
+    return {"keystrokes": list(zip(keystrokes['timestamp'].tolist(), keystrokes['keycode'].tolist())),
+            "Error": "no Error"}
+
+#starts a resumable upload, the file is then sent in binary chunks to PUT /upload/<uploadID>
+@app.route("/upload", methods=['POST'])
+def start_upload():
+    requestJson = request.get_json()
     if 'playerID' not in requestJson:
         return {"Error": "no playerID"}
-    
     playerID = requestJson['playerID']
     if not isID(playerID):
         return {"Error": "no valid playerID"}
-    
     playerID = int(playerID)
 
-    insert_db(insertInputSQL, [playerID, fileContentB64])
+    kind = requestJson.get('kind')
+    if kind not in UPLOAD_KINDS:
+        return {"Error": "no valid kind"}
+
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    uploadID = uuid.uuid4().hex
+    path = os.path.join(UPLOAD_DIR, uploadID + ".part")
+    open(path, "wb").close()
+    insert_db(insertUploadSQL, [uploadID, playerID, kind, path])
+    return {"uploadID": uploadID, "Error": "no Error"}
+
+#returns how many bytes arrived so far, a client resumes from there
+@app.route("/upload/<uploadID>", methods=['GET'])
+def upload_status(uploadID):
+    upload = query_db(requestUploadSQL, [uploadID], one=True)
+    if upload is None:
+        return {"Error": "unknown uploadID"}
+    return {"offset": upload['received'], "Error": "no Error"}
+
+#appends the raw request body at the offset given in the Upload-Offset header,
+#the body is streamed to disk so memory stays bounded for any chunk size
+@app.route("/upload/<uploadID>", methods=['PUT'])
+def upload_chunk(uploadID):
+    upload = query_db(requestUploadSQL, [uploadID], one=True)
+    if upload is None:
+        return {"Error": "unknown uploadID"}
+
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return {"Error": "no valid Upload-Offset"}
+    received = upload['received']
+    if offset != received:
+        return {"Error": "wrong offset", "offset": received}
+
+    try:
+        f = open(upload['path'], "r+b")
+    except FileNotFoundError:
+        return {"Error": "upload file missing"}
+    with f:
+        f.seek(offset)
+        try:
+            while True:
+                block = request.stream.read(STREAM_BLOCK)
+                if not block:
+                    break
+                f.write(block)
+                received += len(block)
+        finally:
+            #keeps whatever arrived if the client disconnects, it can resume from there
+            f.truncate(received)
+            insert_db(updateUploadSQL, [received, uploadID])
+    return {"offset": received, "Error": "no Error"}
+
+#finishes the upload, the file becomes the players current video or input file
+@app.route("/upload/<uploadID>/complete", methods=['POST'])
+def complete_upload(uploadID):
+    upload = query_db(requestUploadSQL, [uploadID], one=True)
+    if upload is None:
+        return {"Error": "unknown uploadID"}
+
+    #identical uploads end up as the same blob
+    store = getStore()
+    try:
+        digest, size = store.putFile(upload['path'], pin=True)
+    except FileNotFoundError:
+        return {"Error": "upload file missing"}
+    #the part file is gone either way, so the upload can't be resumed or completed again
+    delete_db(deleteUploadSQL, [uploadID])
+    try:
+        if not storeFile(upload['kind'], upload['playerID'], digest, size):
+            #removed once unpinned unless another player references the same content
+            store.delete(digest)
+            return {"Error": "could not store file"}
+    finally:
+        store.unpin(digest)
     return {"Error": "no Error"}
 
 @app.route("/verify", methods=['POST'])
@@ -136,115 +372,107 @@ def verify():
         return {"Error": "no valid playerID"}
     playerID = int(playerID)
 
+    #the four keyboard corners (top-left, top-right, bottom-right, bottom-left) calibrated for the recording,
+    #without them the workers detect the keyboard in the video
+    corners = None
+    if requestJson.get('corners') is not None:
+        corners = getCorners(requestJson['corners'])
+        if corners is None:
+            return {"Error": "no valid keyboard corners"}
+
+    #keyboard layout of the recording, the model and the key distances depend on it
+    layout = getLayout(requestJson.get('layout'))
+    if layout is None:
+        return {"Error": "no valid layout"}
+
     videoData = query_db(requestVideoSQL, [playerID])
     inputData = query_db(requestInputSQL, [playerID])
 
     if len(videoData) != 1 or len(inputData) != 1:
         #optionally delete the already existing entrys of video or input data (can also be kept because with new upload the old one gets replaced)
-        delete_db(deleteVideoSQL, [playerID])
-        delete_db(deleteInputSQL, [playerID])
+        try:
+            with transaction(get_db()):
+                orphans = [deleteFile("video", playerID), deleteFile("inputs", playerID)]
+        except sqlite3.Error:
+            app.logger.warning("sql error while deleting files of player %s", playerID)
+            orphans = []
+        for digest in orphans:
+            if digest is not None:
+                getStore().delete(digest)
         return {"Error": "cant verify need one video and one input"}
-    videoData = videoData[0]['videoData']
-    inputData = inputData[0]['inputData']
+    store = getStore()
+    videoHash = videoData[0]['blobHash']
+    inputHash = inputData[0]['blobHash']
+    if not store.exists(videoHash) or not store.exists(inputHash):
+        return {"Error": "uploaded files are missing"}
+
+    #the workers decode the video straight from the store, the input log is memory mapped
+    #both stay in the store until the job is done even if the player uploads new files
+    store.pin(videoHash)
+    store.pin(inputHash)
+    inputData = store.openMmap(inputHash)
+
+    def release():
+        store.closeMmap(inputData)
+        store.unpin(videoHash)
+        store.unpin(inputHash)
+
+    #the analysis runs in the worker pool, the client polls /verify/<jobID> for the result
+    jobID = getPool().submit(playerID, store.path(videoHash), inputData, corners, layout, release)
+    return {"jobID": jobID, "Error": "no Error"}
+
+@app.route("/verify/<jobID>", methods=['GET'])
+def verify_result(jobID):
+    #optionally wait up to `wait` seconds for the job to finish
     try:
-        videoData = base64.b64decode(videoData)
-        inputData = base64.b64decode(inputData)
-    except:
-        return {"Error": "data was not in b64 format"}
-    
-    #extract csv from inputData
-    csvInputData = getCsv(inputData)
-    if csvInputData == None:
-        return {"Error": "data was not in csv format"}
-    
-    #has to be implemented calling the ml model with the video data and returning list of dicts
-    videoData = getVideoData(videoData)
-    if videoData == None:
-        return {"Error": "video data was not in the right format"}
-    
-    videoData, inputData = convertData(videoData, inputData)
-    if videoData is None or inputData is None:
-        return {"Error": "video and input data cant be parsed"}
-
-    if not match(videoData, inputData):
-        return {"Error": "video and input data didnt match"}
-
-    score = simulateGame(inputData)
-    sig = signScore(playerID, score)
-
-    return {"Signature": sig, "Error": "no Error"}
-
-
-#checks for float conversions
-def convertData(videoData, inputData):
-    nvideoData = []
-    ninputData = []
-    for row in videoData:
-        try:
-            nvideoData.append((float(row[csvTime]),int(row[csvKey])))
-        except:
-            return None,None
-    for row in inputData:
-        try:
-            ninputData.append((float(row[csvTime]),int(row[csvKey])))
-        except:
-            return None,None
-    return nvideoData, ninputData
-
-
-#returns true if video and input data match
-def match(videoData, inputData):
-
-    #can also be made fancy by adding how long the distance between keys are
-    wrongKeys = 0
-    #can be made fancy by punishing times not linearly 
-    timeOffset = 0.0
-    sizeV = len(videoData)
-    sizeI = len(inputData)
-
-    itSize = min(sizeV, sizeI)
-    for i in range(0,itSize-1):
-        timeDiffV = videoData[i+1][0] - videoData[i][0]
-        timeDiffI = inputData[i+1][0] - inputData[i][0]
-        timeOffset += abs(timeDiffI - timeDiffV)
-
-        if videoData[i][1] != inputData[i][1]:
-            wrongKeys += 1
-
-    return rating(wrongKeys, timeOffset, itSize)
-
-
-#can be made really fancy!!!
-#here one avg missed second equals one avg wrong key
-def rating(wrongKeys, timeOffset, itSize):
-    timeOffsetAvg = timeOffset/itSize
-    wrongKeysAvg = wrongKeysAvg/itSize
-
-    if wrongKeysAvg > 0.2:
-        return False
-    if timeOffsetAvg > 500:
-        return False
-    return True
+        wait = min(float(request.args.get('wait', 0)), MAX_WAIT)
+    except ValueError:
+        return {"Error": "no valid wait time"}
+
+    status, result = getPool().result(jobID, wait)
+    if status == UNKNOWN:
+        return {"Error": "unknown jobID"}
+    if status == PENDING:
+        return {"Status": PENDING, "Error": "no Error"}
+    return result
+
+#starts an incremental verification, keystrokes are then appended with POST /stream/<sessionID>
+@app.route("/stream", methods=['POST'])
+def start_stream():
+    requestJson = request.get_json()
+    if 'playerID' not in requestJson:
+        return {"Error": "no playerID"}
+    playerID = requestJson['playerID']
+    if not isID(playerID):
+        return {"Error": "no valid playerID"}
+    playerID = int(playerID)
 
-#returns the score of the game simulated by the inputData
-def simulateGame(inputData):
-    return 0
+    layout = getLayout(requestJson.get('layout'))
+    if layout is None:
+        return {"Error": "no valid layout"}
 
-#signs the string playerID:score with the private key of the Server
-def signScore(playerID, score):
-    return ""
+    sessionID = streams.create(playerID, layout)
+    return {"sessionID": sessionID, "Error": "no Error"}
 
-def getCsv(inputData):
-    try:
-        inputData = inputData.decode("utf-8")
-        #string gets interpreted as file for csv parser
-        f = StringIO(inputData)
-        reader = csv.DictReader(f, delimiter=",")
-        if csvKey not in reader.fieldnames or csvTime not in reader.fieldnames:
-            return None
-        return reader
-    except:
-        return None
+#appends the new keystrokes since the last call, both as lists of [timestamp, keycode]
+#'video' are the keystrokes the ml model detected, 'inputs' the ones the keyboard logged
+@app.route("/stream/<sessionID>", methods=['POST'])
+def append_stream(sessionID):
+    session = streams.get(sessionID)
+    if session is None:
+        return {"Error": "unknown sessionID"}
 
-def getVideoData(videoData):
-    return [{"test": 1}, {"test2": 2}]
\ No newline at end of file
+    requestJson = request.get_json()
+    videoData = getEvents(requestJson.get('video', []))
+    inputData = getEvents(requestJson.get('inputs', []))
+    if videoData is None or inputData is None:
+        return {"Error": "keystrokes need to be [timestamp, keycode] pairs"}
+    return session.append(videoData, inputData)
+
+#ends the session and returns the verdict, only the keystrokes since the last append are left to align
+@app.route("/stream/<sessionID>/finish", methods=['POST'])
+def finish_stream(sessionID):
+    session = streams.pop(sessionID)
+    if session is None:
+        return {"Error": "unknown sessionID"}
+    return session.finish()
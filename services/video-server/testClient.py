@@ -14,12 +14,48 @@ def insertInput(id, content):
     r = requests.post('http://127.0.0.1:5000/inputs', json=json)
     print(r.text)
 
+#resumable chunked binary upload, kind is 'video' or 'inputs'
+def uploadFile(id, kind, content, chunkSize=1 << 20):
+    r = requests.post('http://127.0.0.1:5000/upload', json={'playerID': id, 'kind': kind})
+    uploadID = r.json()['uploadID']
+    offset = 0
+    while offset < len(content):
+        chunk = content[offset:offset + chunkSize]
+        r = requests.put('http://127.0.0.1:5000/upload/' + uploadID, data=chunk,
+                         headers={'Upload-Offset': str(offset)})
+        offset = r.json()['offset']
+    r = requests.post('http://127.0.0.1:5000/upload/' + uploadID + '/complete')
+    print(r.text)
+
 def verify(id):
-    json = {'playerID': id}
+    json = {'playerID': id, 'corners': [[100, 300], [540, 300], [560, 460], [80, 460]]}
     r = requests.post('http://127.0.0.1:5000/verify', json=json)
     print(r.text)
+    jobID = r.json().get('jobID')
+    if jobID is None:
+        return
+    #long-wait for the verification result
+    while True:
+        r = requests.get('http://127.0.0.1:5000/verify/' + jobID, params={'wait': 10})
+        if r.json().get('Status') != 'pending':
+            break
+    print(r.text)
+
+#incremental verification, keystrokes are sent while the game runs
+def stream(id, video, inputs, batch=2):
+    r = requests.post('http://127.0.0.1:5000/stream', json={'playerID': id})
+    sessionID = r.json()['sessionID']
+    for i in range(0, max(len(video), len(inputs)), batch):
+        r = requests.post('http://127.0.0.1:5000/stream/' + sessionID,
+                          json={'video': video[i:i + batch], 'inputs': inputs[i:i + batch]})
+        print(r.text)
+    r = requests.post('http://127.0.0.1:5000/stream/' + sessionID + '/finish')
+    print(r.text)
 
 
 insertVideo(20, b'lalalaafsfsdfslal')
 insertInput(20, b'lalalaaaaaaa')
-verify(20)
\ No newline at end of file
+uploadFile(20, 'video', b'lalalaafsfsdfslal' * 100000)
+uploadFile(20, 'inputs', b'timestamp,keycode\n1.0,65\n')
+verify(20)
+stream(20, [[0.0, 65], [0.4, 66], [0.9, 67]], [[100.0, 65], [100.4, 66], [100.9, 67]])
\ No newline at end of file
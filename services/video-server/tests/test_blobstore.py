@@ -0,0 +1,69 @@
+import os
+
+from blobstore import BlobStore
+
+
+def test_identical_content_is_stored_once(tmp_path):
+    store = BlobStore(str(tmp_path))
+    first, size = store.putBytes(b"recording")
+    second, _ = store.putBytes(b"recording")
+    assert first == second
+    assert size == len(b"recording")
+    with open(store.path(first), "rb") as f:
+        assert f.read() == b"recording"
+    #only the blob itself is left, no temporary copies
+    assert sorted(os.listdir(str(tmp_path))) == [first[:2]]
+
+def test_delete_is_deferred_while_pinned(tmp_path):
+    store = BlobStore(str(tmp_path))
+    digest, _ = store.putBytes(b"recording")
+    store.pin(digest)
+    store.pin(digest)
+    store.delete(digest)
+    assert store.exists(digest)
+    store.unpin(digest)
+    assert store.exists(digest)
+    store.unpin(digest)
+    assert not store.exists(digest)
+
+def test_unpin_without_delete_keeps_blob(tmp_path):
+    store = BlobStore(str(tmp_path))
+    digest, _ = store.putBytes(b"recording")
+    store.pin(digest)
+    store.unpin(digest)
+    assert store.exists(digest)
+
+def test_referenced_blob_is_not_removed(tmp_path):
+    referenced = set()
+    store = BlobStore(str(tmp_path), lambda digest: digest in referenced)
+    digest, _ = store.putBytes(b"recording")
+    #an identical upload referenced the blob again after the old reference was dropped
+    referenced.add(digest)
+    store.delete(digest)
+    assert store.exists(digest)
+    referenced.clear()
+    store.delete(digest)
+    assert not store.exists(digest)
+
+def test_pinned_put_survives_concurrent_delete(tmp_path):
+    referenced = set()
+    store = BlobStore(str(tmp_path), lambda digest: digest in referenced)
+    digest, _ = store.putBytes(b"recording")
+    #a second upload of the same content reuses the file, the first owner deletes it
+    #before the second upload committed its reference
+    store.putBytes(b"recording", pin=True)
+    store.delete(digest)
+    referenced.add(digest)
+    store.unpin(digest)
+    assert store.exists(digest)
+
+def test_mmap(tmp_path):
+    store = BlobStore(str(tmp_path))
+    digest, _ = store.putBytes(b"keystrokes")
+    data = store.openMmap(digest)
+    assert data[:4] == b"keys"
+    store.closeMmap(data)
+    assert data.closed
+    empty, _ = store.putBytes(b"")
+    assert store.openMmap(empty) == b""
+    store.closeMmap(b"")
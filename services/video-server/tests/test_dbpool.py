@@ -0,0 +1,62 @@
+import sqlite3
+
+import pytest
+
+from dbpool import ConnectionPool, transaction
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = ConnectionPool(str(tmp_path / "test.db"), size=2)
+    conn = pool.acquire()
+    conn.execute("CREATE TABLE items (name TEXT PRIMARY KEY)")
+    pool.release(conn)
+    yield pool
+    pool.close()
+
+def names(pool):
+    conn = pool.acquire()
+    try:
+        return [row["name"] for row in conn.execute("SELECT name FROM items ORDER BY name")]
+    finally:
+        pool.release(conn)
+
+def test_transaction_commits(pool):
+    conn = pool.acquire()
+    with transaction(conn):
+        conn.execute("INSERT INTO items VALUES ('a')")
+        conn.execute("INSERT INTO items VALUES ('b')")
+    assert not conn.in_transaction
+    pool.release(conn)
+    assert names(pool) == ["a", "b"]
+
+def test_nested_transaction_joins_outer(pool):
+    conn = pool.acquire()
+    with pytest.raises(sqlite3.IntegrityError):
+        with transaction(conn):
+            conn.execute("INSERT INTO items VALUES ('a')")
+            with transaction(conn):
+                conn.execute("INSERT INTO items VALUES ('b')")
+            #the inner block didn't commit, the failure rolls both back
+            conn.execute("INSERT INTO items VALUES ('a')")
+    assert not conn.in_transaction
+    pool.release(conn)
+    assert names(pool) == []
+
+def test_release_rolls_back_open_transaction(pool):
+    conn = pool.acquire()
+    conn.execute("BEGIN")
+    conn.execute("INSERT INTO items VALUES ('a')")
+    pool.release(conn)
+    assert names(pool) == []
+
+def test_pool_size_is_bounded(pool):
+    pool.timeout = 0.01
+    first = pool.acquire()
+    second = pool.acquire()
+    with pytest.raises(sqlite3.OperationalError):
+        pool.acquire()
+    pool.release(first)
+    assert pool.acquire() is first
+    pool.release(first)
+    pool.release(second)
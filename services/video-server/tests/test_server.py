@@ -0,0 +1,136 @@
+import hashlib
+import os
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "DATABASE", str(tmp_path / "database.db"))
+    monkeypatch.setattr(server, "BLOB_DIR", str(tmp_path / "blobs"))
+    monkeypatch.setattr(server, "UPLOAD_DIR", str(tmp_path / "uploads"))
+    monkeypatch.setattr(server, "_dbPool", None)
+    monkeypatch.setattr(server, "_store", None)
+    yield server.app
+    server.getDbPool().close()
+
+def test_missing_database_is_created_from_schema(app):
+    with app.app_context():
+        assert rows("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name") == [
+            ("blobs",), ("inputData",), ("uploads",), ("videoData",)]
+
+def rows(sql):
+    return [tuple(row) for row in server.query_db(sql)]
+
+def test_store_file_references_blob(app):
+    with app.app_context():
+        digest, size = server.getStore().putBytes(b"video")
+        assert server.storeFile("video", 1, digest, size)
+        assert rows("SELECT playerID, blobHash FROM videoData") == [(1, digest)]
+        assert rows("SELECT blobHash, refs FROM blobs") == [(digest, 1)]
+
+def test_failed_statement_rolls_back_batch(app, monkeypatch):
+    failing = "REPLACE INTO missingTable (playerID, blobHash) VALUES(?, ?)"
+    monkeypatch.setitem(server.UPLOAD_KINDS, "video", (failing,) + server.UPLOAD_KINDS["video"][1:])
+    with app.app_context():
+        digest, size = server.getStore().putBytes(b"video")
+        assert not server.storeFile("video", 1, digest, size)
+        #the blob reference must not be committed without the player row
+        assert rows("SELECT * FROM blobs") == []
+        assert not server.get_db().in_transaction
+
+def test_single_statement_errors_are_logged(app):
+    with app.app_context():
+        server.insert_db("INSERT INTO missingTable VALUES(?)", [1])
+        assert not server.get_db().in_transaction
+
+def test_replaced_file_is_removed_once_unreferenced(app):
+    with app.app_context():
+        store = server.getStore()
+        old, size = store.putBytes(b"old")
+        assert server.storeFile("video", 1, old, size)
+        assert server.storeFile("video", 2, old, size)
+        new, size = store.putBytes(b"new")
+        assert server.storeFile("video", 1, new, size)
+        assert store.exists(old)
+        assert server.storeFile("video", 2, new, size)
+        assert not store.exists(old)
+        assert rows("SELECT blobHash, refs FROM blobs") == [(new, 2)]
+
+def test_delete_keeps_blob_referenced_again(app):
+    with app.app_context():
+        store = server.getStore()
+        digest, size = store.putBytes(b"video")
+        assert server.storeFile("video", 1, digest, size)
+        #the reference is committed before the store is asked to delete the file
+        assert server.storeFile("video", 2, digest, size)
+        store.delete(digest)
+        assert store.exists(digest)
+
+def startUpload(client, kind="video"):
+    return client.post("/upload", json={"playerID": 1, "kind": kind}).get_json()["uploadID"]
+
+def putChunk(client, uploadID, offset, data):
+    return client.put("/upload/" + uploadID, data=data, headers={"Upload-Offset": str(offset)}).get_json()
+
+def blobFiles():
+    return [name for _, _, files in os.walk(server.BLOB_DIR) for name in files]
+
+def test_chunked_upload(app):
+    client = app.test_client()
+    uploadID = startUpload(client)
+    assert putChunk(client, uploadID, 0, b"abc") == {"offset": 3, "Error": "no Error"}
+    assert putChunk(client, uploadID, 3, b"def") == {"offset": 6, "Error": "no Error"}
+    assert client.post("/upload/" + uploadID + "/complete").get_json() == {"Error": "no Error"}
+    with app.app_context():
+        digest = rows("SELECT blobHash FROM videoData WHERE playerID = 1")[0][0]
+        assert digest == hashlib.sha256(b"abcdef").hexdigest()
+        assert rows("SELECT * FROM uploads") == []
+    assert client.get("/upload/" + uploadID).get_json() == {"Error": "unknown uploadID"}
+
+def test_resume_from_reported_offset(app):
+    client = app.test_client()
+    uploadID = startUpload(client)
+    putChunk(client, uploadID, 0, b"abc")
+    offset = client.get("/upload/" + uploadID).get_json()["offset"]
+    assert offset == 3
+    assert putChunk(client, uploadID, offset, b"def")["offset"] == 6
+
+def test_wrong_upload_offset(app):
+    client = app.test_client()
+    uploadID = startUpload(client)
+    putChunk(client, uploadID, 0, b"abc")
+    assert putChunk(client, uploadID, 0, b"abc") == {"Error": "wrong offset", "offset": 3}
+    assert putChunk(client, uploadID, 5, b"abc") == {"Error": "wrong offset", "offset": 3}
+    assert client.put("/upload/" + uploadID, data=b"abc").get_json() == {"Error": "no valid Upload-Offset"}
+    assert client.get("/upload/" + uploadID).get_json()["offset"] == 3
+
+def test_failed_complete_leaves_nothing_behind(app, monkeypatch):
+    client = app.test_client()
+    uploadID = startUpload(client)
+    putChunk(client, uploadID, 0, b"abc")
+    monkeypatch.setattr(server, "storeFile", lambda *args: False)
+    assert client.post("/upload/" + uploadID + "/complete").get_json() == {"Error": "could not store file"}
+    assert blobFiles() == []
+    assert putChunk(client, uploadID, 3, b"def") == {"Error": "unknown uploadID"}
+    assert client.post("/upload/" + uploadID + "/complete").get_json() == {"Error": "unknown uploadID"}
+
+def test_missing_part_file(app):
+    client = app.test_client()
+    uploadID = startUpload(client)
+    os.remove(os.path.join(server.UPLOAD_DIR, uploadID + ".part"))
+    assert putChunk(client, uploadID, 0, b"abc") == {"Error": "upload file missing"}
+    assert client.post("/upload/" + uploadID + "/complete").get_json() == {"Error": "upload file missing"}
+
+def test_stream_layout(app):
+    client = app.test_client()
+    response = client.post("/stream", json={"playerID": 1, "layout": "dvorak"}).get_json()
+    assert response == {"Error": "no valid layout"}
+    sessionID = client.post("/stream", json={"playerID": 1, "layout": "ansi_us"}).get_json()["sessionID"]
+    assert server.streams.get(sessionID).layout == "ansi_us"
+
+def test_verify_rejects_unknown_layout(app):
+    response = app.test_client().post("/verify", json={"playerID": 1, "layout": "dvorak"}).get_json()
+    assert response == {"Error": "no valid layout"}
@@ -0,0 +1,41 @@
+from verification import getInputData, getLayout, keyDistances
+
+
+def test_csv_input_data():
+    keystrokes = getInputData(b"timestamp,keycode\n1.0,65\n2.0,66\n")
+    assert keystrokes.tolist() == [(1.0, 65), (2.0, 66)]
+
+def test_malformed_input_data():
+    assert getInputData(b"not a log") is None
+    #only the first line is parsed up front, the bad value is in the block read later
+    assert getInputData(b"timestamp,keycode\n1.0,65\n2.0,abc\n") is None
+
+def test_segments_never_share_hands(monkeypatch):
+    import headless
+    import verification
+
+    passed = []
+    def processVideo(path, corners, hands=None, layout=None, **kwargs):
+        passed.append((hands, layout))
+        return []
+
+    monkeypatch.setattr(headless, "process_video", processVideo)
+    verification.analyzeSegment("video.mp4", None, 0.0, 10.0, 2.0, "ansi_us")
+    verification.analyzeSegment("video.mp4", None, 10.0, None, 2.0, "ansi_us")
+    #without an instance process_video creates and closes a fresh one for the segment
+    assert passed == [(None, "ansi_us"), (None, "ansi_us")]
+
+def test_layout_names():
+    from finger_key_mapping import DEFAULT_LAYOUT
+
+    assert getLayout(None) == DEFAULT_LAYOUT
+    assert getLayout("ansi_us") == "ansi_us"
+    assert getLayout("dvorak") is None
+    assert getLayout("../layouts/iso_de") is None
+
+def test_key_distances_per_layout():
+    iso = keyDistances("iso_de")
+    ansi = keyDistances("ansi_us")
+    assert keyDistances("iso_de") is iso
+    #the iso layout has the extra key left of Z
+    assert len(iso[0]) != len(ansi[0])
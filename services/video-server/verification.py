@@ -0,0 +1,326 @@
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, wait as waitFutures
+
+import numpy as np
+
+#the keystroke detection model lives in model/src of this repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "model", "src"))
+
+
+csvTime = "timestamp"
+csvKey = "keycode"
+#keystroke streams are compared as structured arrays of this type
+KEYSTROKE_DTYPE = np.dtype([(csvTime, np.float64), (csvKey, np.int32)])
+
+#job states reported by VerificationPool.result
+PENDING = "pending"
+DONE = "done"
+UNKNOWN = "unknown"
+
+#finished jobs nobody collected are forgotten after this many seconds
+JOB_TTL = 600
+
+#video segments are analyzed in parallel, each at least this many seconds long
+SEGMENT_MIN_LENGTH = 10.0
+#seconds decoded before every segment to warm up hand tracking
+SEGMENT_OVERLAP = 2.0
+
+#keystrokes the alignment may drift from the diagonal, i.e. missed or extra detections in a row
+ALIGN_WINDOW = 32
+#highest average alignment cost per keystroke that still counts as a match,
+#a missed keystroke costs 1, a neighbouring key about 0.5
+MAX_ALIGN_COST = 0.3
+
+#streaming sessions without new events for this many seconds are forgotten
+STREAM_TTL = 600
+
+#layout name => (codes, distances) between the keys of that keyboard layout, see keyDistances
+_keyDistances = {}
+
+
+#runs the ml model over one time segment of the video, runs inside a worker process
+#corners None detects the keyboard in the video, every segment finds the same corners
+#process_video creates its own Hands, a tracking instance shared between jobs would start
+#every segment from the landmarks of the previous one
+def analyzeSegment(path, corners, start, end, warmup, layout):
+    from headless import process_video
+    return process_video(path, corners, start=start, end=end, warmup=warmup, layout=layout)
+
+
+#finishes the verification once every video segment is analyzed, returns the response dict
+def verifyData(playerID, segmentResults, inputData, layout):
+    #extract the keystrokes from inputData, a binary keystroke log or csv
+    csvInputData = getInputData(inputData)
+    if csvInputData is None:
+        return {"Error": "data was not in csv or keystroke log format"}
+
+    #merges the keystrokes the ml model found in the video segments
+    videoData = getVideoData(segmentResults)
+    if videoData is None:
+        return {"Error": "video data was not in the right format"}
+
+    videoData, inputData = convertData(videoData, csvInputData)
+    if videoData is None or inputData is None:
+        return {"Error": "video and input data cant be parsed"}
+
+    if not match(videoData, inputData, layout):
+        return {"Error": "video and input data didnt match"}
+
+    score = simulateGame(inputData)
+    sig = signScore(playerID, score)
+
+    return {"Signature": sig, "Error": "no Error"}
+
+
+#process pool that analyzes the segments of every uploaded video in parallel
+class VerificationPool:
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    #splits the video file into segments, enqueues them and returns the jobID
+    #layout is the keyboard layout of the recording, release is called once the job is collected or expired
+    def submit(self, playerID, path, inputData, corners, layout, release=None):
+        from headless import video_duration, split_segments
+
+        segments = split_segments(video_duration(path), self.workers, SEGMENT_MIN_LENGTH)
+        futures = [self.executor.submit(analyzeSegment, path, corners, start, end, SEGMENT_OVERLAP, layout)
+                   for start, end in segments]
+
+        jobID = uuid.uuid4().hex
+        with self.lock:
+            self.expire()
+            self.jobs[jobID] = {
+                "segments": futures,
+                "path": path,
+                "playerID": playerID,
+                "inputData": inputData,
+                "layout": layout,
+                "release": release,
+                "created": time.time(),
+            }
+        return jobID
+
+    #returns (status, result), waits up to `wait` seconds for a pending job
+    #a finished job is handed out once and then forgotten
+    def result(self, jobID, wait=0):
+        with self.lock:
+            job = self.jobs.get(jobID)
+        if job is None:
+            return UNKNOWN, None
+
+        _, notDone = waitFutures(job["segments"], timeout=wait)
+        if notDone:
+            return PENDING, None
+
+        with self.lock:
+            #another request may have collected it meanwhile
+            if self.jobs.pop(jobID, None) is None:
+                return UNKNOWN, None
+
+        try:
+            segmentResults = [future.result() for future in job["segments"]]
+            return DONE, verifyData(job["playerID"], segmentResults, job["inputData"], job["layout"])
+        except Exception:
+            return DONE, {"Error": "verification failed"}
+        finally:
+            self.release(job)
+
+    def release(self, job):
+        if job["release"] is not None:
+            job["release"]()
+
+    #drops finished jobs older than JOB_TTL, caller holds the lock
+    def expire(self):
+        now = time.time()
+        for jobID, job in list(self.jobs.items()):
+            if all(future.done() for future in job["segments"]) and now - job["created"] > JOB_TTL:
+                del self.jobs[jobID]
+                self.release(job)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+#incremental verification of a running game, the keystrokes detected in the video and the
+#ones logged by the keyboard are appended as they arrive and aligned right away,
+#so finishing only has to align the last few keystrokes
+class StreamingSession:
+    def __init__(self, playerID, layout):
+        from alignment import StreamingAligner
+
+        codes, distances = keyDistances(layout)
+        self.playerID = playerID
+        self.layout = layout
+        self.aligner = StreamingAligner(codes, distances, window=ALIGN_WINDOW)
+        self.lock = threading.Lock()
+        self.updated = time.time()
+
+    #appends KEYSTROKE_DTYPE arrays of new video and input keystrokes, returns the status dict
+    def append(self, videoData, inputData):
+        with self.lock:
+            self.aligner.extend_a(videoData[csvTime], videoData[csvKey])
+            self.aligner.extend_b(inputData[csvTime], inputData[csvKey])
+            self.updated = time.time()
+            return self.status()
+
+    #average alignment cost per keystroke aligned so far, caller holds the lock
+    def status(self):
+        size = max(self.aligner.rows, 1)
+        return {"Aligned": self.aligner.rows, "Cost": self.aligner.partial_cost()/size, "Error": "no Error"}
+
+    #no more keystrokes will arrive, returns the response dict like verifyData
+    def finish(self):
+        with self.lock:
+            cost = self.aligner.close()
+            inputs = self.aligner.b
+            inputData = np.empty(len(inputs), dtype=KEYSTROKE_DTYPE)
+            inputData[csvTime] = inputs.times[:len(inputs)]
+            inputData[csvKey] = inputs.keys[:len(inputs)]
+
+        if not rating(cost, max(len(self.aligner.a), len(inputs))):
+            return {"Error": "video and input data didnt match"}
+
+        score = simulateGame(inputData)
+        sig = signScore(self.playerID, score)
+        return {"Signature": sig, "Error": "no Error"}
+
+
+#the running StreamingSessions by sessionID
+class StreamingSessions:
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def create(self, playerID, layout):
+        sessionID = uuid.uuid4().hex
+        session = StreamingSession(playerID, layout)
+        with self.lock:
+            self.expire()
+            self.sessions[sessionID] = session
+        return sessionID
+
+    def get(self, sessionID):
+        with self.lock:
+            return self.sessions.get(sessionID)
+
+    #removes the session, it can only be finished once
+    def pop(self, sessionID):
+        with self.lock:
+            return self.sessions.pop(sessionID, None)
+
+    #drops sessions without events for STREAM_TTL seconds, caller holds the lock
+    def expire(self):
+        now = time.time()
+        for sessionID, session in list(self.sessions.items()):
+            if now - session.updated > STREAM_TTL:
+                del self.sessions[sessionID]
+
+
+#converts both keystroke streams to KEYSTROKE_DTYPE arrays, None,None if that isn't possible
+def convertData(videoData, inputData):
+    try:
+        return videoData.astype(KEYSTROKE_DTYPE, copy=False), inputData.astype(KEYSTROKE_DTYPE, copy=False)
+    except (ValueError, TypeError):
+        return None,None
+
+
+#returns true if video and input data match
+#the streams are aligned so a missed or extra detection only costs once instead of shifting everything after it
+def match(videoData, inputData, layout):
+    from alignment import align_keystrokes
+
+    codes, distances = keyDistances(layout)
+    cost = align_keystrokes(videoData[csvTime], videoData[csvKey], inputData[csvTime], inputData[csvKey],
+                            codes, distances, window=ALIGN_WINDOW)
+    return rating(cost, max(len(videoData), len(inputData)))
+
+
+#distances between the keys of the layout the model detects presses on, computed once per layout
+def keyDistances(layout):
+    if layout not in _keyDistances:
+        from alignment import key_distance_table
+        from finger_key_mapping import create_keyboard_layout
+        #distances are in key units so the size doesn't matter
+        _keyDistances[layout] = key_distance_table(create_keyboard_layout(1000, 1000, layout))
+    return _keyDistances[layout]
+
+
+#can be made really fancy!!!
+def rating(cost, itSize):
+    #nothing to compare
+    if itSize == 0:
+        return False
+    return cost/itSize <= MAX_ALIGN_COST
+
+#returns the score of the game simulated by the inputData
+def simulateGame(inputData):
+    return 0
+
+#signs the string playerID:score with the private key of the Server
+def signScore(playerID, score):
+    return ""
+
+#returns the key presses of a binary keystroke log or csv file as KEYSTROKE_DTYPE array or None
+#inputData can be any bytes-like object, e.g. a memory map of the stored file
+def getInputData(inputData, start=-np.inf, end=np.inf):
+    reader = getReader(inputData)
+    if reader is None:
+        return None
+    #only the lines of the index are checked up front, the rest is parsed here
+    try:
+        return reader.presses(start, end).astype(KEYSTROKE_DTYPE, copy=False)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+#random access reader of a keystroke log or None if it isn't one
+def getReader(inputData):
+    from keylog_format import KeylogReader
+
+    try:
+        return KeylogReader(inputData)
+    except (ValueError, UnicodeDecodeError, IndexError):
+        return None
+
+#returns a list of [timestamp, keycode] pairs as KEYSTROKE_DTYPE array or None
+def getEvents(events):
+    try:
+        return np.array([(float(t), int(k)) for t, k in events], dtype=KEYSTROKE_DTYPE)
+    except:
+        return None
+
+#returns the name of the keyboard layout, the default one if none is given, or None if it is unknown
+def getLayout(layout):
+    from finger_key_mapping import available_layouts, DEFAULT_LAYOUT
+
+    if layout is None:
+        return DEFAULT_LAYOUT
+    if layout not in available_layouts():
+        return None
+    return layout
+
+#returns the corners as float32 array of shape (4, 2) or None
+def getCorners(corners):
+    try:
+        corners = np.array(corners, dtype="float32")
+        if corners.shape != (4, 2):
+            return None
+        return corners
+    except:
+        return None
+
+#merges the keystrokes detected in the video segments and returns them as KEYSTROKE_DTYPE array
+def getVideoData(segmentResults):
+    from headless import merge_segments
+
+    if any(keystrokes is None for keystrokes in segmentResults):
+        return None
+    keystrokes = merge_segments(segmentResults)
+    return np.array([(k['timestamp'], k['keycode']) for k in keystrokes if k['keycode'] is not None],
+                    dtype=KEYSTROKE_DTYPE)
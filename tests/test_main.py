@@ -0,0 +1,183 @@
+import asyncio
+import contextlib
+import socket
+import threading
+import time
+
+import aiohttp
+from aiohttp import web
+
+import main
+from main import EventBuffer, post_batch, upload_events
+
+
+class StandIn:
+    # Local attestation endpoint answering with the given statuses (then 200),
+    # every request waits for `gate` so a test can hold batches in flight
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.requests = []
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def handle(self, request):
+        self.requests.append((time.monotonic(), await request.json()))
+        await self.gate.wait()
+        return web.Response(status=self.statuses.pop(0) if self.statuses else 200)
+
+    async def wait_for(self, count, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while len(self.requests) < count:
+            assert time.monotonic() < deadline, "no request arrived"
+            await asyncio.sleep(0.01)
+
+
+@contextlib.asynccontextmanager
+async def stand_in(statuses=()):
+    server = StandIn(statuses)
+    app = web.Application()
+    app.router.add_post('/attest', server.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    await web.SockSite(runner, sock).start()
+    try:
+        yield server, f'http://127.0.0.1:{port}/attest'
+    finally:
+        server.gate.set()
+        await runner.cleanup()
+
+
+def one_batch():
+    buffer = EventBuffer(8)
+    buffer.add_keyboard(65, 1.0)
+    return buffer.swap()
+
+
+def test_server_errors_are_retried_with_backoff(monkeypatch):
+    monkeypatch.setattr(main.random, 'uniform', lambda a, b: 1.0)
+
+    async def run():
+        async with stand_in([500, 503]) as (server, url):
+            async with aiohttp.ClientSession() as session:
+                assert await post_batch(session, url, one_batch(), retries=4, backoff=0.05)
+            return [t for t, _ in server.requests]
+
+    times = asyncio.run(run())
+    assert len(times) == 3
+    assert times[1] - times[0] >= 0.05
+    assert times[2] - times[1] >= 0.1
+
+
+def test_rejected_batch_is_dropped_without_retry():
+    async def run():
+        async with stand_in([400]) as (server, url):
+            async with aiohttp.ClientSession() as session:
+                assert not await post_batch(session, url, one_batch(), retries=4, backoff=0.05)
+            return len(server.requests)
+
+    assert asyncio.run(run()) == 1
+
+
+def test_slow_endpoint_grows_batches():
+    buffer = EventBuffer(8)
+
+    async def run():
+        async with stand_in() as (server, url):
+            server.gate.clear()
+            buffer.add_keyboard(65, 1.0)
+            uploader = asyncio.create_task(upload_events(buffer, url, interval=0.01, max_pending=1))
+            await server.wait_for(1)
+            # The only slot is held by the first batch, the next swap has to wait
+            for timestamp in (2.0, 3.0, 4.0):
+                buffer.add_keyboard(66, timestamp)
+                await asyncio.sleep(0.05)
+            assert len(server.requests) == 1
+            server.gate.set()
+            await server.wait_for(2)
+            uploader.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await uploader
+            return [batch for _, batch in server.requests]
+
+    batches = asyncio.run(run())
+    assert batches[0]['keyboard_timestamps'] == [1.0]
+    assert batches[1]['keyboard_timestamps'] == [2.0, 3.0, 4.0]
+
+
+def test_cancel_flushes_collected_keystrokes():
+    buffer = EventBuffer(8)
+
+    async def run():
+        async with stand_in() as (server, url):
+            uploader = asyncio.create_task(upload_events(buffer, url, interval=60.0))
+            buffer.add_keyboard(65, 1.0)
+            buffer.add_video(65, 1.1)
+            await asyncio.sleep(0.05)
+            uploader.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await uploader
+            return [batch for _, batch in server.requests]
+
+    assert asyncio.run(run()) == [{
+        'keyboard_timestamps': [1.0], 'keyboard_keystrokes': [65],
+        'video_timestamps': [1.1], 'video_keystrokes': [65],
+    }]
+
+
+def test_ring_wraps_around():
+    ring = main.EventRing(4)
+    for i in range(3):
+        ring.push(float(i), i)
+    assert ring.snapshot()['keycode'].tolist() == [0, 1, 2]
+    # Slots 3, 0 and 1 of the ring
+    for i in range(3, 6):
+        ring.push(float(i), i)
+    events = ring.snapshot()
+    assert events['keycode'].tolist() == [3, 4, 5]
+    assert events['timestamp'].tolist() == [3.0, 4.0, 5.0]
+    assert len(ring.snapshot()) == 0
+
+
+def test_full_ring_drops_newest():
+    ring = main.EventRing(4)
+    for i in range(6):
+        ring.push(float(i), i)
+    assert ring.dropped == 2
+    assert ring.snapshot()['keycode'].tolist() == [0, 1, 2, 3]
+    # Freed slots are reused
+    ring.push(6.0, 6)
+    assert ring.snapshot()['keycode'].tolist() == [6]
+
+
+def test_snapshots_keep_order_with_concurrent_writer():
+    ring = main.EventRing(64)
+    count = 20000
+
+    def write():
+        for i in range(count):
+            ring.push(float(i), i)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    received = []
+    while writer.is_alive():
+        received.extend(ring.snapshot()['keycode'].tolist())
+    writer.join()
+    received.extend(ring.snapshot()['keycode'].tolist())
+    # Every event arrives once and in order unless it was dropped for a full ring
+    assert received == sorted(set(received))
+    assert len(received) + ring.dropped == count
+
+
+def test_swap_reports_dropped_keystrokes(capsys):
+    buffer = EventBuffer(2)
+    for i in range(5):
+        buffer.add_keyboard(65, float(i))
+    batch = buffer.swap()
+    assert batch['keyboard_timestamps'] == [0.0, 1.0]
+    assert "Lost 3 keyboard keystrokes" in capsys.readouterr().out
+    buffer.swap()
+    assert capsys.readouterr().out == ""